@@ -0,0 +1,113 @@
+"""A local, content-addressed cache of analysis results.
+
+Results are keyed by the sha1 of the image file(s), the analysis mode and a hash of the analysis settings, so a shot
+is never analyzed twice with the same settings, no matter whether AnalysisLogger was restarted, switched between
+modes or the images were moved. File hashes are themselves cached by (path, size, mtime), so looking up a folder of
+thousands of already analyzed shots costs one stat per image rather than reading every image. Both live in a sqlite
+file; the least recently used results are evicted once there are more than max_entries.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+_SCHEMA = ["""CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    run_id INTEGER,
+    analysis TEXT NOT NULL,
+    settings TEXT,
+    last_used REAL NOT NULL)""",
+           "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)",
+           """CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL)"""]
+
+
+def _jsonable(value):
+    """JSON default for settings values: numpy and MATLAB arrays, e.g. marqueeBox, become (nested) lists, so they
+    are stored and hashed the same whether they come from an analysis or from the cache."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    try:
+        return [item if isinstance(item, (int, float, str)) else _jsonable(item) for item in value]
+    except TypeError:
+        return str(value)
+
+
+def settings_hash(settings):
+    """Returns a hash of a (JSON-like) analysis settings dict, independent of key order."""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=_jsonable).encode()).hexdigest()
+
+
+class AnalysisCache():
+
+    def __init__(self, db_path=os.path.join(os.path.dirname(__file__), 'analysis_cache.sqlite'), max_entries=100000):
+        """
+        Args:
+            - db_path: sqlite file holding the cache.
+            - max_entries: number of results kept, the least recently used are evicted first.
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()  # the connection is shared by the stages of analysis_pipeline.py
+        with self.conn:
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+
+    def file_hash(self, filepath):
+        """Returns the sha1 hexdigest of a file, only reading it if its size or mtime changed since it was hashed."""
+        path = os.path.abspath(filepath)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT sha1 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                    (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        checksum = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha1) VALUES (?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns, checksum.hexdigest()))
+            # keep the hashes of the newest few images per cached result
+            self.conn.execute("DELETE FROM file_hashes WHERE rowid <= (SELECT MAX(rowid) FROM file_hashes) - ?",
+                              (3 * self.max_entries,))
+        return checksum.hexdigest()
+
+    def key(self, file, analysis_mode, settings=None):
+        """Returns the cache key of analyzing file (a filepath or list of filepaths) in analysis_mode with settings."""
+        filepaths = [file] if isinstance(file, str) else list(file)
+        content_hash = '+'.join(self.file_hash(filepath) for filepath in filepaths)
+        return '{content}:{mode}:{settings}'.format(content=content_hash, mode=analysis_mode,
+                                                    settings=settings_hash(settings))
+
+    def get(self, key):
+        """Returns a dict with the run_id, analysis and settings stored under key, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT run_id, analysis, settings FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {'run_id': row[0], 'analysis': json.loads(row[1]), 'settings': json.loads(row[2])}
+
+    def put(self, key, run_id, analysis_dict, settings=None):
+        """Stores the analysis_dict and returned settings of run_id under key and evicts the least recently used
+        results beyond max_entries."""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO results (key, run_id, analysis, settings, last_used) VALUES (?, ?, ?, ?, ?)",
+                              (key, run_id, json.dumps(analysis_dict, default=float),
+                               json.dumps(settings, default=_jsonable), time.time()))
+            self.conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                              (self.max_entries,))
+
+    def close(self):
+        self.conn.close()
@@ -7,8 +7,12 @@ import enrico_bot
 from math import isnan
 import sys
 import pickle
-from measurement_directory import run_ids_from_filenames
+import threading
 from json import JSONDecodeError
+from write_completion import WriteCompletionWaiter
+from watchfolder_index import WatchfolderIndex
+from analysis_scheduler import AnalysisScheduler
+from breadboard_outbox import BreadboardOutbox
 
 
 class AnalysisLogger():
@@ -19,7 +23,9 @@ class AnalysisLogger():
 
     def __init__(self, analysis_mode=None, watchfolder=None, load_matlab=True,
                  save_images=None, refresh_time=0.2, save_previous_settings=True,
-                 append_mode=True, export_time = 10):
+                 append_mode=True, export_time = 10, n_engines=1,
+                 analysis_cache_path=os.path.join(os.path.dirname(__file__), 'analysis_cache.sqlite'),
+                 scheduler=None, outbox_path=None, previous_settings=None):
         """
         Args:
             - analysis_mode: determines which MATLAB function to perform analysis with.
@@ -28,6 +34,15 @@ class AnalysisLogger():
             - save_images: if set to False, images are discarded after analysis.
             - save_previous_settings: set to False if analysis settings, e.g. normBox, needs to be reset on each shot
             - append_mode: set to True to check breadboard for existing analysis before analyzing
+            - n_engines: number of MATLAB engines analyzing shots in parallel, see matlab_engine_pool.py
+            - analysis_cache_path: sqlite file of results by image content, mode and settings, see analysis_cache.py.
+                Shots found there are neither analyzed nor checked on breadboard again. None disables the cache.
+            - scheduler: AnalysisScheduler deciding the order of analysis and shedding of unanalyzed shots,
+                see analysis_scheduler.py. By default newest shot first with a backfill of older shots.
+            - outbox_path: sqlite file of the breadboard uploads waiting to be sent, see breadboard_outbox.py.
+                By default one file per analysis_mode next to analysis_logger.py.
+            - previous_settings: analysis settings, e.g. marqueeBox and normBox, to analyze the first shots with,
+                e.g. those of a previous AnalysisLogger. None starts from the defaults of the analysis function.
         """
 
         # ycam, zcam double imaging, zcam triple imaging, and default images_per_shot
@@ -63,19 +78,45 @@ class AnalysisLogger():
         print("\n\n Watching this folder for changes: " +
               self.watchfolder + "\n\n")
         self.init_logger()
+        self.n_engines = n_engines
+        self.engine_pool = None
+        self.inline_preview = True  # False if a separate pipeline stage saves the .jpeg previews
+        self.eng = None  # MATLAB engine, see load_matlab_engine
         if load_matlab:
             self.load_matlab_engine()
         self.load_matlab_wrapper()
+        self.previous_settings = previous_settings
+        self.dispatcher = None
+        if self.engine_pool is not None:
+            from matlab_engine_pool import AnalysisDispatcher
+            self.dispatcher = AnalysisDispatcher(self.engine_pool, self.analysis_function,
+                                                 previous_settings=self.previous_settings)
         self.load_breadboard_client()
+        if outbox_path is None:
+            outbox_path = os.path.join(os.path.dirname(__file__),
+                                       'breadboard_outbox_{mode}.sqlite'.format(mode=self.analysis_mode))
+        # uploads are queued on disk and sent in the background, see breadboard_outbox.py
+        self.outbox = BreadboardOutbox(self.bc, outbox_path)
         self.save_images = save_images  # TODO delete images from BECserver
         self.refresh_time = refresh_time
-        self.previous_settings = None
-        self.unanalyzed_ids = []
+        # unanalyzed run_ids, in a latest and a backfill lane
+        self.scheduler = AnalysisScheduler() if scheduler is None else scheduler
         self.done_ids = []
         # check breadboard if analysis has already been done on image, e.g. if analysis is restarted
         self.append_mode = append_mode
         self.save_previous_settings = save_previous_settings
         self.export_time = export_time
+        self.analysis_cache = None
+        if analysis_cache_path is not None:
+            from analysis_cache import AnalysisCache
+            self.analysis_cache = AnalysisCache(analysis_cache_path)
+        self.cache_keys = {}  # run_id: cache key of the analyses in flight
+        # guards done_ids, cache_keys, checked_ids and analyzed_ids, shared by the stages of run_pipeline
+        self.lock = threading.RLock()
+        # run_ids whose breadboard parameters were checked, and those known to have analyzed_var_names
+        self.checked_ids, self.analyzed_ids = set(), set()
+        self.write_completion = None  # created once the watchfolder exists, see wait_until_written
+        self.watchfolder_index = None  # created once the watchfolder exists, see monitor_watchfolder
 
     def init_logger(self):
         import logging
@@ -146,7 +187,15 @@ class AnalysisLogger():
 
     def load_matlab_engine(self):
         import matlab_wrapper
-        self.eng = matlab_wrapper.load_matlab_engine()
+        if self.n_engines == 1:
+            self.eng = matlab_wrapper.load_matlab_engine()
+        else:
+            from matlab_engine_pool import MatlabEnginePool
+            analysis_library_paths = {'y': matlab_wrapper.ycam_path,
+                                      'zd': matlab_wrapper.dualimaging_path,
+                                      'zt': matlab_wrapper.tripleimaging_path}
+            self.engine_pool = MatlabEnginePool(n_engines=self.n_engines,
+                                                analysis_library_path=analysis_library_paths[self.analysis_mode])
 
     def load_matlab_wrapper(self):
         """
@@ -162,19 +211,28 @@ class AnalysisLogger():
             'zt': ('getTripleImagingAnalysis', 'triple_imaging_analyzed_var_names')}
         self.matlab_func_name, self.analyzed_var_names = (getattr(
             matlab_wrapper, name) for name in analysis_modes_dict[self.analysis_mode])
-
-        def analysis_function(filepath, previous_settings=None):
+        def analysis_function(filepath, previous_settings=None, eng=None):
             """A generic placeholder for one of Carsten's MATLAB analysis functions.
             By passing in previous_settings, one can avoid resetting manually inputted settings, e.g. normBox.
+            eng is an engine of self.engine_pool, which is already in the analysis library folder, or self.eng if None.
 
             Returns a MATLAB analysis struct mapped to a Python dict, analysis_dict, and a settings dict compatible with the MATLAB wrapper functions.
             """
+            kwargs = {}
+            if not self.inline_preview:
+                kwargs['save_jpg_preview'] = False
+            if eng is None:
+                eng = self.eng
+            else:
+                kwargs['analysis_library_path'] = None
             if previous_settings is None:
-                matlab_dict = self.matlab_func_name(self.eng, filepath)
+                matlab_dict = self.matlab_func_name(eng, filepath, **kwargs)
             else:
-                matlab_dict = self.matlab_func_name(self.eng, filepath, marqueeBox=self.previous_settings['marqueeBox'],
-                                                    normBox=self.previous_settings['normBox'])
+                matlab_dict = self.matlab_func_name(eng, filepath, marqueeBox=previous_settings['marqueeBox'],
+                                                    normBox=previous_settings['normBox'], **kwargs)
             analysis_dict, settings = matlab_dict['analysis'], matlab_dict['settings']
+            if 'ODimage' in matlab_dict and not self.inline_preview:  # saved by preview_stage
+                analysis_dict['ODimage'] = matlab_dict['ODimage']
             if settings == {}:
                 settings = None
             if not self.save_previous_settings:
@@ -185,47 +243,83 @@ class AnalysisLogger():
 
     def monitor_watchfolder(self):
         """
-        Adds new images to the stack of unanalyzed_ids.
+        Adds new images to the scheduler of unanalyzed run_ids.
         """
         watchfolder = self.watchfolder
         if not os.path.exists(watchfolder):
             pass
         else:
-            files = [filename for filename in os.listdir(watchfolder)]
-            filesSPE = []
-            for file in files:  # filter out non .spe files
-                if '.spe' in file:
-                    filesSPE.append(file)
-            files = filesSPE
-            run_ids = run_ids_from_filenames(files)
-            fresh_ids = sorted(list(set(run_ids).difference(
-                set(self.done_ids)).difference(set(self.unanalyzed_ids))))
-            self.unanalyzed_ids += fresh_ids
+            if self.watchfolder_index is None:
+                self.watchfolder_index = WatchfolderIndex(watchfolder)
+            # each run_id is reported once, when its first image appears, see watchfolder_index.py
+            fresh_ids = self.watchfolder_index.new_run_ids()
+            if self.append_mode and len(fresh_ids) > 1:
+                self.prefetch_analyzed_ids(fresh_ids)
+            self.scheduler.add(fresh_ids)
+            for run_id in self.scheduler.pop_shed_ids():
+                self.logger.warning('{run_id} shed from the analysis backlog: {metrics}'.format(
+                    run_id=str(run_id), metrics=str(self.scheduler.metrics())))
 
     def analyze_newest_images(self):
         """
-        Analyzes the newest run_id on the stack of unanalyzed_ids and uploads to breadboard. 
+        Analyzes the next run_id from the scheduler (usually the newest) and uploads to breadboard. 
         Deletes images locally after analysis if self.save_images is False.
         """
-        def analyze_image(filepath):
-            """Helper function for cleaning analysis_dict to JSON serializable types
-            before uploading to breadboard.
-            """
-            self.logger.debug('{file} analyzing: '.format(file=filepath))
-            analysis_dict, settings = self.analysis_function(
-                filepath, self.previous_settings)
-            cleaned_analysis_dict = {}
-            print('\n')
-            for key in self.analyzed_var_names:
-                if not isnan(analysis_dict[key]):
-                    cleaned_analysis_dict[key] = analysis_dict[key]
-                    print(key, analysis_dict[key])
-            print('\n')
-            return cleaned_analysis_dict, settings
+        run_id = self.scheduler.next_run_id()
+        print(self.scheduler.metrics())
+        file = self.wait_for_shot(run_id)
+        self.cache_keys[run_id], cached = self.lookup_analysis_cache(file, self.previous_settings)
+        if cached is not None:
+            self.restore_cached_settings(cached)
+        if (cached is not None and cached['run_id'] == run_id) or (
+                cached is None and self.append_mode and self.is_analyzed(run_id)):
+            self.scheduler.remove(run_id)
+            self.done_ids += [run_id]
+            self.cache_keys.pop(run_id)
+            return None
+        if cached is not None:  # the same images were analyzed for another run_id
+            analysis_dict = cached['analysis']
+        else:
+            try:
+                self.logger.debug('{file} analyzing: '.format(file=file))
+                analysis_dict, self.previous_settings = self.analysis_function(
+                    file, self.previous_settings)
+            except:  # if MATLAB analysis fails
+                analysis_dict = None
+        self.scheduler.remove(run_id)
+        self.finish_analysis(run_id, file, analysis_dict, self.previous_settings)
+
+    def dispatch_analyses(self):
+        """
+        Submits the next run_ids from the scheduler to idle engines of self.engine_pool,
+        and uploads finished analyses to breadboard in run_id order.
+        """
+        while len(self.scheduler) > 0 and not self.dispatcher.is_full():
+            run_id = self.scheduler.pop()
+            file = self.wait_for_shot(run_id)
+            self.cache_keys[run_id], cached = self.lookup_analysis_cache(file, self.dispatcher.previous_settings)
+            if cached is not None:
+                self.restore_cached_settings(cached)
+            if (cached is not None and cached['run_id'] == run_id) or (
+                    cached is None and self.append_mode and self.is_analyzed(run_id)):
+                self.done_ids += [run_id]
+                self.cache_keys.pop(run_id)
+                continue
+            if cached is not None:  # the same images were analyzed for another run_id
+                self.finish_analysis(run_id, file, cached['analysis'], self.previous_settings)
+                continue
+            self.logger.debug('{file} analyzing: '.format(file=file))
+            self.dispatcher.submit(run_id, file)
+        for run_id, file, analysis_dict, error in self.dispatcher.pop_finished(timeout=self.refresh_time):
+            if error is not None:
+                self.logger.debug('{run_id} analysis error: {error}'.format(run_id=str(run_id), error=repr(error)))
+            self.previous_settings = self.dispatcher.previous_settings
+            self.finish_analysis(run_id, file, analysis_dict, self.previous_settings)
 
-        bc, watchfolder = self.bc, self.watchfolder
-        run_id = self.unanalyzed_ids[-1]  # start from top of stack
-        print(self.unanalyzed_ids)
+    def wait_for_shot(self, run_id):
+        """Returns the filepath (or list of filepaths for multiple images per shot) of run_id's images,
+        once they are completely written."""
+        watchfolder = self.watchfolder
         if self.images_per_shot == 1:
             file = os.path.join(watchfolder,
                                 '{run_id}_0.spe'.format(run_id=run_id))
@@ -234,38 +328,91 @@ class AnalysisLogger():
             file = [os.path.join(watchfolder, '{run_id}_{idx}.spe'.format(
                 run_id=run_id, idx=idx)) for idx in range(self.images_per_shot)]
             pending_file = file[-1]
-            while not os.path.exists(pending_file):
-                print(pending_file + ' not finished writing to disk. Waiting ...')
-                time.sleep(1)
-        old_filesize = 0
         # wait for file to finish writing to hard disk before opening in MATLAB
-        while os.path.getsize(pending_file) != old_filesize:
-            old_filesize = os.path.getsize(pending_file)
-            time.sleep(0.3)
-        if self.append_mode:
-            run_dict = bc._send_message(
-                'get', '/runs/' + str(run_id) + '/').json()
-            if set(self.analyzed_var_names).issubset(set(run_dict['parameters'].keys())):
-                popped_id = [self.unanalyzed_ids.pop()]
-                self.done_ids += popped_id
-                return None
+        self.wait_until_written(pending_file)
+        return file
+
+    def lookup_analysis_cache(self, file, settings):
+        """Returns the analysis cache key of analyzing file with settings in this mode, and the cached result or None.
+        Both are None without a cache."""
+        if self.analysis_cache is None:
+            return None, None
+        key = self.analysis_cache.key(file, self.analysis_mode, settings)
+        return key, self.analysis_cache.get(key)
+
+    def cached_settings(self, cached):
+        """Returns the settings stored with a cached result, in the form the analysis function returns them."""
+        settings = cached['settings']
+        if settings is not None:
+            import matlab  # boxes are stored as lists, see analysis_cache.py
+            settings = {key: matlab.double(value) if isinstance(value, list) else value
+                        for key, value in settings.items()}
+        return settings
+
+    def restore_cached_settings(self, cached):
+        """Continues from the settings stored with a cached result, as if its analysis had just run, so the cache keys
+        of the following shots, which include the settings, match those of the first run, e.g. after a restart."""
+        settings = self.cached_settings(cached)
+        self.previous_settings = settings
+        if self.dispatcher is not None:
+            self.dispatcher.previous_settings = settings
+
+    def prefetch_analyzed_ids(self, run_ids):
+        """Gets the parameters of all run_ids at once from the local mirror of breadboard runs, which fetches the runs
+        it does not hold, see utility_functions.get_runs_by_ids. is_analyzed then needs no request per shot, e.g. when
+        restarting on a folder of thousands of shots."""
+        from utility_functions import get_runs_by_ids
+        run_dicts = get_runs_by_ids(self.bc, run_ids)
+        with self.lock:
+            for run_id, run_dict in run_dicts.items():
+                self.checked_ids.add(run_id)
+                if set(self.analyzed_var_names).issubset(set(run_dict.keys())):
+                    self.analyzed_ids.add(run_id)
+        self.logger.debug('prefetched {n} runs, {n_analyzed} already analyzed'.format(
+            n=str(len(run_dicts)), n_analyzed=str(len(self.analyzed_ids.intersection(run_dicts)))))
+
+    def is_analyzed(self, run_id):
+        # analysis results are never removed from breadboard, so the answers are kept
+        with self.lock:
+            checked = run_id in self.checked_ids
+        if not checked:
+            self.prefetch_analyzed_ids([run_id])
+        with self.lock:
+            return run_id in self.analyzed_ids
+
+    def finish_analysis(self, run_id, file, analysis_dict, settings=None):
+        """Queues the upload of the analysis_dict of run_id to breadboard, or marks it as a bad shot if analysis_dict is
+        None, i.e. the analysis failed, and caches it with the settings the analysis returned. Deletes the images
+        afterwards if self.save_images is False."""
+        watchfolder = self.watchfolder
         try:
-            analysis_dict, self.previous_settings = analyze_image(
-                file)
-            resp = bc.append_analysis_to_run(run_id, analysis_dict)
+            # clean analysis_dict to JSON serializable types before uploading to breadboard
+            cleaned_analysis_dict = {}
+            print('\n')
+            for key in self.analyzed_var_names:
+                if not isnan(analysis_dict[key]):
+                    cleaned_analysis_dict[key] = analysis_dict[key]
+                    print(key, analysis_dict[key])
+            print('\n')
+            uploaded_analysis_dict = {key: analysis_dict[key] for key in self.analyzed_var_names}
         except:  # if MATLAB analysis fails
-            analysis_dict = {'badshot': True}
+            uploaded_analysis_dict = None
+            cleaned_analysis_dict = {'badshot': True}
             warning_message = str(
                 run_id) + 'could not be analyzed. Marking as bad shot.'
-            resp = bc.append_analysis_to_run(run_id, analysis_dict)
             warnings.warn(warning_message)
             self.logger.warn(warning_message)
-        
-        popped_id = [self.unanalyzed_ids.pop()]
-        self.done_ids += popped_id
+        # upload errors are logged and retried by the outbox
+        self.outbox.append_analysis_to_run(run_id, cleaned_analysis_dict)
 
-        if resp.status_code != 200:
-            self.logger.warning('Upload error: ' + resp.text)
+        popped_id = [run_id]
+        with self.lock:
+            if uploaded_analysis_dict is not None:
+                self.analyzed_ids.add(run_id)
+            self.done_ids += popped_id
+            cache_key = self.cache_keys.pop(run_id, None)
+        if cache_key is not None and uploaded_analysis_dict is not None:
+            self.analysis_cache.put(cache_key, run_id, uploaded_analysis_dict, settings)
 
         if not self.save_images:  # delete images and add run_ids to .txt file after analysis if in testing mode
             print('Not saving images.')
@@ -286,6 +433,13 @@ class AnalysisLogger():
                     id=str(popped_id[0]), file=os.path.join(watchfolder, 'run_ids.txt')))
         print('\n')
 
+    def wait_until_written(self, filepath):
+        """Blocks until the image at filepath exists and is completely written, see write_completion.py."""
+        if self.write_completion is None:
+            self.write_completion = WriteCompletionWaiter(self.watchfolder)
+        while not self.write_completion.wait_until_complete(filepath, timeout=10):
+            print(filepath + ' not finished writing to disk. Waiting ...')
+
     def dump(self):
         with open(os.path.join(self.watchfolder, 'analysisLogger.pkl'), 'wb') as file:
             pickle.dump(self, file)
@@ -311,13 +465,27 @@ class AnalysisLogger():
         print('Export completed.')
 
 
-    def main(self):
+    def main(self, pipeline=True):
+        """
+        Analyzes the shots of the watchfolder as they arrive, by default with run_pipeline. With pipeline=False the
+        shots are analyzed one at a time by this thread, or in parallel with dispatch_analyses for n_engines > 1.
+        """
+        if pipeline:
+            return self.run_pipeline()
         export_idx = 0
         export_threshold_int = int(self.export_time * 60 / self.refresh_time)
         while True:
             export_idx += 1
             self.monitor_watchfolder()
-            if len(self.unanalyzed_ids) > 0:
+            if self.dispatcher is not None and len(self.scheduler) + len(self.dispatcher.in_flight) > 0:
+                try:
+                    self.dispatch_analyses()
+                    if export_idx % export_threshold_int == 0:
+                        self.export_params_csv()
+                except JSONDecodeError as e:
+                    print('JSONDecodeError encountered. Trying again later.')
+                continue  # pop_finished waits up to refresh_time for analyses instead of sleeping
+            if len(self.scheduler) > 0:
                 try:
                     self.analyze_newest_images()
                     if export_idx % export_threshold_int == 0:
@@ -328,6 +496,129 @@ class AnalysisLogger():
             time.sleep(self.refresh_time)
             
 
+    def run_pipeline(self, metrics_interval=60):
+        """
+        Runs the analysis as a pipeline of stages connected by bounded queues (see analysis_pipeline.py):
+        discover -> wait_complete -> analyze -> preview -> upload -> export. This thread schedules run_ids
+        into the pipeline and logs the stage metrics every metrics_interval seconds. With several engines, the analyze
+        stage passes shots on in the order they were scheduled (usually newest first, see analysis_scheduler.py), not
+        in the order they finish, so uploads and previous_settings advance in that order as with a single engine.
+        With a single engine, every shot is analyzed with the settings of the shot before, see release_analysis.
+        """
+        from analysis_pipeline import Stage, Pipeline
+        self.inline_preview = False  # the MATLAB ODimage is saved by preview_stage
+        self.last_export_time = time.monotonic()
+        n_analysis_workers = 1 if self.engine_pool is None else self.engine_pool.size
+        self.pipeline = Pipeline([Stage('discover', self.discover_stage),
+                                  Stage('wait_complete', self.wait_complete_stage),
+                                  Stage('analyze', self.analyze_stage, n_workers=n_analysis_workers,
+                                        maxsize=2 * n_analysis_workers, ordered=True,
+                                        release=self.release_analysis),
+                                  Stage('preview', self.preview_stage),
+                                  Stage('upload', self.upload_stage),
+                                  Stage('export', self.export_stage)])
+        self.pipeline.start()
+        last_metrics_time = time.monotonic()
+        try:
+            while True:
+                self.monitor_watchfolder()
+                run_id = self.scheduler.pop()
+                if run_id is None:
+                    time.sleep(self.refresh_time)
+                else:
+                    self.pipeline.put(run_id)  # blocks while the pipeline is full
+                if time.monotonic() - last_metrics_time > metrics_interval:
+                    self.logger.debug('pipeline metrics: ' + str(self.pipeline.metrics()))
+                    last_metrics_time = time.monotonic()
+        finally:
+            self.pipeline.stop()
+
+    def discover_stage(self, run_id):
+        watchfolder = self.watchfolder
+        if self.images_per_shot == 1:
+            file = os.path.join(watchfolder, '{run_id}_0.spe'.format(run_id=run_id))
+        else:
+            file = [os.path.join(watchfolder, '{run_id}_{idx}.spe'.format(
+                run_id=run_id, idx=idx)) for idx in range(self.images_per_shot)]
+        return {'run_id': run_id, 'file': file}
+
+    def wait_complete_stage(self, shot):
+        """Waits for the images of a shot and hashes them for the analysis cache, so the lookup in analyze_stage,
+        which depends on the settings the shot is analyzed with, costs one stat per image."""
+        shot['file'] = self.wait_for_shot(shot['run_id'])
+        if self.analysis_cache is not None:
+            for filepath in [shot['file']] if isinstance(shot['file'], str) else shot['file']:
+                self.analysis_cache.file_hash(filepath)
+        return shot
+
+    def analyze_stage(self, shot):
+        """Analyzes a shot, unless it was analyzed before with the settings it would be analyzed with now. A cached
+        result is looked up with exactly those settings, and its settings are continued from like those of an
+        analysis, see release_analysis."""
+        run_id = shot['run_id']
+        # shots in parallel all start from the settings released last, see release_analysis
+        previous_settings = self.previous_settings
+        cache_key, cached = self.lookup_analysis_cache(shot['file'], previous_settings)
+        if cached is not None:
+            shot['settings'] = self.cached_settings(cached)
+        if (cached is not None and cached['run_id'] == run_id) or (
+                cached is None and self.append_mode and self.is_analyzed(run_id)):
+            shot['analyzed_before'] = True
+            return shot
+        with self.lock:
+            self.cache_keys[run_id] = cache_key
+        if cached is not None:  # the same images were analyzed for another run_id
+            shot['analysis_dict'] = cached['analysis']
+            return shot
+        self.logger.debug('{file} analyzing: '.format(file=shot['file']))
+        try:
+            if self.engine_pool is None:
+                shot['analysis_dict'], shot['settings'] = self.analysis_function(shot['file'], previous_settings)
+            else:
+                with self.engine_pool.engine() as eng:
+                    shot['analysis_dict'], shot['settings'] = self.analysis_function(shot['file'], previous_settings,
+                                                                                     eng)
+        except:  # if MATLAB analysis fails
+            shot['analysis_dict'] = None
+        return shot
+
+    def release_analysis(self, shot):
+        """Advances previous_settings to the settings of an analyzed shot. The analyze stage calls this one shot at a
+        time, in the order the shots were scheduled, and before its worker takes the next shot, so previous_settings
+        is only changed here and a single engine chains the settings from shot to shot. Drops the shots that were
+        analyzed before."""
+        if 'settings' in shot:
+            self.previous_settings = shot['settings']
+        if shot.get('analyzed_before', False):
+            with self.lock:
+                self.done_ids += [shot['run_id']]
+            return None
+        return shot
+
+    def preview_stage(self, shot):
+        """Saves the ODimage returned by the MATLAB analysis as a .jpeg preview next to the (first) image of the shot,
+        as matlab_wrapper does when the analysis saves it inline."""
+        if shot['analysis_dict'] is None or 'ODimage' not in shot['analysis_dict']:
+            return shot
+        from matlab_wrapper import save_od_preview
+        od_image = shot['analysis_dict'].pop('ODimage')
+        filepath = shot['file'] if isinstance(shot['file'], str) else shot['file'][0]
+        try:
+            save_od_preview(od_image, filepath)
+        except Exception as e:
+            self.logger.debug('no preview of {file}: {error}'.format(file=str(shot['file']), error=repr(e)))
+        return shot
+
+    def upload_stage(self, shot):
+        self.finish_analysis(shot['run_id'], shot['file'], shot['analysis_dict'], shot.get('settings'))
+        return shot['run_id']
+
+    def export_stage(self, run_id):
+        if time.monotonic() - self.last_export_time > self.export_time * 60:
+            self.export_params_csv()
+            self.last_export_time = time.monotonic()
+        return None
+
     def crash_messsage(self):
         warning_message = '{folder} analysis crashed: '.format(folder=watchfolder) + 'Error: {}. {}, line: {}'.format(sys.exc_info()[0],
                                                                                                                       sys.exc_info()[
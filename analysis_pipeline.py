@@ -0,0 +1,182 @@
+"""A pipeline of stages connected by bounded queues, each stage running in its own worker thread(s).
+
+A stage takes items from its input queue, passes each through its function and puts the result on the input queue of
+the next stage (or drops the item if the function returns None). As the queues are bounded, a slow stage fills its
+input queue and then blocks the stage before it, instead of letting a backlog pile up in memory: this backpressure
+shows up in the blocked_sec counter of the stage before the bottleneck. Every stage counts its processed items, errors
+and busy time, see Pipeline.metrics. A stage with several workers passes its results on in the order they finish,
+unless it is ordered: then every item gets a ticket, in the order the workers take the items from the input queue,
+and a result waits in a reorder buffer until the results of all lower tickets were passed on. As the queues are FIFO,
+an ordered stage after stages with a single worker (or ordered ones) passes its results on in the order the items
+were fed to the pipeline, whatever that order is, e.g. newest run_id first. A stage can also release its results,
+i.e. pass each through a function, one at a time and in the order they are passed on, e.g. to advance state that the
+next items of the stage start from. AnalysisLogger.run_pipeline builds the analysis path from these stages.
+"""
+import time
+import queue
+import logging
+import threading
+
+_STOP = object()
+_PENDING = object()
+
+
+class Stage():
+
+    def __init__(self, name, function, n_workers=1, maxsize=4, ordered=False, release=None):
+        """
+        Args:
+            - name: stage name used in metrics and logs.
+            - function: takes an item and returns the item for the next stage, or None to drop it.
+            - n_workers: number of worker threads running function.
+            - maxsize: capacity of the input queue of the stage.
+            - ordered: if True, results are passed on in the order the items were taken from the input queue rather
+                than in the order they finish.
+            - release: optional function called with every result before it is passed on, one result at a time and
+                before the worker takes its next item. Returns the item for the next stage, or None to drop it.
+        """
+        self.name = name
+        self.function = function
+        self.n_workers = n_workers
+        self.input_queue = queue.Queue(maxsize=maxsize)
+        self.next_stage = None
+        self.workers = []
+        self.ordered = ordered
+        self.release = release
+        self.next_ticket = 0
+        self.in_flight = {}  # ticket: output, or _PENDING while the item is processed
+        self.get_lock = threading.Lock()  # hands out the tickets in the order of the input queue
+        self.order_lock = threading.Lock()
+        self.forward_lock = threading.Lock()  # keeps the released outputs of several workers in order
+        self.lock = threading.Lock()
+        self.processed, self.dropped, self.errors = 0, 0, 0
+        self.busy_sec, self.blocked_sec = 0.0, 0.0
+        self.start_time = None
+        self.logger = logging.getLogger(__name__)
+
+    def put(self, item):
+        """Puts item on the input queue of the stage, blocking while it is full."""
+        self.input_queue.put(item)
+
+    def _forward(self, item):
+        start_time = time.perf_counter()
+        self.next_stage.put(item)
+        with self.lock:
+            self.blocked_sec += time.perf_counter() - start_time
+
+    def _work(self):
+        while True:
+            with self.get_lock:
+                item = self.input_queue.get()
+                if item is _STOP:
+                    break
+                if self.ordered:
+                    with self.order_lock:
+                        ticket = self.next_ticket
+                        self.next_ticket += 1
+                        self.in_flight[ticket] = _PENDING
+            start_time = time.perf_counter()
+            try:
+                output = self.function(item)
+            except Exception as e:
+                output = None
+                with self.lock:
+                    self.errors += 1
+                self.logger.warning('{stage} stage failed on {item}: {error}'.format(
+                    stage=self.name, item=str(item), error=repr(e)))
+            with self.lock:
+                self.processed += 1
+                self.busy_sec += time.perf_counter() - start_time
+                if output is None:
+                    self.dropped += 1
+            if self.ordered or self.release is not None:
+                self._release(ticket if self.ordered else None, output)
+            elif output is not None and self.next_stage is not None:
+                self._forward(output)
+
+    def _release(self, ticket, output):
+        """Stores the output of the item of ticket in the reorder buffer and passes on all outputs with no unfinished
+        item of a lower ticket, through the release function of the stage. Unordered outputs are passed on at once."""
+        with self.forward_lock:
+            if self.ordered:
+                with self.order_lock:
+                    self.in_flight[ticket] = output
+                    released = []
+                    while len(self.in_flight) > 0 and self.in_flight[min(self.in_flight)] is not _PENDING:
+                        released.append(self.in_flight.pop(min(self.in_flight)))
+            else:
+                released = [output]
+            for output in released:
+                if output is not None and self.release is not None:
+                    output = self._release_output(output)
+                if output is not None and self.next_stage is not None:
+                    self._forward(output)
+
+    def _release_output(self, output):
+        try:
+            return self.release(output)
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            self.logger.warning('{stage} stage failed to release {item}: {error}'.format(
+                stage=self.name, item=str(output), error=repr(e)))
+            return None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        for idx in range(self.n_workers):
+            worker = threading.Thread(target=self._work, name='{name}-{idx}'.format(name=self.name, idx=idx),
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.input_queue.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def metrics(self):
+        """Returns a dict of queue_depth, queue_capacity, processed, dropped (function returned None), errors,
+        items_per_sec since start, busy_fraction of the workers' time, blocked_sec, the total time spent waiting
+        for room in the next stage's queue, and reorder_depth, the items in an ordered stage."""
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        with self.lock:
+            return {'queue_depth': self.input_queue.qsize(),
+                    'queue_capacity': self.input_queue.maxsize,
+                    'processed': self.processed,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'items_per_sec': self.processed / elapsed if elapsed > 0 else 0,
+                    'busy_fraction': self.busy_sec / (elapsed * self.n_workers) if elapsed > 0 else 0,
+                    'blocked_sec': self.blocked_sec,
+                    'reorder_depth': len(self.in_flight)}
+
+
+class Pipeline():
+
+    def __init__(self, stages):
+        """
+        Args:
+            - stages: list of Stage, in the order items pass through them.
+        """
+        self.stages = stages
+        for stage, next_stage in zip(stages[:-1], stages[1:]):
+            stage.next_stage = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        """Feeds item to the first stage, blocking while its queue is full."""
+        self.stages[0].put(item)
+
+    def stop(self):
+        """Stops the stages in order, after each finished the items already queued."""
+        for stage in self.stages:
+            stage.stop()
+
+    def metrics(self):
+        return {stage.name: stage.metrics() for stage in self.stages}
@@ -0,0 +1,130 @@
+"""Decides which shot AnalysisLogger analyzes next.
+
+The scheduler keeps two lanes. The latest lane holds only the newest shot, so the operator's live feedback is never
+more than one analysis behind. The backfill lane holds every older unanalyzed shot and is served whenever no newer
+shot is waiting, and in any case every backfill_interval-th pick, so older shots cannot starve during fast data
+taking. The backfill lane can be bounded in length (max_backfill_depth) and age (max_age_in_sec); shots beyond the
+bounds are shed, i.e. dropped without analysis, and reported by pop_shed_ids.
+"""
+import time
+from bisect import insort
+
+SHEDDING_POLICIES = ['oldest', 'newest']
+
+
+class AnalysisScheduler():
+
+    def __init__(self, backfill_interval=3, backfill_order='oldest_first', max_backfill_depth=None,
+                 shedding_policy='oldest', max_age_in_sec=None):
+        """
+        Args:
+            - backfill_interval: at least every backfill_interval-th pick comes from the backfill lane, if it is not
+                empty. None serves the backfill lane only when no newer shot is waiting.
+            - backfill_order: 'oldest_first' or 'newest_first' order of draining the backfill lane.
+            - max_backfill_depth: maximum number of shots in the backfill lane, None for no limit.
+            - shedding_policy: which shots to shed beyond max_backfill_depth, 'oldest' or 'newest' of the backfill lane.
+            - max_age_in_sec: shots waiting longer than this are shed, None for no limit.
+        """
+        if backfill_order not in ['oldest_first', 'newest_first']:
+            raise ValueError(str(backfill_order) + ' is not an allowed backfill order, i.e. oldest_first, newest_first')
+        if shedding_policy not in SHEDDING_POLICIES:
+            raise ValueError(str(shedding_policy) + ' is not an allowed shedding policy, i.e. ' + str(SHEDDING_POLICIES))
+        self.backfill_interval = backfill_interval
+        self.backfill_order = backfill_order
+        self.max_backfill_depth = max_backfill_depth
+        self.shedding_policy = shedding_policy
+        self.max_age_in_sec = max_age_in_sec
+        self.latest_id = None
+        self.backfill_ids = []  # sorted
+        self.arrival_times = {}  # run_id: time.time() the shot was added
+        self.picks_since_backfill = 0
+        self.shed_ids = []
+        self.served = {'latest': 0, 'backfill': 0}
+        self.n_shed = 0
+
+    def __len__(self):
+        return len(self.backfill_ids) + (self.latest_id is not None)
+
+    def add(self, run_ids):
+        """Adds new unanalyzed run_ids. The newest of all waiting shots takes the latest lane."""
+        now = time.time()
+        for run_id in run_ids:
+            if run_id in self.arrival_times:
+                continue
+            self.arrival_times[run_id] = now
+            if self.latest_id is None or run_id > self.latest_id:
+                if self.latest_id is not None:
+                    insort(self.backfill_ids, self.latest_id)
+                self.latest_id = run_id
+            else:
+                insort(self.backfill_ids, run_id)
+        self.shed()
+
+    def shed(self):
+        """Drops shots beyond max_age_in_sec and max_backfill_depth from the backfill lane."""
+        if self.max_age_in_sec is not None:
+            now = time.time()
+            expired_ids = [run_id for run_id in self.backfill_ids
+                           if now - self.arrival_times[run_id] > self.max_age_in_sec]
+            for run_id in expired_ids:
+                self._shed(run_id)
+        if self.max_backfill_depth is not None:
+            while len(self.backfill_ids) > self.max_backfill_depth:
+                self._shed(self.backfill_ids[0] if self.shedding_policy == 'oldest' else self.backfill_ids[-1])
+
+    def _shed(self, run_id):
+        self.backfill_ids.remove(run_id)
+        del self.arrival_times[run_id]
+        self.shed_ids.append(run_id)
+        self.n_shed += 1
+
+    def pop_shed_ids(self):
+        """Returns the run_ids shed since the last call."""
+        shed_ids, self.shed_ids = self.shed_ids, []
+        return shed_ids
+
+    def _pick_backfill(self):
+        if len(self.backfill_ids) == 0:
+            return False
+        if self.latest_id is None:
+            return True
+        return self.backfill_interval is not None and self.picks_since_backfill + 1 >= self.backfill_interval
+
+    def next_run_id(self):
+        """Returns the run_id to analyze next without removing it, or None if no shot is waiting."""
+        self.shed()
+        if self._pick_backfill():
+            return self.backfill_ids[0] if self.backfill_order == 'oldest_first' else self.backfill_ids[-1]
+        return self.latest_id
+
+    def remove(self, run_id):
+        """Removes run_id, e.g. once its analysis started."""
+        if run_id == self.latest_id:
+            self.latest_id = None
+            self.picks_since_backfill += 1
+            self.served['latest'] += 1
+        else:
+            self.backfill_ids.remove(run_id)
+            self.picks_since_backfill = 0
+            self.served['backfill'] += 1
+        del self.arrival_times[run_id]
+
+    def pop(self):
+        """Removes and returns the run_id to analyze next, or None if no shot is waiting."""
+        run_id = self.next_run_id()
+        if run_id is not None:
+            self.remove(run_id)
+        return run_id
+
+    def metrics(self):
+        """Returns a dict of the lane depths, the age in seconds of the latest and the oldest waiting shot (None if
+        there is none), and the numbers of shots served per lane and shed."""
+        now = time.time()
+        waiting_times = [now - arrival_time for arrival_time in self.arrival_times.values()]
+        return {'latest_depth': int(self.latest_id is not None),
+                'backfill_depth': len(self.backfill_ids),
+                'latest_age_in_sec': None if self.latest_id is None else now - self.arrival_times[self.latest_id],
+                'oldest_age_in_sec': max(waiting_times) if len(waiting_times) > 0 else None,
+                'served_latest': self.served['latest'],
+                'served_backfill': self.served['backfill'],
+                'shed': self.n_shed}
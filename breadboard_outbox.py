@@ -0,0 +1,285 @@
+"""A persistent outbox of breadboard writes, sent in the background by a pool of worker threads.
+
+Daemons queue their writes (analysis results, image names, measurement names, instrument readouts) with the same
+methods as the BreadboardClient, which only insert a row in a local sqlite database and return immediately, so a
+measurement loop never waits on breadboard. Writes are sent batch_delay seconds after they are queued: all pending
+writes of the same run are coalesced, i.e. every parameter update of the run (analysis results and readouts) is
+merged into a single GET + PUT of the run, as in log_editor.save_image_log. Failed writes stay in the database and are
+retried with exponential backoff, including after a restart of the process, so no result is lost while breadboard is
+unreachable. Errors are reported (see on_error) once per outage and for every write given up, not for every retry.
+One process should own a db_path at a time.
+"""
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+PARAMETERS, IMAGES, MEASUREMENT_NAME = 'parameters', 'images', 'measurement_name'
+# http status codes worth retrying, other 4xx errors will not go away by themselves
+RETRY_STATUS_CODES = [408, 429]
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL,
+    error TEXT,
+    finished REAL)"""
+
+
+class BreadboardWriteError(Exception):
+
+    def __init__(self, resp):
+        self.status_code = resp.status_code
+        Exception.__init__(self, 'status code {code}: {text}'.format(code=str(resp.status_code), text=resp.text))
+
+
+def coalesce_writes(rows):
+    """Merges (kind, payload) rows of one run, oldest first, into a dict of the parameter updates, the list of image
+    names and the latest measurement name (None if there is none)."""
+    writes = {PARAMETERS: {}, IMAGES: [], MEASUREMENT_NAME: None}
+    for kind, payload in rows:
+        if kind == PARAMETERS:
+            writes[PARAMETERS].update(payload)
+        elif kind == IMAGES:
+            writes[IMAGES] += [image_name for image_name in payload if image_name not in writes[IMAGES]]
+        else:
+            writes[MEASUREMENT_NAME] = payload
+    return writes
+
+
+class BreadboardOutbox():
+    """BreadboardOutbox queues breadboard writes durably and sends them without blocking the caller."""
+
+    def __init__(self, bc, db_path, num_workers=2, batch_delay=0.5, max_retries=None, backoff_time=2,
+                 max_backoff_time=60 * 5, on_error=None, autostart=True):
+        """
+        Args:
+            - bc: BreadboardClient, see utility_functions.load_breadboard_client. Its connections are shared by the
+                worker threads.
+            - db_path: sqlite file holding the outbox. Reusing it after a restart sends the writes left unsent.
+            - num_workers: number of sending threads, each sending the writes of one run at a time.
+            - batch_delay: seconds a write waits for more writes of the same run to coalesce with.
+            - max_retries: writes are marked failed after this many attempts. None retries until breadboard accepts
+                them; writes rejected with a client error (4xx) are marked failed right away.
+            - backoff_time, max_backoff_time: seconds to wait before the first retry, doubling up to max_backoff_time.
+            - on_error: optional function called with run_id and the error message, e.g. to warn on Slack, when
+                sending fails after the previous send succeeded (once per outage, not on every retry) and when a
+                write is given up.
+        """
+        self.bc = bc
+        self.db_path = db_path
+        self.num_workers = num_workers
+        self.batch_delay = batch_delay
+        self.max_retries = max_retries
+        self.backoff_time = backoff_time
+        self.max_backoff_time = max_backoff_time
+        self.on_error = on_error
+        self.logger = logging.getLogger(__name__)
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self.failing = False  # True from a failed send until the next successful one
+        self._failing_lock = threading.Lock()
+        self.workers = []
+        with self._connection() as conn:
+            conn.execute(_SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS writes_status ON writes (status, next_try)")
+            # writes interrupted by a crash or restart are sent again
+            conn.execute("UPDATE writes SET status = 'pending' WHERE status = 'in_progress'")
+        if autostart:
+            self.start()
+
+    def _connection(self):
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+        return self._local.conn
+
+    def start(self):
+        self._stop.clear()
+        for idx in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name='outbox-worker-{idx}'.format(idx=idx), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def enqueue(self, run_id, kind, payload):
+        """Queues a write of kind PARAMETERS (dict), IMAGES (list of image names) or MEASUREMENT_NAME (str) to run_id
+        and returns immediately."""
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT INTO writes (run_id, kind, payload, enqueued, status, next_try) VALUES (?, ?, ?, ?, 'pending', ?)",
+                         (int(run_id), kind, json.dumps(payload, default=float), now, now + self.batch_delay))
+        self._wakeup.set()
+
+    def append_analysis_to_run(self, run_id, analysis_dict):
+        self.enqueue(run_id, PARAMETERS, analysis_dict)
+
+    def add_instrument_readout_to_run(self, run_id, readout_dict):
+        self.enqueue(run_id, PARAMETERS, readout_dict)
+
+    def append_images_to_run(self, run_id, image_names):
+        self.enqueue(run_id, IMAGES, list(image_names))
+
+    def add_measurement_name_to_run(self, run_id, measurement_name):
+        self.enqueue(run_id, MEASUREMENT_NAME, measurement_name)
+
+    def status(self):
+        """Returns a dict with queue_depth (pending and in progress writes), failed writes, done writes and
+        lag_in_sec, the age of the oldest unsent write."""
+        conn = self._connection()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM writes GROUP BY status").fetchall())
+        oldest = conn.execute("SELECT MIN(enqueued) FROM writes WHERE status IN ('pending', 'in_progress')").fetchone()[0]
+        return {'queue_depth': counts.get('pending', 0) + counts.get('in_progress', 0),
+                'failed': counts.get('failed', 0),
+                'done': counts.get('done', 0),
+                'lag_in_sec': 0 if oldest is None else time.time() - oldest}
+
+    def flush(self, timeout=None):
+        """Waits until all writes queued so far are sent or failed. Returns True if the outbox is empty."""
+        start_time = time.time()
+        while self.status()['queue_depth'] > 0:
+            if timeout is not None and time.time() - start_time > timeout:
+                return False
+            self._wakeup.set()
+            time.sleep(0.05)
+        return True
+
+    def _claim(self):
+        """Claims all pending writes of the run with the oldest due write, skipping runs another worker is sending."""
+        conn = self._connection()
+        with self._claim_lock, conn:
+            row = conn.execute("""SELECT run_id FROM writes WHERE status = 'pending' AND next_try <= ? AND run_id NOT IN
+                               (SELECT run_id FROM writes WHERE status = 'in_progress') ORDER BY id LIMIT 1""",
+                               (time.time(),)).fetchone()
+            if row is None:
+                return None, []
+            run_id = row[0]
+            rows = conn.execute("SELECT id, kind, payload, attempts FROM writes WHERE status = 'pending' AND run_id = ? ORDER BY id",
+                                (run_id,)).fetchall()
+            conn.executemany("UPDATE writes SET status = 'in_progress' WHERE id = ?", [(row[0],) for row in rows])
+        return run_id, rows
+
+    def _time_to_next_try(self):
+        next_try = self._connection().execute(
+            "SELECT MIN(next_try) FROM writes WHERE status = 'pending'").fetchone()[0]
+        if next_try is None:
+            return None
+        return max(next_try - time.time(), 0)
+
+    def send(self, run_id, writes):
+        """Sends the coalesced writes of run_id (see coalesce_writes) to breadboard. Raises on failure."""
+        bc = self.bc
+        if len(writes[PARAMETERS]) > 0:
+            resp = bc._send_message('get', '/runs/' + str(run_id) + '/')
+            if resp.status_code != 200:
+                raise BreadboardWriteError(resp)
+            run_dict = resp.json()
+            run_dict['parameters'].update(writes[PARAMETERS])
+            resp = bc._send_message('put', '/runs/' + str(run_id) + '/', data=json.dumps(run_dict))
+            if resp.status_code != 200:
+                raise BreadboardWriteError(resp)
+        if len(writes[IMAGES]) > 0:
+            resp = bc.append_images_to_run(run_id, writes[IMAGES])
+            if resp.status_code != 200:
+                raise BreadboardWriteError(resp)
+        if writes[MEASUREMENT_NAME] is not None:
+            resp = bc.add_measurement_name_to_run(run_id, writes[MEASUREMENT_NAME])
+            if resp is not None and resp.status_code != 200:
+                raise BreadboardWriteError(resp)
+
+    def _work(self):
+        loop_errors = 0  # consecutive failures outside of send, e.g. of the outbox database
+        while not self._stop.is_set():
+            try:
+                if len(getattr(self._local, 'claimed', [])) > 0:
+                    self._release_claimed()
+                self._work_once()
+                loop_errors = 0
+            except Exception as e:
+                loop_errors += 1
+                wait_time = min(self.backoff_time * 2 ** (loop_errors - 1), self.max_backoff_time)
+                message = 'breadboard outbox worker failed ({error}), retrying in {sec:.0f} s'.format(error=repr(e),
+                                                                                                  sec=wait_time)
+                if self._report_failure(None, message):
+                    self.logger.error(message)
+                else:
+                    self.logger.debug(message)
+                self._stop.wait(wait_time)
+
+    def _release_claimed(self):
+        """Puts the writes claimed by this worker back to pending, after they could not be marked sent or failed."""
+        with self._connection() as conn:
+            conn.executemany("UPDATE writes SET status = 'pending' WHERE id = ? AND status = 'in_progress'",
+                             self._local.claimed)
+        self._local.claimed = []
+
+    def _work_once(self):
+        """Claims and sends the writes of one run, or waits until a write is due."""
+        run_id, rows = self._claim()
+        if run_id is None:
+            self._wakeup.clear()
+            self._wakeup.wait(self._time_to_next_try())
+            return
+        write_ids = [(row[0],) for row in rows]
+        self._local.claimed = write_ids
+        writes = coalesce_writes([(kind, json.loads(payload)) for _, kind, payload, _ in rows])
+        conn = self._connection()
+        try:
+            self.send(run_id, writes)
+            now = time.time()
+            with conn:
+                conn.executemany("UPDATE writes SET status = 'done', finished = ?, error = NULL WHERE id = ?",
+                                 [(now, write_id) for (write_id,) in write_ids])
+            self._local.claimed = []
+            self.logger.debug('sent {n} write(s) to breadboard run_id {id}'.format(n=str(len(rows)), id=str(run_id)))
+            with self._failing_lock:
+                outage_end, self.failing = self.failing, False
+            if outage_end:
+                self.logger.warning('breadboard writes succeed again')
+        except Exception as e:
+            attempts = max(row[3] for row in rows) + 1
+            status_code = getattr(e, 'status_code', None)
+            client_error = (status_code is not None and 400 <= status_code < 500
+                            and status_code not in RETRY_STATUS_CODES)
+            if client_error or (self.max_retries is not None and attempts >= self.max_retries):
+                status, next_try = 'failed', time.time()
+                message = 'giving up writing {writes} to breadboard run_id {id}: {error}'.format(
+                    writes=str(writes), id=str(run_id), error=str(e))
+                self.logger.error(message)
+            else:
+                status = 'pending'
+                next_try = time.time() + min(self.backoff_time * 2 ** (attempts - 1), self.max_backoff_time)
+                message = 'writing to breadboard run_id {id} failed ({error}), retry {n} in {sec:.0f} s'.format(
+                    id=str(run_id), error=str(e), n=str(attempts), sec=next_try - time.time())
+                self.logger.warning(message)
+            with conn:
+                conn.executemany("UPDATE writes SET status = ?, attempts = ?, next_try = ?, error = ? WHERE id = ?",
+                                 [(status, attempts, next_try, str(e), write_id) for (write_id,) in write_ids])
+            self._local.claimed = []
+            self._report_failure(run_id, message, give_up=status == 'failed')
+
+    def _report_failure(self, run_id, message, give_up=False):
+        """Marks the outbox failing and passes message to on_error at the start of an outage, i.e. if it was not
+        failing yet, and whenever a write is given up. Returns True at the start of an outage."""
+        with self._failing_lock:
+            outage_start, self.failing = not self.failing, True
+        if self.on_error is not None and (outage_start or give_up):
+            try:
+                self.on_error(run_id, message)
+            except:
+                self.logger.error(sys.exc_info()[1])
+        return outage_start
@@ -0,0 +1,155 @@
+"""Moves and copies of image files that keep the data out of python where the OS allows it.
+
+move_file renames a file in place (os.replace, or a hardlink when an existing destination must not be overwritten)
+if source and destination share a filesystem, so no data is read at all, and only copies across filesystems.
+copy_file first tries a reflink (a copy-on-write clone, on e.g. btrfs or xfs), then copy_file_range and sendfile,
+which copy inside the kernel (and for copy_file_range on network filesystems, often on the server itself), and
+only falls back to reading the file through a python buffer where none of these are available (e.g. on Windows).
+
+Both return a dict of transfer statistics (bytes, seconds, mb_per_sec, method), see format_stats.
+"""
+import os
+import time
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # linux/fs.h _IOW(0x94, 9, int)
+CHUNK_SIZE = 8 * 1024 * 1024
+# errors meaning a copy method is not supported for this pair of files, rather than that the copy failed
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                       getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+
+
+def transfer_stats(n_bytes, start_time, method):
+    """Returns the statistics dict of a transfer of n_bytes started at time.perf_counter() start_time."""
+    seconds = time.perf_counter() - start_time
+    return {'bytes': n_bytes, 'seconds': seconds, 'method': method,
+            'mb_per_sec': n_bytes / 1e6 / seconds if seconds > 0 else float('inf')}
+
+
+def format_stats(stats):
+    return '{mb:.1f} MB in {sec:.3f} s ({rate:.1f} MB/s, {method})'.format(
+        mb=stats['bytes'] / 1e6, sec=stats['seconds'], rate=stats['mb_per_sec'], method=stats['method'])
+
+
+def move_file(source, destination, overwrite=True):
+    """Moves source to destination. Within a filesystem this is an atomic rename, otherwise a copy_file followed by
+    removing the source.
+
+    Args:
+        - overwrite: if False, raises FileExistsError instead of replacing an existing destination. Within a
+            filesystem the file is then hardlinked to destination and unlinked from source, which is atomic too.
+    """
+    start_time = time.perf_counter()
+    n_bytes = os.path.getsize(source)
+    try:
+        if overwrite:
+            os.replace(source, destination)
+            return transfer_stats(n_bytes, start_time, 'rename')
+        os.link(source, destination)
+        os.remove(source)
+        return transfer_stats(n_bytes, start_time, 'hardlink')
+    except OSError as e:
+        # across filesystems, or (for hardlinks) on a filesystem without them, fall back to copying
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP] or (overwrite and e.errno != errno.EXDEV):
+            raise
+    if not overwrite and os.path.exists(destination):
+        raise FileExistsError(errno.EEXIST, 'File exists', destination)
+    stats = copy_file(source, destination)
+    os.remove(source)
+    stats['seconds'] = time.perf_counter() - start_time
+    stats['method'] = 'copy ({method}) and unlink'.format(method=stats['method'])
+    return stats
+
+
+def copy_file(source, destination, offset=0, fsync=True):
+    """Copies source to destination, each byte read at most once, resuming at byte offset of an existing
+    destination (e.g. a partial copy).
+
+    Returns:
+        dict of transfer statistics, see format_stats. bytes counts only the bytes copied in this call.
+
+    Raises:
+        IOError if the source changed size during the copy, e.g. was truncated, so destination would not be a
+        complete copy of it.
+    """
+    start_time = time.perf_counter()
+    with open(source, 'rb') as source_file, open(destination, 'r+b' if offset > 0 else 'wb') as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        method, end = None, None
+        if offset == 0 and _reflink(source_file, destination_file):
+            method, end = 'reflink', os.fstat(destination_file.fileno()).st_size
+        for kernel_copy in [_copy_file_range, _sendfile]:
+            if method is None:
+                end = _try_kernel_copy(kernel_copy, source_file, destination_file, offset, size)
+                if end is not None:
+                    method = kernel_copy.__name__.lstrip('_')
+        if method is None:
+            source_file.seek(offset)
+            destination_file.seek(offset)
+            shutil.copyfileobj(source_file, destination_file, CHUNK_SIZE)
+            method, end = 'userspace', destination_file.tell()
+        if end != size:
+            raise IOError('{source} changed size while copying, {end} of {size} bytes copied to {destination}'.format(
+                source=source, end=str(end), size=str(size), destination=destination))
+        destination_file.truncate(size)  # the tail of a longer previous copy at destination
+        destination_file.flush()
+        if fsync:
+            os.fsync(destination_file.fileno())
+    return transfer_stats(size - offset, start_time, method)
+
+
+def _reflink(source_file, destination_file):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _try_kernel_copy(kernel_copy, source_file, destination_file, offset, size):
+    """Runs kernel_copy, returning the position it copied up to, or None if the OS does not support it for this pair
+    of files."""
+    try:
+        return kernel_copy(source_file.fileno(), destination_file.fileno(), offset, size)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS:
+            return None
+        raise
+
+
+def _copy_file_range(source_fd, destination_fd, offset, size):
+    if not hasattr(os, 'copy_file_range'):
+        return None
+    position = offset
+    while position < size:
+        n_copied = os.copy_file_range(source_fd, destination_fd, min(size - position, CHUNK_SIZE),
+                                      position, position)
+        if n_copied == 0:
+            if position == offset:
+                return None  # e.g. pseudo files reporting a wrong size
+            break  # the source is shorter than size
+        position += n_copied
+    return position
+
+
+def _sendfile(source_fd, destination_fd, offset, size):
+    if not hasattr(os, 'sendfile'):
+        return None
+    os.lseek(destination_fd, offset, os.SEEK_SET)
+    position = offset
+    while position < size:
+        n_copied = os.sendfile(destination_fd, source_fd, position, min(size - position, CHUNK_SIZE))
+        if n_copied == 0:
+            if position == offset:
+                return None
+            break  # the source is shorter than size
+        position += n_copied
+    return position
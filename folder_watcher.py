@@ -0,0 +1,117 @@
+"""Notification backends for watching a folder for newly written files.
+
+InotifyFolderWatcher blocks on Linux inotify close-write/moved-to events, so new files are reported as soon
+as the camera closes them and the watcher uses no CPU while the experiment is idle. PollingFolderWatcher
+re-lists the folder every refresh_time seconds and is the fallback on platforms without inotify (e.g. the
+Windows camera PCs).
+"""
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class PollingFolderWatcher():
+    """Reports files that appeared in folder since the last call by listing it every refresh_time seconds."""
+
+    def __init__(self, folder, refresh_time=0.3):
+        self.folder = folder
+        self.refresh_time = refresh_time
+        self.known_filenames = set(os.listdir(folder))
+
+    def wait_for_files(self, timeout=None):
+        """Blocks until new files appear in the folder or timeout (in seconds) elapses.
+
+        Returns:
+            list of new filenames, in ascending name order. Empty if timeout elapsed.
+        """
+        start_time = time.monotonic()
+        while True:
+            filenames = set(os.listdir(self.folder))
+            new_filenames = sorted(filenames.difference(self.known_filenames))
+            # forget files that were moved out of the folder, so a file with a reused name is reported again
+            self.known_filenames = filenames
+            if len(new_filenames) > 0:
+                return new_filenames
+            if timeout is not None and time.monotonic() - start_time >= timeout:
+                return []
+            time.sleep(self.refresh_time)
+
+    def close(self):
+        pass
+
+
+class InotifyFolderWatcher():
+    """Reports files in folder as soon as they are closed after writing, or moved into the folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed for ' + folder)
+
+    def wait_for_files(self, timeout=None):
+        """Blocks until files are closed after writing in (or moved into) the folder, or timeout (in seconds) elapses.
+
+        Returns:
+            list of new filenames, in the order the events arrived. Empty if timeout elapsed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        buffer = os.read(self.fd, 64 * 1024)
+        new_filenames = []
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, name_len = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped by the kernel, fall back to listing the folder once
+                return sorted(os.listdir(self.folder))
+            if mask & IN_IGNORED or len(name) == 0:
+                continue
+            filename = os.fsdecode(name)
+            if filename not in new_filenames:
+                new_filenames.append(filename)
+        return new_filenames
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_folder_watcher(folder, backend='auto', refresh_time=0.3):
+    """Returns a folder watcher with a wait_for_files(timeout) method.
+
+    Args:
+        folder: path string of the folder to watch.
+        backend: 'inotify', 'polling', or 'auto' to use inotify where available and polling otherwise.
+        refresh_time: seconds between folder listings for the polling backend.
+    """
+    if backend not in ['auto', 'inotify', 'polling']:
+        raise ValueError(str(backend) + ' is not an allowed notification backend, i.e. auto, inotify, polling')
+    if backend == 'inotify' or (backend == 'auto' and sys.platform.startswith('linux')):
+        try:
+            return InotifyFolderWatcher(folder)
+        except (OSError, AttributeError):
+            if backend == 'inotify':
+                raise
+    return PollingFolderWatcher(folder, refresh_time=refresh_time)
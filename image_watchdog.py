@@ -7,10 +7,19 @@ from utility_functions import load_breadboard_client, load_bec1serverpath
 import utility_functions
 bc = load_breadboard_client()
 import warnings
-from measurement_directory import measurement_directory, todays_measurements
+from measurement_directory import measurement_directory, todays_measurements, measurement_name_from_runfolder
 import enrico_bot
 import logging
 from pathlib import Path
+from file_transfer import move_file, format_stats
+from folder_watcher import make_folder_watcher
+from replication_queue import ReplicationQueue
+from breadboard_outbox import BreadboardOutbox
+from run_cache import RunCache
+from run_matching import assign_shots_to_runs, OffsetEstimator, ArrivalClock, image_times
+from spe_file import read_spe_header
+from write_completion import WriteCompletionWaiter
+from watchdog_journal import WatchdogJournal, ARRIVED, MATCHED, MISPLACED, MOVED, COPY_QUEUED, DONE
 
 
 class ImageWatchdog():
@@ -20,13 +29,32 @@ class ImageWatchdog():
 
     def __init__(self, watchfolder=os.path.join(os.path.dirname(__file__), 'images'),
                  num_images_per_shot=1, refresh_time=0.3, backup_to_bec1server=True, MONTH_DIR_FMT='%Y%m',
-                 max_time_diff_in_sec=10, min_time_diff_in_sec=0, max_idle_time=60 * 3, runfolder=None):
+                 max_time_diff_in_sec=10, min_time_diff_in_sec=0, max_idle_time=60 * 3, runfolder=None,
+                 notification_backend='auto', idle_check_time=5, journal_path=None,
+                 run_cache=None, replication_queue=None, filename_format='{run_id}_{image_idx}.spe', camera_name=None,
+                 outbox=None):
+        """
+        Optional args:
+            run_cache, replication_queue ~ shared RunCache and ReplicationQueue, e.g. from multi_camera_watchdog.py.
+                By default the watchdog creates its own.
+            filename_format ~ name of matched images, formatted with run_id and image_idx
+            camera_name ~ distinguishes the debugging logs of several watchdogs in one process
+            outbox ~ shared BreadboardOutbox sending the image and measurement names to breadboard. By default the
+                watchdog creates its own, next to the journal.
+        """
         self.MONTH_DIR_FMT = MONTH_DIR_FMT
+        self.camera_name = camera_name
         self.init_logger()
         self.watchfolder = watchfolder
         print("\n\nWatching this folder for changes: " + self.watchfolder)
-        # clears watchfolder by moving unmatched images to a temporary storage folder
-        self.clear_watchfolder()
+        # crash-safe record of the state of every image, see watchdog_journal.py
+        if journal_path is None:
+            journal_path = os.path.normpath(self.watchfolder) + '_journal.jsonl'
+        self.journal = WatchdogJournal(journal_path)
+        recovered_states = self.journal.replay()
+        # clears watchfolder by moving unmatched images to a temporary storage folder, except for images
+        # whose handling was interrupted by a crash or restart
+        self.clear_watchfolder(keep_filenames=[state['file'] for state in recovered_states])
         if runfolder is None:
             self.set_runfolder()
         else:
@@ -37,17 +65,47 @@ class ImageWatchdog():
         self.backup_to_bec1server = backup_to_bec1server
         if self.backup_to_bec1server:
             self.set_bec1serverpath()
+            # copies to the server run in background threads, see replication_queue.py
+            if replication_queue is None:
+                replication_queue = ReplicationQueue()
+            self.replication_queue = replication_queue
         self.incomingfile_time = datetime.datetime.now()
         self.newest_run_dict = {'run_id': 0}
+        # background-refreshed window of the newest breadboard runs, see run_cache.py
+        if run_cache is None:
+            run_cache = RunCache(bc)
+        self.run_cache = run_cache
+        # breadboard writes are queued on disk and sent in the background, see breadboard_outbox.py
+        if outbox is None:
+            outbox = BreadboardOutbox(bc, os.path.normpath(self.watchfolder) + '_outbox.sqlite')
+        self.outbox = outbox
+        self.filename_format = filename_format
         self.max_time_diff_in_sec = max_time_diff_in_sec
         self.min_time_diff_in_sec = min_time_diff_in_sec
+        # the window above is calibrated for the arrival (ctime) of the images, and camera times are moved onto
+        # that clock by the latency from exposure to arrival, see run_matching.ArrivalClock
+        self.arrival_clock = ArrivalClock()
+        # learns the runtime to image delay from confirmed matches and tightens the window above
+        self.offset_estimator = OffsetEstimator(min_time_diff_in_sec=min_time_diff_in_sec,
+                                                max_time_diff_in_sec=max_time_diff_in_sec)
         self.idle_message_sent = False
         self.max_idle_time = max_idle_time
-        self.run_id_offset = 0
+        # inotify on Linux, polling every refresh_time otherwise. See folder_watcher.py
+        self.folder_watcher = make_folder_watcher(self.watchfolder, backend=notification_backend,
+                                                  refresh_time=refresh_time)
+        self.idle_check_time = idle_check_time
+        # reports images complete from their .spe header and close-write events, see write_completion.py
+        self.write_completion = WriteCompletionWaiter(self.watchfolder, backend=notification_backend,
+                                                      poll_interval=min(refresh_time, 0.05))
+        self.pending_filenames = []
+        self.recover_from_journal(recovered_states)
 
     def init_logger(self):
         '''A debugging log is created in the MM/YYMMDD with info to manually associate files that failed to match.'''
-        self.logger = logging.getLogger(__name__)
+        if self.camera_name is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logging.getLogger(__name__ + '.' + self.camera_name)
         logger = self.logger
         logger.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s:%(name)s:%(message)s')
@@ -66,8 +124,9 @@ class ImageWatchdog():
         paths = [os.path.join(folder, f) for f in filenames]
         return (filenames, paths)
 
-    def clear_watchfolder(self):
+    def clear_watchfolder(self, keep_filenames=[]):
         filenames, _ = self.getFileList()
+        filenames = [filename for filename in filenames if filename not in keep_filenames]
         if len(filenames) > 0:
             self.logger.debug(str(filenames) +
                               ' found. Clearing ' + self.watchfolder)
@@ -77,10 +136,61 @@ class ImageWatchdog():
             time_now = datetime.datetime.strftime(today, '%H%M%S')
             misplaced_filepath = os.path.join(os.path.join(
                 month, date), 'misplacedimages' + time_now)
-            shutil.move(self.watchfolder, misplaced_filepath)
+            if len(keep_filenames) == 0:
+                shutil.move(self.watchfolder, misplaced_filepath)
+                os.mkdir(self.watchfolder)
+            else:
+                os.mkdir(misplaced_filepath)
+                for filename in filenames:
+                    shutil.move(os.path.join(self.watchfolder, filename), misplaced_filepath)
             self.logger.debug('moved misplaced file(s) to {path}'.format(
                 path=misplaced_filepath))
-            os.mkdir(self.watchfolder)
+
+    def recover_from_journal(self, states):
+        """Completes the handling of images interrupted by a crash or restart. Unmatched images are matched
+        again with the next shots; matched images are moved, backed up and written to breadboard.
+
+        Args:
+            states: list of image states from WatchdogJournal.replay
+        """
+        uploads = {}  # (run_id, runfolder): [(watchfolder filename, new filename)]
+        for state in states:
+            filename, status = state['file'], state['status']
+            filepath = os.path.join(self.watchfolder, filename)
+            try:
+                if status == ARRIVED:
+                    if os.path.exists(filepath):
+                        self.pending_filenames.append(filename)
+                    else:
+                        self.journal.record(filename, DONE)
+                    continue
+                new_filepath = state['new_filepath']
+                if status in [MATCHED, MISPLACED]:
+                    if os.path.exists(filepath):
+                        self.move_image(filename, new_filepath, status == MATCHED)
+                    elif os.path.exists(new_filepath):  # moved, but the journal entry was lost
+                        self.journal.record(filename, MOVED if status == MATCHED else DONE)
+                    else:
+                        self.logger.error('{file} from journal not found, skipping recovery.'.format(file=filename))
+                        self.journal.record(filename, DONE)
+                        continue
+                    if status == MISPLACED:
+                        continue
+                elif status == MOVED:
+                    self.queue_backup(filename, new_filepath)
+                uploads.setdefault((state['run_id'], state['runfolder']), []).append(
+                    (filename, os.path.basename(new_filepath)))
+            except:
+                self.logger.error('Recovering {file} failed: {error}'.format(file=filename, error=sys.exc_info()[1]))
+        for (run_id, runfolder), filenames in uploads.items():
+            if self.write_images_to_breadboard(run_id, [new_filename for _, new_filename in filenames], runfolder):
+                for filename, _ in filenames:
+                    self.journal.record(filename, DONE)
+        if len(states) > 0:
+            message = 'Recovered {n} image(s) from {path}.'.format(n=str(len(states)), path=self.journal.path)
+            print(message)
+            self.logger.debug(message)
+        self.journal.compact()
 
     def set_runfolder(self):
         print('existing runs: ')
@@ -105,50 +215,89 @@ class ImageWatchdog():
                 os.mkdir(path)
 
     def monitor_watchfolder(self):
-        filenames, paths = self.getFileList()
-        if len(filenames) > 0:
-            self.incomingfile_time = datetime.datetime.fromtimestamp(
-                Path(paths[0]).stat().st_ctime)
-            while len(filenames) < self.num_images_per_shot:
-                time.sleep(0.1)
-                filenames, _ = self.getFileList()
-        if len(filenames) >= self.num_images_per_shot:
-            self.new_imagenames = filenames[0:self.num_images_per_shot]
-            new_images_bool = True
-            # self.incomingfile_time = datetime.datetime.today()
+        """Waits up to idle_check_time for new files and returns True once num_images_per_shot files are pending."""
+        if len(self.pending_filenames) >= self.num_images_per_shot:
+            timeout = 0  # a complete shot is already waiting
         else:
-            new_images_bool = False
-        return new_images_bool
+            timeout = self.idle_check_time
+        new_filenames = self.folder_watcher.wait_for_files(timeout=timeout)
+        for filename in new_filenames:
+            if filename not in self.pending_filenames:
+                self.pending_filenames.append(filename)
+                self.journal.record(filename, ARRIVED)
+        # drop files which were renamed or removed since they were reported
+        self.pending_filenames = [filename for filename in self.pending_filenames
+                                  if os.path.exists(os.path.join(self.watchfolder, filename))]
+        return len(self.pending_filenames) >= self.num_images_per_shot
 
-    def update_run_dict(self, MAX_RETRIES=10):
-        """
-        Optional args:
-            run_id_offset ~ see utility_functions.py. Pass in -1 since for short sequences, 
-            the newest run_id may be +1 ahead of the image(s) waiting to be matched.
+    def pop_pending_shots(self):
+        """Removes all complete shots from self.pending_filenames. Pending images are grouped into shots in
+        the order of their camera timestamps and frame tracking numbers, see image_time_and_number. If any pending
+        image has no camera timestamp, all of them are grouped in the order of their ctime instead, so that the
+        images are never ordered by two clocks at once.
+
+        Returns:
+            list of (filenames, incomingfile_time) tuples, oldest shot first. incomingfile_time is the time of
+            the first image of the shot on the arrival clock, see run_matching.image_times.
         """
-        try_counter = 0
-        success = False
-        while try_counter < MAX_RETRIES:
-            try_counter += 1
-            if success:
-                break
+        image_keys = {filename: self.image_time_and_number(filename) for filename in self.pending_filenames}
+        camera_times = [image_keys[filename][0] for filename in self.pending_filenames]
+        arrival_times = [image_keys[filename][2] for filename in self.pending_filenames]
+        if None in camera_times and len(set(camera_times)) > 1:
+            self.logger.warning('Some pending images have no camera timestamp, ordering all of them by ctime.')
+        times = dict(zip(self.pending_filenames, image_times(camera_times, arrival_times, self.arrival_clock)))
+        # frame tracking numbers break ties of camera times, and are -1 for ctimes
+        self.pending_filenames = sorted(self.pending_filenames,
+                                        key=lambda filename: (times[filename], image_keys[filename][1]))
+        shots = []
+        n_images = self.num_images_per_shot
+        while len(self.pending_filenames) >= n_images:
+            filenames = self.pending_filenames[0:n_images]
+            self.pending_filenames = self.pending_filenames[n_images:]
+            shots.append((sorted(filenames, reverse=True), times[filenames[0]]))
+        return shots
+
+    def image_time_and_number(self, filename):
+        """Returns (camera time, frame tracking number, ctime) of a watchfolder image. The camera time is the
+        timestamp of its first exposure from the .spe header and footer (see spe_file.py) and the number is the
+        camera frame counter. The header is only read once the file is completely written, as LightField writes
+        the footer last. Files without a camera timestamp, or still incomplete after idle_check_time, return
+        (None, -1, ctime)."""
+        filepath = os.path.join(self.watchfolder, filename)
+        if not self.write_completion.wait_until_complete(filepath, timeout=self.idle_check_time):
+            self.logger.warning('{file} did not finish writing within {sec} s, ordering it by ctime.'.format(
+                file=filename, sec=str(self.idle_check_time)))
+        ctime = datetime.datetime.fromtimestamp(Path(filepath).stat().st_ctime)
+        try:
+            header = read_spe_header(filepath)
+            if header['frame_timestamps'] is not None:
+                image_time = header['frame_timestamps'][0]
             else:
-                try:
-                    if try_counter > 1:
-                        print('Retrying to get newest breadboard entry. Tries: {n}'.format(
-                            n=str(try_counter)))
-                    new_run_dict = utility_functions.get_newest_run_dict(bc, run_id_offset=self.run_id_offset)
-                    new_id = new_run_dict['run_id']
-                    if self.newest_run_dict['run_id'] != new_id:
-                        print('new id: {id}'.format(id=str(new_id)))
-                        print('list bound variables: {run_dict}'.format(run_dict={key: new_run_dict[key]
-                                                                                  for key in new_run_dict['ListBoundVariables']}))
-                        self.logger.debug(
-                            'new run_id: ' + str(new_run_dict['run_id']) + '. runtime: ' + str(new_run_dict['runtime']))
-                        self.newest_run_dict = new_run_dict
-                    success = True
-                except:
-                    self.logger.error(sys.exc_info()[1])
+                image_time = header['acquisition_time']
+            if image_time is not None:
+                frame_numbers = header['frame_tracking_numbers']
+                return image_time, -1 if frame_numbers is None else frame_numbers[0], ctime
+        except Exception:
+            pass
+        return None, -1, ctime
+
+    def update_run_dict(self):
+        """Sets self.newest_run_dict to the newest run in the run cache."""
+        try:
+            new_run_dict = self.run_cache.newest_run_dict()
+            self.set_newest_run_dict(new_run_dict)
+        except:
+            self.logger.error(sys.exc_info()[1])
+
+    def set_newest_run_dict(self, new_run_dict):
+        new_id = new_run_dict['run_id']
+        if self.newest_run_dict['run_id'] != new_id:
+            print('new id: {id}'.format(id=str(new_id)))
+            print('list bound variables: {run_dict}'.format(run_dict={key: new_run_dict[key]
+                                                                      for key in new_run_dict['ListBoundVariables']}))
+            self.logger.debug(
+                'new run_id: ' + str(new_run_dict['run_id']) + '. runtime: ' + str(new_run_dict['runtime']))
+            self.newest_run_dict = new_run_dict
 
     def move_images(self, safety_check_passed):
         """Renames images according to run_id or timestamp (if safety_check passes or fails) and moves
@@ -173,15 +322,13 @@ class ImageWatchdog():
         for filename in self.new_imagenames:
             # prevent python from corrupting file, wait for writing to disk to finish
             filepath = os.path.join(self.watchfolder, filename)
-            old_filesize = 0
-            while os.path.getsize(filepath) != old_filesize:
-                old_filesize = os.path.getsize(filepath)
-                time.sleep(0.2)
+            if not self.write_completion.wait_until_complete(filepath, timeout=self.idle_check_time):
+                self.logger.warning('{file} did not finish writing within {sec} s, moving it anyway.'.format(
+                    file=filename, sec=str(self.idle_check_time)))
             # rename images according to their associated run_id
             old_filename = filename
             if safety_check_passed:
-                new_filename = str(run_id) + '_' + \
-                    str(image_idx) + '.spe'
+                new_filename = self.filename_format.format(run_id=run_id, image_idx=image_idx)
                 destination = self.runfolder
             else:
                 new_filename = old_filename
@@ -192,55 +339,106 @@ class ImageWatchdog():
                 new_filename = rename_file(new_filename)
                 new_filepath = os.path.join(
                     destination, new_filename)
-            if safety_check_passed and self.backup_to_bec1server:
-                becserver_filepath = os.path.join(
-                    self.bec1serverpath, new_filepath)
-                shutil.copyfile(filepath, becserver_filepath)
-                print('copying file to ' + becserver_filepath)
-            if not os.path.exists(os.path.dirname(new_filepath)):
-                os.mkdir(os.path.dirname(new_filepath))
-            shutil.move(filepath, os.path.abspath(new_filepath))
-            self.logger.debug('moving {old_name} to {destination}'.format(old_name=old_filename,
-                                                                          destination=new_filepath))
+            if safety_check_passed:
+                self.journal.record(filename, MATCHED, new_filepath=new_filepath, run_id=run_id,
+                                    runfolder=self.runfolder)
+            else:
+                self.journal.record(filename, MISPLACED, new_filepath=new_filepath)
+            self.move_image(filename, new_filepath, safety_check_passed)
             image_idx += 1
             output_filenames.append(new_filename)
         return output_filenames
 
+    def move_image(self, filename, new_filepath, safety_check_passed):
+        """Moves watchfolder image filename to new_filepath and queues its backup if it was matched."""
+        filepath = os.path.join(self.watchfolder, filename)
+        if not os.path.exists(os.path.dirname(new_filepath)):
+            os.mkdir(os.path.dirname(new_filepath))
+        stats = move_file(filepath, os.path.abspath(new_filepath))
+        self.logger.debug('moving {old_name} to {destination}: {stats}'.format(old_name=filename,
+                                                                               destination=new_filepath,
+                                                                               stats=format_stats(stats)))
+        if safety_check_passed:
+            self.journal.record(filename, MOVED)
+            self.queue_backup(filename, new_filepath)
+        else:
+            self.journal.record(filename, DONE)
+
+    def queue_backup(self, filename, new_filepath):
+        if self.backup_to_bec1server:
+            becserver_filepath = os.path.join(
+                self.bec1serverpath, new_filepath)
+            self.replication_queue.enqueue(new_filepath, becserver_filepath)
+            print('queued copy to ' + becserver_filepath)
+        self.journal.record(filename, COPY_QUEUED)
+
     def match_images_to_run_id(self, MAX_RETRIES=5):
-        def check_run_image_concurrent(self):
-            max_time_diff_in_sec = self.max_time_diff_in_sec
-            min_time_diff_in_sec = self.min_time_diff_in_sec
-            runtime_str = self.newest_run_dict['runtime']
-            incomingfile_time = self.incomingfile_time
-            runtime = datetime.datetime.strptime(
-                runtime_str, "%Y-%m-%dT%H:%M:%SZ")
-            time_diff = (incomingfile_time - runtime)
-            self.logger.debug("time diff in seconds: {time_diff}".format(
-                time_diff=str(time_diff.total_seconds())))
-            if min_time_diff_in_sec < time_diff.total_seconds() < max_time_diff_in_sec:
+        """Matches every complete shot waiting in the watchfolder to a cached breadboard run in one pass (see
+        run_matching.py), then moves the images and writes their names to breadboard.
+
+        Returns:
+            list of bools, True for each shot matched to a run_id and False for each misplaced shot.
+        """
+        def unmatched_shots_covered(shots, assignment, runs):
+            # once the cache holds a run started after an unmatched shot, refreshing cannot produce a match
+            return all((incomingfile_time - runs[0][0]).total_seconds() <= min_time_diff_in_sec
+                       for (_, incomingfile_time), run_idx in zip(shots, assignment) if run_idx is None)
+
+        def shots_ahead_of_cache(shots, runs):
+            # the offset estimator predicts the newest shot belongs to a run newer than any cached run
+            if len(runs) == 0:
                 return True
-            elif time_diff.total_seconds() < min_time_diff_in_sec:
-                #time_diff.total_seconds() < min_time_diff_in_sec typically only for short sequences, where the image
-                #being matched is one id *behind* the newest run_id on breadboard. 
-                self.run_id_offset += -1
-                self.update_run_dict()
-                return False
-            elif time_diff.total_seconds() > min_time_diff_in_sec:
-                self.run_id_offset = 0
-                self.update_run_dict()
-                return False
+            predicted_run_id = self.offset_estimator.predict_run_id(shots[-1][1], runs[0][0], runs[0][1]['run_id'])
+            return predicted_run_id is not None and predicted_run_id > runs[0][1]['run_id']
 
+        shots = self.pop_pending_shots()
+        min_time_diff_in_sec, max_time_diff_in_sec = self.offset_estimator.window()
+        if shots_ahead_of_cache(shots, self.run_cache.runs()):
+            self.run_cache.refresh()
         try_counter = 0
-        safety_check_passed = False
-        while try_counter < MAX_RETRIES and (not safety_check_passed):
+        while True:
+            try_counter += 1
+            runs = self.run_cache.runs()  # newest first
+            assignment = assign_shots_to_runs([incomingfile_time for _, incomingfile_time in shots],
+                                              [runtime for runtime, _ in runs],
+                                              min_time_diff_in_sec=min_time_diff_in_sec,
+                                              max_time_diff_in_sec=max_time_diff_in_sec,
+                                              expected_time_diff_in_sec=self.offset_estimator.time_diff_in_sec())
+            if None not in assignment or try_counter >= MAX_RETRIES or \
+                    (len(runs) > 0 and unmatched_shots_covered(shots, assignment, runs)):
+                break
             try:
-                safety_check_passed = check_run_image_concurrent(self)
-                try_counter += 1
-                time.sleep(1)
+                if try_counter == 1:
+                    self.run_cache.refresh()  # runs may be newer than the last background refresh
+                else:
+                    self.run_cache.wait_for_update(timeout=self.run_cache.refresh_time)
             except:
-                pass
+                self.logger.error(sys.exc_info()[1])
+        if len(shots) > 1:
+            print('matching {n} pending shots at once'.format(n=str(len(shots))))
+        matched_to_run_ids = []
+        for (filenames, incomingfile_time), run_idx in zip(shots, assignment):
+            self.new_imagenames = filenames
+            self.incomingfile_time = incomingfile_time
+            if run_idx is not None:
+                run_dict = runs[run_idx][1]
+                time_diff = incomingfile_time - runs[run_idx][0]
+                self.logger.debug("time diff in seconds: {time_diff}".format(
+                    time_diff=str(time_diff.total_seconds())))
+                self.set_newest_run_dict(run_dict)
+                self.offset_estimator.update(incomingfile_time, runs[run_idx][0], run_dict['run_id'])
+            else:
+                self.offset_estimator.report_miss()
+            matched_to_run_ids.append(self.file_images(run_idx is not None))
+        if self.backup_to_bec1server:
+            self.report_replication_status()
+        return matched_to_run_ids
+
+    def file_images(self, safety_check_passed):
+        """Moves self.new_imagenames and, if safety_check_passed, writes them to breadboard run self.newest_run_dict."""
         output_filenames = self.move_images(safety_check_passed)
         if not safety_check_passed:
+            self.update_run_dict()
             warning_message = 'Incoming image time and latest Breadboard runtime differ by too much. Check run_id {id} manually later.'.format(
                 id=str(self.newest_run_dict['run_id']))
             warning = warnings.warn(warning_message)
@@ -249,24 +447,36 @@ class ImageWatchdog():
         else:
             # write to breadboard
             run_id = self.newest_run_dict['run_id']
-            try:
-                resp = bc.append_images_to_run(run_id, output_filenames)
-                bc.add_measurement_name_to_run(run_id, self.runfolder)
-                if resp.status_code != 200:
-                    self.logger.warning('Upload error: ' + resp.text)
-                else:
-                    self.logger.debug('Uploaded filenames {files} to breadboard run_id {id}.'.format(
-                        files=str(output_filenames), id=str(run_id)))
-            except Exception as e:
-                print(e)
-                warning = 'Failed to write {files} to breadboard run_id {id}.'.format(
-                    files=str(output_filenames), id=str(run_id))
-                warnings.warn(warning)
-                self.logger.warning(warning)
+            if self.write_images_to_breadboard(run_id, output_filenames, self.runfolder):
+                for filename in self.new_imagenames:
+                    self.journal.record(filename, DONE)
             matched_to_run_id = True
-        self.run_id_offset = min(self.run_id_offset, 0)
         return matched_to_run_id
 
+    def write_images_to_breadboard(self, run_id, output_filenames, runfolder):
+        """Queues image filenames and the measurement name for breadboard run_id in the outbox, which retries them
+        until they are written. Returns True on success."""
+        try:
+            self.outbox.append_images_to_run(run_id, output_filenames)
+            self.outbox.add_measurement_name_to_run(run_id, measurement_name_from_runfolder(runfolder))
+            self.logger.debug('Queued filenames {files} for breadboard run_id {id}.'.format(
+                files=str(output_filenames), id=str(run_id)))
+            return True
+        except Exception as e:
+            print(e)
+            warning = 'Failed to write {files} to breadboard run_id {id}.'.format(
+                files=str(output_filenames), id=str(run_id))
+            warnings.warn(warning)
+            self.logger.warning(warning)
+            return False
+
+    def report_replication_status(self):
+        status = self.replication_queue.status()
+        message = 'bec1server copies queued: {depth}, lag: {lag:.1f} s, failed: {failed}'.format(
+            depth=status['queue_depth'], lag=status['lag_in_sec'], failed=status['failed'])
+        print(message)
+        self.logger.debug(message)
+
     def check_idle_time(self):
         idle_time = (datetime.datetime.now() -
                      self.incomingfile_time).total_seconds()
@@ -285,10 +495,8 @@ class ImageWatchdog():
                 self.check_idle_time()  # fire Slack message if experiment is idling
                 new_images_bool = self.monitor_watchfolder()
                 if new_images_bool:
-                    self.update_run_dict()  # fetch newest run info from breadboard
                     self.match_images_to_run_id()  # this method contains all the safety checks and logic
-                    # for matching run_id to images and writing image and run names to breadboard.
-                time.sleep(self.refresh_time)
+                    # for matching run_ids to all pending images and writing image and run names to breadboard.
             except KeyboardInterrupt:
                 break
             except:
@@ -308,3 +516,8 @@ if __name__ == "__main__":
         watchdog = ImageWatchdog(
             num_images_per_shot=n_images)
         watchdog.main()
+    elif len(sys.argv) == 3:  # e.g. from image_watchdog_autorestart.py
+        measurement_name, n_images = sys.argv[1], int(sys.argv[2])
+        watchdog = ImageWatchdog(num_images_per_shot=n_images,
+                                 runfolder=measurement_directory(measurement_name=measurement_name))
+        watchdog.main()
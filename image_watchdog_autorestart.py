@@ -21,18 +21,12 @@ measurement_name = 'run{idx}_{name}'.format(idx=run_idx, name=name)
 n_images_per_run = input(
     'How many images arrive per shot? e.g. 3 for triple imaging ')
 
-i = 0
+# the watchdog journal lets a restarted watchdog finish the images a crash interrupted, so it resumes the same run
 while True:
-    if i == 0:
-        print('python image_watchdog.py {name} {n_images}'.format(name=measurement_name,
-                                                                  n_images=n_images_per_run))
-        p1 = subprocess.run('python image_watchdog.py {name} {n_images}'.format(name=measurement_name,
-                                                                                n_images=n_images_per_run),
-                            shell=True)
-        enrico_bot.post_message('image_watchdog.py restarted automatically.')
-        print('\n restarting')
-        i += 1
-    else:
-        p1 = subprocess.run('python image_watchdog.py {name} {n_images}'.format(name=measurement_name + '_aftercrash',
-                                                                                n_images=n_images_per_run),
-                            shell=True)
+    print('python image_watchdog.py {name} {n_images}'.format(name=measurement_name,
+                                                              n_images=n_images_per_run))
+    p1 = subprocess.run('python image_watchdog.py {name} {n_images}'.format(name=measurement_name,
+                                                                            n_images=n_images_per_run),
+                        shell=True)
+    enrico_bot.post_message('image_watchdog.py restarted automatically.')
+    print('\n restarting')
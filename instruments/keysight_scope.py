@@ -421,11 +421,12 @@ def example_lockdiscriminator(scope_trace, low_level):
         return True
 
 class LockDetector(StatusMonitor):
-    """A LockDetector continuously monitors a scope and uploads to the newest breadboard run_id when available.
+    """A LockDetector continuously monitors a scope and uploads to every new breadboard run_id when available
+    (catch_up, see StatusMonitor.catch_up_to_breadboard).
     lock_channels is a dict of {channel_idx:{'name':MEANINGFULNAME,'lock_discriminator':LOCKDISCRIMINATOR_FUNCTION}}
     or simply {chl_idx:{'name':MEANINGFULNAME}} as the lock_discriminator option is optional. See example_lockdiscriminator above."""
-    def __init__(self, visa_address, lock_channels = None, refresh_time = 5, **kwargs):
-        StatusMonitor.__init__(self, **kwargs)
+    def __init__(self, visa_address, lock_channels = None, refresh_time = 5, catch_up=True, **kwargs):
+        StatusMonitor.__init__(self, catch_up=catch_up, **kwargs)
         self.scope = Oscilloscope(visa_address)
         if lock_channels is None:
             done, self.lock_channels = None, {}
@@ -1,11 +1,13 @@
-from collections import OrderedDict
 import datetime
 import os
 import sys
+import traceback
 import pandas as pd
 main_path = os.path.abspath(os.path.join(__file__, '../..'))
 sys.path.insert(0, main_path)
-from utility_functions import load_breadboard_client, get_newest_run_dict, time_diff_in_sec
+from utility_functions import load_breadboard_client, get_newest_run_dict, get_newest_runs, page_back_runs
+from breadboard_outbox import BreadboardOutbox
+from time_alignment import ColumnarReadingBuffer, to_timestamps
 import enrico_bot
 import numpy as np
 # TODO: logging errors
@@ -18,19 +20,55 @@ for warning_id in warning_id_list:
 
 class StatusMonitor:
     def __init__(self, backlog_max=30, warning_interval_in_min=10, read_run_time_offset=3, max_time_diff_tolerance=15, local_log_filename = "DEFAULT.csv",
-                 load_bc = True):
+                 load_bc = True, alignment_direction='backward', catch_up=False, max_catch_up_runs=50,
+                 max_catch_up_pages=20):
+        """
+        Args:
+            - read_run_time_offset: seconds a reading should precede the runtime of the run it belongs to.
+            - max_time_diff_tolerance: seconds a reading may be off read_run_time_offset and still be uploaded.
+            - alignment_direction: 'backward' uploads the newest reading taken read_run_time_offset before the run
+                or earlier, 'nearest' the reading closest to that time. See time_alignment.py
+            - catch_up: if True, upload_to_breadboard uploads a readout to every run since the last uploaded one,
+                not only to the newest run, see catch_up_to_breadboard.
+            - max_catch_up_runs: number of runs fetched per request to catch up with.
+            - max_catch_up_pages: number of requests catch_up_to_breadboard pages back through at most to reach the
+                last uploaded run_id. Older runs are skipped with a warning.
+        """
         if load_bc:
             self.bc = load_breadboard_client()
         else:
             self.bc = None
         self.backlog_max = backlog_max
-        self.backlog = OrderedDict()
+        self.backlog = ColumnarReadingBuffer(capacity=backlog_max)
         self.last_warning = None
         self.warning_interval_in_min = warning_interval_in_min
         self.read_run_time_offset = read_run_time_offset
         self.local_log_filename = local_log_filename
         # seconds, to avoid off-by-one run_id uploads to breadboard
         self.max_time_diff_tolerance = max_time_diff_tolerance
+        self.alignment_direction = alignment_direction
+        self.alignment_lag = read_run_time_offset
+        self.outbox = None  # created on the first upload, see load_outbox
+        self.catch_up = catch_up
+        self.max_catch_up_runs = max_catch_up_runs
+        self.max_catch_up_pages = max_catch_up_pages
+        self.last_uploaded_run_id = None
+
+    def load_outbox(self):
+        """Returns the outbox sending readouts to breadboard in the background (see breadboard_outbox.py), one sqlite
+        file per StatusMonitor subclass. Upload errors are posted to Slack once per outage, see report_upload_error."""
+        if self.outbox is None:
+            outbox_path = os.path.join(os.path.dirname(__file__), type(self).__name__ + '_outbox.sqlite')
+            self.outbox = BreadboardOutbox(self.bc, outbox_path, on_error=self.report_upload_error)
+        return self.outbox
+
+    def report_upload_error(self, run_id, message):
+        # posted outside of warn_on_slack's rate limit, which is kept for the instrument's own warnings
+        print(message)
+        try:
+            enrico_bot.post_message('{name} upload error: {message}'.format(name=type(self).__name__, message=message))
+        except:
+            print(traceback.format_exc())
 
     def append_to_backlog(self, values_dict, time_now=None):
         for value_name in values_dict:
@@ -38,11 +76,9 @@ class StatusMonitor:
                 raise ValueError(
                     '{name} not in format VALNAME_in_UNITNAME'.format(name=value_name))
 
-        if len(self.backlog) > self.backlog_max:
-            self.backlog.popitem(last=False)
         if time_now is None:
             time_now = datetime.datetime.today()
-        self.backlog[time_now] = values_dict
+        self.backlog.append(values_dict, time_now)
         print('Logged {value} at {time_now}'.format(value=str(values_dict),
                                                     time_now=str(time_now)))
 
@@ -120,43 +156,94 @@ class StatusMonitor:
 
     def upload_to_breadboard(self):
         # matches backlog times to run_id times and writes (but not overwrites) closest log entry to breadboard
+        if self.catch_up:
+            return self.catch_up_to_breadboard()
         try:
             run_dict = get_newest_run_dict(self.bc)
         except:
             print(traceback.format_exc())
+            return
         new_run_id = run_dict['run_id']
-        time_diffs = np.array([time_diff_in_sec(
-            run_dict['runtime'], backlog_time) for backlog_time in self.backlog])
-        time_diffs[time_diffs < self.read_run_time_offset] = -np.infty
-        min_idx = np.argmin(np.abs(time_diffs - self.read_run_time_offset))
-        min_time_diff_from_ideal = (time_diffs[min_idx] -
-                                    self.read_run_time_offset)
-        if np.abs(min_time_diff_from_ideal) < self.max_time_diff_tolerance:
+        indices, deviations = self.backlog.align(run_dict['runtime'], lag=self.alignment_lag,
+                                                 tolerance=self.max_time_diff_tolerance,
+                                                 direction=self.alignment_direction)
+        min_time_diff_from_ideal = deviations[0]
+        if indices[0] >= 0:
             print("Newest breadboard run_id {id} at time: ".format(id=str(run_dict['run_id']))
                   + str(run_dict['runtime']))
-            closest_backlog_time = list(
-                self.backlog.keys())[min_idx]
-            dict_to_upload = self.backlog[closest_backlog_time]
+            dict_to_upload = self.backlog.value(indices[0])
             readout_exists_on_breadboard = False
             for value_name in dict_to_upload.keys():
                 if value_name in run_dict:
                     readout_exists_on_breadboard = True
                     # print('{name} already exists for run_id {id} on breadboard.'.format(name=value_name,id=run_dict['run_id']))
-            if not readout_exists_on_breadboard:
-                resp = self.bc.add_instrument_readout_to_run(
-                    new_run_id, dict_to_upload)
-                if resp.status_code != 200:
-                    warning_text = ('Error uploading {dict_to_upload} from {time_str} to run_id {id}. Error text: '.format(dict_to_upload=str(dict_to_upload),
-                                                                                                                           reading=str(
-                                                                                                                               value_to_upload),
-                                                                                                                           time_str=str(
-                                                                                                                               closest_backlog_time),
-                                                                                                                           id=str(
-                                                                                                                               new_run_id)
-                                                                                                                           ) + resp.text)
-                    self.warn_on_slack(warning_text)
+            if not readout_exists_on_breadboard and new_run_id != self.last_uploaded_run_id:
+                self.load_outbox().add_instrument_readout_to_run(new_run_id, dict_to_upload)
+                self.last_uploaded_run_id = new_run_id
         else:
             warning_text = 'Time difference {diff} sec between reading and latest breadboard entry exceeds max tolerance of {tol} sec. Check breadboard-cicero-client.'.format(
                 diff=str(np.abs(min_time_diff_from_ideal)), tol=str(self.max_time_diff_tolerance))
             if np.abs(min_time_diff_from_ideal) != np.inf:
                 self.warn_on_slack(warning_text)
+
+    def fetch_runs_to_catch_up(self):
+        """Returns the run dicts newer than last_uploaded_run_id, newest first, paging back through breadboard until
+        the last uploaded run_id is reached (see utility_functions.page_back_runs). Only the newest run is returned if
+        nothing was uploaded yet. If the runs since the last upload span more than max_catch_up_pages, the older ones
+        are skipped with a warning."""
+        if self.last_uploaded_run_id is None:  # start from the newest run
+            return get_newest_runs(self.bc, limit=1)
+        run_dicts = []
+        for run_dict in page_back_runs(lambda limit, offset: get_newest_runs(self.bc, limit=limit, offset=offset),
+                                       self.max_catch_up_runs):
+            if run_dict['run_id'] <= self.last_uploaded_run_id:
+                return run_dicts
+            run_dicts.append(run_dict)
+            if len(run_dicts) >= self.max_catch_up_pages * self.max_catch_up_runs:
+                break
+        else:
+            return run_dicts
+        self.warn_on_slack('More than {n} runs since the last upload to run_id {id}, readouts are only uploaded to the newest {n}.'.format(
+            n=str(len(run_dicts)), id=str(self.last_uploaded_run_id)))
+        return run_dicts
+
+    def catch_up_to_breadboard(self):
+        """Uploads the closest backlog entry to every run newer than the last uploaded run_id, so runs are not missed
+        when the monitor loop is slower than the experiment cycle or breadboard was unreachable. The newer runs are
+        fetched in pages of max_catch_up_runs, back to the last uploaded run_id or max_catch_up_pages, and aligned to
+        the backlog in one pass. A run is left for the next call while a closer reading may still arrive, and skipped
+        with a warning if no reading is within max_time_diff_tolerance.
+        Returns the number of runs handled."""
+        try:
+            run_dicts = self.fetch_runs_to_catch_up()
+        except:
+            print(traceback.format_exc())
+            return 0
+        run_dicts = sorted(run_dicts, key=lambda run_dict: run_dict['run_id'])
+        if len(run_dicts) == 0 or len(self.backlog) == 0:
+            return 0
+        runtimes = [run_dict['runtime'] for run_dict in run_dicts]
+        indices, deviations = self.backlog.align(runtimes, lag=self.alignment_lag,
+                                                 tolerance=self.max_time_diff_tolerance,
+                                                 direction=self.alignment_direction)
+        targets = to_timestamps(runtimes) - self.alignment_lag
+        # readings after the target time can only change a nearest match up to max_time_diff_tolerance later
+        settle_time = 0 if self.alignment_direction == 'backward' else self.max_time_diff_tolerance
+        newest_reading_time = self.backlog.times()[-1]
+        n_handled, skipped_run_ids = 0, []
+        for run_dict, idx, target in zip(run_dicts, indices, targets):
+            if newest_reading_time < target + settle_time:
+                break
+            if idx >= 0:
+                dict_to_upload = self.backlog.value(idx)
+                # writes, but does not overwrite, readouts on breadboard
+                if not any(value_name in run_dict for value_name in dict_to_upload):
+                    self.load_outbox().add_instrument_readout_to_run(run_dict['run_id'], dict_to_upload)
+            else:
+                skipped_run_ids.append(run_dict['run_id'])
+            self.last_uploaded_run_id = run_dict['run_id']
+            n_handled += 1
+        if len(skipped_run_ids) > 0:
+            self.warn_on_slack('No reading within max tolerance of {tol} sec for run_ids {ids}. Check breadboard-cicero-client.'.format(
+                tol=str(self.max_time_diff_tolerance), ids=str(skipped_run_ids)))
+        return n_handled
@@ -7,11 +7,12 @@ import sys
 main_path = os.path.abspath(os.path.join(__file__, '../..'))
 sys.path.insert(0, main_path)
 
-from utility_functions import load_breadboard_client, get_newest_run_dict, time_diff_in_sec
+from utility_functions import load_breadboard_client, get_newest_run_dict
+from breadboard_outbox import BreadboardOutbox
 from wlm import WavelengthMeter
 import datetime
 import time
-from collections import OrderedDict
+from time_alignment import ReadingBuffer
 import numpy as np
 bc = load_breadboard_client()
 
@@ -29,7 +30,7 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
 import enrico_bot
-from status_monitor import StatusMonitor, alex_chuang_id
+from status_monitor import StatusMonitor
 from solstis import Solstis
 
 # this script does not use the full functionality of the StatusMonitor class.
@@ -53,6 +54,8 @@ def main():
     my_tisa = Solstis()
     refresh_time = 0.5  # seconds
     print("Did you remember to sync the os clock to a web server?")
+    # readings are queued on disk and sent to breadboard in the background, see breadboard_outbox.py
+    outbox = BreadboardOutbox(bc, os.path.join(os.path.dirname(__file__), 'wavemeter_outbox.sqlite'))
     print('Reading wavemeter, readings will output below ... \n')
     old_run_dict = get_newest_run_dict(bc)
     old_run_id = old_run_dict['run_id']
@@ -64,8 +67,8 @@ def main():
     if(initial_frequency <= 0):
         print("Unable to get wavemeter frequency. Check wavemeter. Program aborted.")
         exit(-1)
-    wavemeter_backlog = OrderedDict()
     max_length = 30
+    wavemeter_backlog = ReadingBuffer(capacity=max_length)
     # Main Loop
     while True:
         successful_read = False
@@ -95,11 +98,9 @@ def main():
                         wavemeter_error_warned = True
                     fail_counter = 0  # keep trying, underexposure is safe for wavemeter
 
-        wavemeter_backlog[datetime.datetime.today()] = wavemeter_reading
+        wavemeter_backlog.append(wavemeter_reading, datetime.datetime.today())
         print('wavemeter reading: {reading}'.format(
             reading=str(wavemeter_reading)))
-        if len(wavemeter_backlog) > max_length:
-            wavemeter_backlog.popitem(last=False)
 
         # listen to breadboard server for new run_id
         try:
@@ -128,28 +129,17 @@ def main():
                 reading=str(wavemeter_reading)))
             # write to Breadboard
             print("Breadboard time: " + str(new_run_dict['runtime']))
-            time_diffs = np.array([time_diff_in_sec(
-                new_run_dict['runtime'], wavemeter_time) for wavemeter_time in wavemeter_backlog])
-            time_diffs[time_diffs < WAVEMETER_READ_TIME_OFFSET] = -np.infty
-            min_idx = np.argmin(
-                np.abs(time_diffs - WAVEMETER_READ_TIME_OFFSET))
-            min_time_diff_from_ideal = time_diffs[min_idx] - \
-                WAVEMETER_READ_TIME_OFFSET
             max_time_diff_tolerance = 20  # seconds
-            if np.abs(min_time_diff_from_ideal) < max_time_diff_tolerance:
-                closest_wavemeter_time = list(
-                    wavemeter_backlog.keys())[min_idx]
-                wavemeter_reading_to_upload = wavemeter_backlog[closest_wavemeter_time]
-                resp = bc.add_instrument_readout_to_run(
+            indices, _ = wavemeter_backlog.align(new_run_dict['runtime'], lag=WAVEMETER_READ_TIME_OFFSET,
+                                                 tolerance=max_time_diff_tolerance)
+            if indices[0] >= 0:
+                closest_wavemeter_time = wavemeter_backlog.time(indices[0])
+                wavemeter_reading_to_upload = wavemeter_backlog.value(indices[0])
+                outbox.add_instrument_readout_to_run(
                     new_run_id, {'wavemeter_in_THz': wavemeter_reading_to_upload})
-                if resp.status_code == 200:
-                    logger.debug('Associated wavemeter reading {reading} from {time_str} to run_id {id}'.format(reading=str(wavemeter_reading_to_upload),
-                                                                                                                time_str=str(closest_wavemeter_time), id=str(new_run_id)
-                                                                                                                ))
-                else:
-                    logger.warning('Error uploading wavemeter reading {reading} from {time_str} to run_id {id}. Error text: '.format(reading=str(wavemeter_reading_to_upload),
-                                                                                                                                     time_str=str(closest_wavemeter_time), id=str(new_run_id)
-                                                                                                                                     ) + resp.text)
+                logger.debug('Queued wavemeter reading {reading} from {time_str} for run_id {id}'.format(reading=str(wavemeter_reading_to_upload),
+                                                                                                    time_str=str(closest_wavemeter_time), id=str(new_run_id)
+                                                                                                    ))
                 old_run_id = new_run_id
             else:
                 warning_message = 'Time difference between wavemeter reading and latest breadboard entry exceeds max tolerance of {tol} sec. Check breadboard-cicero-client.'.format(
@@ -13,6 +13,7 @@ import numpy as np
 import warnings
 import matplotlib.cbook
 from utility_functions import get_newest_df
+from run_mirror import get_mirror
 warnings.filterwarnings("ignore", category=matplotlib.cbook.mplDeprecation)
 
 filechooser_widget = FileChooser(os.getcwd())
@@ -47,6 +48,8 @@ def save_image_log(event, qgrid_widget):
     payload = json.dumps(run_dict)
 #     print(payload)
     resp = bc._send_message('put', '/runs/' + str(run_id) + '/', data=payload)
+    if resp.status_code == 200:
+        get_mirror(bc).store([run_dict])
 
 def load_image_log(watchfolder, optional_column_names=[]):
     try:
@@ -59,8 +62,10 @@ def load_image_log(watchfolder, optional_column_names=[]):
             load_qgrid.loaded_qgrid.close()
     except:
         pass
+    # a newly loaded folder is re-fetched from breadboard, to show edits made elsewhere
     df = get_newest_df(
-        watchfolder, optional_column_names=optional_column_names, existing_df=existing_df)
+        watchfolder, optional_column_names=optional_column_names, existing_df=existing_df,
+        max_age=0 if existing_df is None else None)
     load_image_log.old_watchfolder = watchfolder
     for column in optional_column_names:
         if column not in df.columns:
@@ -0,0 +1,118 @@
+"""A pool of pre-warmed MATLAB engines and a dispatcher analyzing several shots at once.
+
+Starting a MATLAB engine takes tens of seconds, so MatlabEnginePool starts all of its engines once, in parallel, and
+changes each into the analysis library folder right away, so the matlab_wrapper functions can be called with
+analysis_library_path=None and skip their per-call cd. AnalysisDispatcher runs one shot per engine in worker threads
+and hands finished analyses back in run_id order, so uploads to breadboard and updates of the analysis settings
+happen in the same order as with a single engine.
+"""
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class MatlabEnginePool():
+
+    def __init__(self, n_engines=2, analysis_library_path=None):
+        """
+        Args:
+            - n_engines: number of MATLAB engines, i.e. shots analyzed at once.
+            - analysis_library_path: folder with the MATLAB analysis functions every engine is cd'd into.
+        """
+        import matlab.engine
+        print('loading {n} matlab engines...'.format(n=str(n_engines)))
+        futures = [matlab.engine.start_matlab(background=True) for _ in range(n_engines)]
+        self.engines = [future.result() for future in futures]
+        if analysis_library_path is not None:
+            for eng in self.engines:
+                eng.eval(r'cd ' + analysis_library_path, nargout=0)
+        self.idle_engines = queue.Queue()
+        for eng in self.engines:
+            self.idle_engines.put(eng)
+        print('matlab engines loaded')
+
+    @property
+    def size(self):
+        return len(self.engines)
+
+    @contextmanager
+    def engine(self):
+        """Blocks until an engine is idle and lends it for the duration of a with block."""
+        eng = self.idle_engines.get()
+        try:
+            yield eng
+        finally:
+            self.idle_engines.put(eng)
+
+    def quit(self):
+        for eng in self.engines:
+            eng.quit()
+
+
+class AnalysisDispatcher():
+    """Analyzes shots on the engines of a MatlabEnginePool in parallel, and returns the results in run_id order.
+
+    Each shot is analyzed with the settings of the newest analysis handed back when it was submitted, and
+    previous_settings is only advanced as results are handed back, i.e. in run_id order.
+    """
+
+    def __init__(self, pool, analysis_function, previous_settings=None):
+        """
+        Args:
+            - pool: MatlabEnginePool.
+            - analysis_function: takes (filepath(s), previous_settings, eng) and returns (analysis_dict, settings).
+            - previous_settings: settings passed to the first shots.
+        """
+        self.pool = pool
+        self.analysis_function = analysis_function
+        self.previous_settings = previous_settings
+        self.executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix='matlab-analysis')
+        self.in_flight = {}  # run_id: (filepath(s), future)
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def _analyze(self, file, previous_settings):
+        with self.pool.engine() as eng:
+            return self.analysis_function(file, previous_settings, eng)
+
+    def is_full(self):
+        return len(self.in_flight) >= self.pool.size
+
+    def submit(self, run_id, file):
+        """Queues the analysis of run_id's image(s) file and returns immediately."""
+        with self.lock:
+            future = self.executor.submit(self._analyze, file, self.previous_settings)
+            self.in_flight[run_id] = (file, future)
+        self.logger.debug('{run_id} submitted for analysis'.format(run_id=str(run_id)))
+
+    def pop_finished(self, timeout=None):
+        """Waits up to timeout seconds for the lowest run_id in flight to finish.
+
+        Returns:
+            list of (run_id, file, analysis_dict, error) tuples in run_id order, for all finished shots with no
+            unfinished shot of a lower run_id. analysis_dict is None and error the exception if the analysis failed.
+        """
+        with self.lock:
+            if len(self.in_flight) == 0:
+                return []
+            lowest_future = self.in_flight[min(self.in_flight)][1]
+        wait([lowest_future], timeout=timeout)
+        with self.lock:
+            finished = []
+            for run_id in sorted(self.in_flight):
+                file, future = self.in_flight[run_id]
+                if not future.done():
+                    break
+                del self.in_flight[run_id]
+                try:
+                    analysis_dict, settings = future.result()
+                    self.previous_settings = settings
+                    finished.append((run_id, file, analysis_dict, None))
+                except Exception as e:
+                    finished.append((run_id, file, None, e))
+            return finished
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
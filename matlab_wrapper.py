@@ -26,6 +26,14 @@ def load_matlab_engine():
 def numpyfy_MATLABarray(matlab_array):
     return np.array(matlab_array._data).reshape(matlab_array.size, order='F')
 
+
+def save_od_preview(od_image, filepath):
+    """Saves the ODimage of a MATLAB analysis as a .jpeg preview next to the .spe file at filepath."""
+    np_im = numpyfy_MATLABarray(od_image)
+    im = Image.fromarray(np_im)
+    save_filepath = filepath.replace('.spe', '.jpeg')
+    im.save(save_filepath)
+
 # getAnalysisModeAnalysis takes (matlab_engine, filepath, **kwargs) and returns a dictionary translated from a MATLAB analysis struct.
 # analysismode_analyzed_var_names is manually defined to include scalar values from the analysis dictionary. These are most easily written to breadboard.
 
@@ -41,7 +49,8 @@ def getYcamAnalysis(eng, filepath,
                     analysis_library_path=ycam_path,
                     marqueeBox=None, normBox=None, save_jpg_preview=True):
     try:
-        eng.eval(r'cd ' + analysis_library_path, nargout=0)
+        if analysis_library_path is not None:  # None if eng is already there, see matlab_engine_pool.py
+            eng.eval(r'cd ' + analysis_library_path, nargout=0)
         if marqueeBox is None and normBox is None:
             # calling MATLAB function
             matlab_dict = eng.getYcamAnalysis(filepath)
@@ -50,10 +59,7 @@ def getYcamAnalysis(eng, filepath,
                 filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
         if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
+            save_od_preview(matlab_dict['ODimage'], filepath)
 
         return matlab_dict
     except:
@@ -68,7 +74,8 @@ def getDualImagingAnalysis(eng, filepath,
                            analysis_library_path=dualimaging_path,
                            marqueeBox=None, normBox=None, save_jpg_preview=True):
     try:
-        eng.eval(r'cd ' + analysis_library_path, nargout=0)
+        if analysis_library_path is not None:  # None if eng is already there, see matlab_engine_pool.py
+            eng.eval(r'cd ' + analysis_library_path, nargout=0)
         matlab_dict = eng.getDualImagingZcamAnalysis(filepath)
         # if marqueeBox is None and normBox is None:
         #     matlab_dict = eng.getMeasNaAnalysis(filepath) #calling MATLAB function getMeasNaAnalysis
@@ -76,12 +83,11 @@ def getDualImagingAnalysis(eng, filepath,
         #     matlab_dict = eng.getMeasNaAnalysis(filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
         if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
+            save_od_preview(matlab_dict['ODimage'], filepath)
 
         flatten_dict = {'analysis': {}, 'settings': {}}
+        if not save_jpg_preview and 'ODimage' in matlab_dict:  # saved by AnalysisLogger.preview_stage instead
+            flatten_dict['ODimage'] = matlab_dict['ODimage']
         for key in matlab_dict['K_analysis']:
             flatten_dict['analysis']['K_' +
                                      key] = matlab_dict['K_analysis'][key]
@@ -110,7 +116,8 @@ def getTripleImagingAnalysis(eng, filepaths,
                              analysis_library_path=tripleimaging_path,
                              marqueeBox=None, normBox=None, save_jpg_preview=True):
     try:
-        eng.eval(r'cd ' + analysis_library_path, nargout=0)
+        if analysis_library_path is not None:  # None if eng is already there, see matlab_engine_pool.py
+            eng.eval(r'cd ' + analysis_library_path, nargout=0)
         matlab_dict = eng.getTripleImagingZcamAnalysis_2021(filepaths[0],
                                                        filepaths[1], filepaths[2])
         # if marqueeBox is None and normBox is None:
@@ -119,12 +126,11 @@ def getTripleImagingAnalysis(eng, filepaths,
         #     matlab_dict = eng.getMeasNaAnalysis(filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
         if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
+            save_od_preview(matlab_dict['ODimage'], filepaths[0])
 
         flatten_dict = {'analysis': {}, 'settings': {}}
+        if not save_jpg_preview and 'ODimage' in matlab_dict:  # saved by AnalysisLogger.preview_stage instead
+            flatten_dict['ODimage'] = matlab_dict['ODimage']
         for key in matlab_dict['K1_analysis']:
             flatten_dict['analysis']['K1_' +
                                      key] = matlab_dict['K1_analysis'][key]
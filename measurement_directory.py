@@ -105,6 +105,12 @@ def measurement_directory(warn=False, measurement_name=None, basepath='', yester
     return measurement_dir
 
 
+def measurement_name_from_runfolder(runfolder):
+    """Returns the month/date/run_name measurement name of a run folder, i.e. the folder returned by
+    measurement_directory with basepath '', whatever the basepath or the cwd the run folder is given in."""
+    return os.path.join(*os.path.normpath(os.path.abspath(runfolder)).split(os.sep)[-3:])
+
+
 def move_misplaced_images():
     today = datetime.datetime.today()
     month = datetime.datetime.strftime(today, MONTH_DIR_FMT)
@@ -0,0 +1,77 @@
+"""Runs one ImageWatchdog per camera in a single process.
+
+All cameras share one RunCache, so breadboard is polled once per refresh no matter how many cameras are attached,
+one ReplicationQueue for the copies to the BEC1server and one BreadboardOutbox, which sends the image names of all
+cameras for a run in one batch. Each camera keeps its own watchfolder, images per shot,
+run folder and image naming, and its watchdog blocks on its own folder watcher in its own thread.
+
+The cameras are configured in a .json file (by default multi_camera_config.json next to this file) holding a list
+of ImageWatchdog keyword arguments plus an optional measurement_name, e.g.
+    [{"camera_name": "ycam", "watchfolder": "images_ycam", "num_images_per_shot": 1, "measurement_name": "run0_foo"},
+     {"camera_name": "zcam", "watchfolder": "images_zcam", "num_images_per_shot": 3, "measurement_name": "run0_foo"}]
+
+Usage:
+    python multi_camera_watchdog.py [config.json]
+"""
+import os
+import sys
+import json
+import time
+import threading
+from image_watchdog import ImageWatchdog, bc
+from measurement_directory import measurement_directory
+from run_cache import RunCache
+from replication_queue import ReplicationQueue
+from breadboard_outbox import BreadboardOutbox
+
+
+class MultiCameraWatchdog():
+
+    def __init__(self, camera_configs, backup_to_bec1server=True,
+                 outbox_path=os.path.join(os.path.dirname(__file__), 'multi_camera_outbox.sqlite')):
+        """
+        Args:
+            - camera_configs: list of dicts of ImageWatchdog keyword arguments. A measurement_name key is turned into
+                the runfolder of that camera.
+            - backup_to_bec1server: if True, all cameras share one queue of copies to the BEC1server.
+            - outbox_path: sqlite file of the breadboard writes of all cameras, see breadboard_outbox.py.
+        """
+        self.run_cache = RunCache(bc)
+        self.replication_queue = ReplicationQueue() if backup_to_bec1server else None
+        self.outbox = BreadboardOutbox(bc, outbox_path)
+        self.watchdogs = []
+        for camera_config in camera_configs:
+            camera_config = dict(camera_config)
+            measurement_name = camera_config.pop('measurement_name', None)
+            if measurement_name is not None:
+                camera_config['runfolder'] = measurement_directory(measurement_name=measurement_name)
+            watchdog = ImageWatchdog(run_cache=self.run_cache, replication_queue=self.replication_queue,
+                                     outbox=self.outbox, backup_to_bec1server=backup_to_bec1server, **camera_config)
+            self.watchdogs.append(watchdog)
+        self.threads = []
+
+    def main(self):
+        for watchdog in self.watchdogs:
+            name = watchdog.camera_name or watchdog.watchfolder
+            thread = threading.Thread(target=watchdog.main, name='watchdog-' + str(name), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        try:
+            while any(thread.is_alive() for thread in self.threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+def load_camera_configs(config_path=os.path.join(os.path.dirname(__file__), 'multi_camera_config.json')):
+    with open(config_path) as my_file:
+        return json.load(my_file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        camera_configs = load_camera_configs()
+    else:
+        camera_configs = load_camera_configs(sys.argv[1])
+    multi_camera_watchdog = MultiCameraWatchdog(camera_configs)
+    multi_camera_watchdog.main()
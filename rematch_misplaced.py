@@ -0,0 +1,156 @@
+"""Offline recovery of images that ImageWatchdog moved to a <runfolder>misplaced folder.
+
+For every misplaced folder of a day (YYYYMM/YYMMDD) or a whole month (YYYYMM), the images are grouped into shots, the
+breadboard runs covering their time span are fetched in a few paged requests, and the shots are assigned to the runs
+without images in the run folders yet, in time order with run_matching.assign_shots_to_runs. Shots are timed by the
+camera clock moved onto the arrival clock of the matching window, like in ImageWatchdog. Matched images are renamed to runIdx_imageIdx.spe, moved into the run folder and
+registered with breadboard under the same measurement name as ImageWatchdog uses, one request per run.
+
+Usage:
+    python rematch_misplaced.py YYYYMM/YYMMDD [images_per_shot] [--dry-run]
+    python rematch_misplaced.py YYYYMM [images_per_shot] [--dry-run]
+"""
+import os
+import sys
+import datetime
+import logging
+from utility_functions import load_breadboard_client, get_runs_since, parse_runtime
+from run_matching import assign_shots_to_runs, ArrivalClock, image_times
+from spe_file import spe_camera_time
+from measurement_directory import measurement_name_from_runfolder
+
+MISPLACED_SUFFIX = 'misplaced'
+
+
+def find_misplaced_folders(path):
+    """Returns (misplaced folder, run folder) path pairs for all <runfolder>misplaced folders in a month or day folder.
+    Folders made by ImageWatchdog.clear_watchfolder (misplacedimagesHHMMSS) have no run folder and are skipped."""
+    day_folders = [path]
+    if not any(name.startswith('run') or name.startswith('misplaced') for name in os.listdir(path)):
+        # a month folder, containing day folders
+        day_folders = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                       if os.path.isdir(os.path.join(path, name))]
+    folder_pairs = []
+    for day_folder in day_folders:
+        for name in sorted(os.listdir(day_folder)):
+            runfolder = os.path.join(day_folder, name[:-len(MISPLACED_SUFFIX)])
+            if name.endswith(MISPLACED_SUFFIX) and os.path.isdir(runfolder):
+                folder_pairs.append((os.path.join(day_folder, name), runfolder))
+    return folder_pairs
+
+
+def group_shots(misplaced_folder, images_per_shot=1, arrival_clock=None):
+    """Groups the .spe files in misplaced_folder into shots of images_per_shot consecutive files.
+
+    Args:
+        - arrival_clock: run_matching.ArrivalClock shared by all folders, so that their shots can be compared.
+
+    Returns:
+        list of (filepaths, file_time) tuples in time order. file_time is the time of the first image of the shot
+        on the arrival clock: its camera time (see spe_file.spe_camera_time) moved by the latency to its ctime, or
+        its ctime if an image of the folder has no camera timestamp, see run_matching.image_times.
+    """
+    if arrival_clock is None:
+        arrival_clock = ArrivalClock()
+    filepaths = [os.path.join(misplaced_folder, name) for name in os.listdir(misplaced_folder) if name.endswith('.spe')]
+    camera_times = [spe_camera_time(filepath) for filepath in filepaths]
+    ctimes = [datetime.datetime.fromtimestamp(os.stat(filepath).st_ctime) for filepath in filepaths]
+    file_times = dict(zip(filepaths, image_times(camera_times, ctimes, arrival_clock)))
+    filepaths = sorted(filepaths, key=lambda filepath: file_times[filepath])
+    shots = []
+    for idx in range(0, len(filepaths) - images_per_shot + 1, images_per_shot):
+        shot_filepaths = filepaths[idx:idx + images_per_shot]
+        file_time = file_times[shot_filepaths[0]]
+        # image indices follow the same (reverse name) order as ImageWatchdog.move_images
+        shots.append((sorted(shot_filepaths, key=os.path.basename, reverse=True), file_time))
+    return shots
+
+
+def taken_run_ids(runfolders):
+    """Returns the set of run_ids with images named runIdx_imageIdx.spe in any of runfolders."""
+    run_ids = set()
+    for runfolder in set(runfolders):
+        for name in os.listdir(runfolder):
+            run_id = name.split('_')[0]
+            if name.endswith('.spe') and run_id.isdigit():
+                run_ids.add(int(run_id))
+    return run_ids
+
+
+def rematch_misplaced(path, images_per_shot=1, min_time_diff_in_sec=0, max_time_diff_in_sec=10, dry_run=False, bc=None):
+    """Matches, renames, moves and registers the misplaced images of a day or month folder.
+
+    Returns:
+        dict of run_id: list of new image filenames.
+    """
+    logger = logging.getLogger(__name__)
+    folder_pairs = find_misplaced_folders(path)
+    shots, runfolders = [], []
+    arrival_clock = ArrivalClock()
+    for misplaced_folder, runfolder in folder_pairs:
+        folder_shots = group_shots(misplaced_folder, images_per_shot=images_per_shot, arrival_clock=arrival_clock)
+        shots += folder_shots
+        runfolders += [runfolder] * len(folder_shots)
+    if len(shots) == 0:
+        print('No misplaced images found in ' + path)
+        return {}
+    order = sorted(range(len(shots)), key=lambda idx: shots[idx][1])
+    shots, runfolders = [shots[idx] for idx in order], [runfolders[idx] for idx in order]
+    if bc is None:
+        bc = load_breadboard_client()
+    start_time = shots[0][1] - datetime.timedelta(seconds=max_time_diff_in_sec)
+    run_dicts = get_runs_since(bc, start_time)
+    # runs with images already are matched, and must not take a misplaced shot
+    taken = taken_run_ids(runfolders)
+    run_dicts = [run_dict for run_dict in run_dicts if run_dict['run_id'] not in taken]
+    print('{n_shots} misplaced shots, {n_runs} breadboard runs without images since {time}'.format(
+        n_shots=str(len(shots)), n_runs=str(len(run_dicts)), time=str(start_time)))
+    runtimes = [parse_runtime(run_dict['runtime']) for run_dict in run_dicts]
+    assignment = assign_shots_to_runs([file_time for _, file_time in shots], runtimes,
+                                      min_time_diff_in_sec=min_time_diff_in_sec,
+                                      max_time_diff_in_sec=max_time_diff_in_sec)
+    registered = {}
+    for (filepaths, file_time), runfolder, run_idx in zip(shots, runfolders, assignment):
+        if run_idx is None:
+            continue
+        run_id = run_dicts[run_idx]['run_id']
+        new_filenames = ['{run_id}_{idx}.spe'.format(run_id=str(run_id), idx=str(image_idx))
+                         for image_idx in range(len(filepaths))]
+        new_filepaths = [os.path.join(runfolder, new_filename) for new_filename in new_filenames]
+        # a shot is moved whole or not at all, so it is never split between folders
+        existing_filepaths = [new_filepath for new_filepath in new_filepaths if os.path.exists(new_filepath)]
+        if len(existing_filepaths) > 0:
+            logger.warning('{paths} exist(s) already, leaving {files} misplaced.'.format(
+                paths=', '.join(existing_filepaths), files=', '.join(filepaths)))
+            continue
+        for filepath, new_filepath in zip(filepaths, new_filepaths):
+            print('{old} -> {new}'.format(old=filepath, new=new_filepath))
+            if not dry_run:
+                os.replace(filepath, new_filepath)
+                logger.debug('moving {old_name} to {destination}'.format(old_name=filepath, destination=new_filepath))
+        registered.setdefault((run_id, runfolder), []).extend(new_filenames)
+    if not dry_run:
+        for (run_id, runfolder), new_filenames in registered.items():
+            # the images are moved already, so a failed request must not keep the other runs from being registered
+            try:
+                resp = bc.append_images_to_run(run_id, new_filenames)
+                if resp.status_code != 200:
+                    logger.warning('Upload error: ' + resp.text)
+                resp = bc.add_measurement_name_to_run(run_id, measurement_name_from_runfolder(runfolder))
+                if resp is not None and resp.status_code != 200:
+                    logger.warning('Upload error: ' + resp.text)
+            except:
+                logger.error('registering {files} to run_id {id} failed: {error}'.format(
+                    files=', '.join(new_filenames), id=str(run_id), error=str(sys.exc_info()[1])))
+    n_matched = sum(run_idx is not None for run_idx in assignment)
+    print('Matched {n} of {total} misplaced shots.'.format(n=str(n_matched), total=str(len(shots))))
+    return {run_id: new_filenames for (run_id, _), new_filenames in registered.items()}
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--dry-run']
+    if len(args) not in [1, 2]:
+        print(__doc__)
+        sys.exit(1)
+    images_per_shot = int(args[1]) if len(args) == 2 else 1
+    rematch_misplaced(args[0], images_per_shot=images_per_shot, dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,324 @@
+"""A persistent queue of file copies to the BEC1server, drained in the background by a pool of worker threads.
+
+Copies are recorded in a sqlite database before they are attempted, so queued and interrupted copies survive
+a restart of the process. Each copy is written to destination.partial, resumed from the end of an existing .partial
+file, verified and only then renamed into place. By default the checksum of the source is computed in the same read
+pass as the copy and the written file is verified against it. With verify_checksums=False the copy is done inside the
+kernel instead (see file_transfer.copy_file), never passing the image through python, and verified by its size; a
+resumed copy, whose partial file may end in a torn write, is still verified by checksums of both files. Failed copies
+are retried with exponential backoff.
+
+Several processes, e.g. an ImageWatchdog and a MultiCameraWatchdog, can share the queue database. A copy is claimed
+in a single write transaction and leased to the claiming process, which renews the lease while it runs. Only copies
+whose lease expired, i.e. whose process died, are taken over by another process or reset on start.
+"""
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+from file_transfer import copy_file, format_stats, transfer_stats
+
+CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = '.partial'
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS copies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL,
+    checksum TEXT,
+    error TEXT,
+    finished REAL,
+    owner TEXT,
+    lease_until REAL)"""
+# columns added to the copies table since it was first created, see ReplicationQueue._migrate
+_ADDED_COLUMNS = [('owner', 'TEXT'), ('lease_until', 'REAL')]
+
+
+def file_checksum(filepath):
+    checksum = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def copy_with_checksum(source, destination):
+    """Copies source to destination + '.partial', resuming from the end of an existing partial file, and renames it
+    to destination after verifying its checksum. The source is read once and the written file is read back once,
+    so this costs two full reads, one of them over the network for a remote destination.
+
+    Returns:
+        the sha1 hexdigest of the source.
+
+    Raises:
+        IOError if the written file does not match the source.
+    """
+    partial = destination + PARTIAL_SUFFIX
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    resume_offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if resume_offset > os.path.getsize(source):
+        resume_offset = 0
+    checksum = hashlib.sha1()
+    position = 0
+    with open(source, 'rb') as source_file, open(partial, 'r+b' if resume_offset > 0 else 'wb') as partial_file:
+        partial_file.seek(resume_offset)
+        for chunk in iter(lambda: source_file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+            if position + len(chunk) > resume_offset:
+                partial_file.write(chunk[max(resume_offset - position, 0):])
+            position += len(chunk)
+        partial_file.truncate(position)
+        partial_file.flush()
+        os.fsync(partial_file.fileno())
+    source_checksum = checksum.hexdigest()
+    if file_checksum(partial) != source_checksum:
+        os.remove(partial)  # restart from scratch on the next attempt
+        raise IOError('checksum mismatch copying {source} to {destination}'.format(source=source,
+                                                                                  destination=destination))
+    os.replace(partial, destination)
+    return source_checksum
+
+
+def copy_with_size_check(source, destination):
+    """Copies source to destination + '.partial' with file_transfer.copy_file, resuming from the end of an existing
+    partial file, and renames it to destination once its size matches the source. A resumed copy is also verified
+    by the checksums of the source and the written file, since the partial file may end in a torn write.
+
+    Returns:
+        dict of transfer statistics, see file_transfer.format_stats.
+
+    Raises:
+        IOError if the written file does not match the size (or for a resumed copy, the checksum) of the source.
+    """
+    partial = destination + PARTIAL_SUFFIX
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    resume_offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if resume_offset > os.path.getsize(source):
+        resume_offset = 0
+    stats = copy_file(source, partial, offset=resume_offset)
+    if os.path.getsize(partial) != os.path.getsize(source):
+        os.remove(partial)
+        raise IOError('size mismatch copying {source} to {destination}'.format(source=source,
+                                                                              destination=destination))
+    if resume_offset > 0 and file_checksum(partial) != file_checksum(source):
+        os.remove(partial)  # restart from scratch on the next attempt
+        raise IOError('checksum mismatch resuming the copy of {source} to {destination}'.format(
+            source=source, destination=destination))
+    os.replace(partial, destination)
+    return stats
+
+
+class ReplicationQueue():
+    """ReplicationQueue copies files to a (possibly slow or stalled) network share without blocking the caller.
+    enqueue() only writes a row to the local queue database; worker threads do the copying."""
+
+    def __init__(self, db_path=os.path.join(os.path.dirname(__file__), 'replication_queue.sqlite'),
+                 num_workers=2, max_retries=10, backoff_time=2, max_backoff_time=60 * 5, autostart=True,
+                 verify_checksums=True, lease_time=60):
+        """
+        Args:
+            - db_path: sqlite file holding the queue. Reusing it after a restart resumes unfinished copies.
+            - num_workers: number of copy threads.
+            - max_retries: copies are marked failed after this many attempts.
+            - backoff_time, max_backoff_time: seconds to wait before the first retry, doubling up to max_backoff_time.
+            - verify_checksums: if True, the source is checksummed in the read pass of the copy and the written file
+                is verified against it (see copy_with_checksum), which reads the destination back. If False, copies
+                are done inside the kernel and verified by size, resumed copies also by checksum (see
+                copy_with_size_check).
+            - lease_time: seconds a claimed copy stays with this process without a renewal of its lease. Copies of a
+                process that stopped renewing, e.g. crashed, are taken over after this.
+        """
+        self.db_path = db_path
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.backoff_time = backoff_time
+        self.max_backoff_time = max_backoff_time
+        self.verify_checksums = verify_checksums
+        self.lease_time = lease_time
+        # identifies the copies claimed by this process in a database shared with other processes
+        self.owner = '{host}:{pid}:{token}'.format(host=socket.gethostname(), pid=str(os.getpid()),
+                                                   token=uuid.uuid4().hex[:8])
+        self.logger = logging.getLogger(__name__)
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self.failing = False  # True from a failure of the worker loop until the next copy is done
+        self._failing_lock = threading.Lock()
+        self.workers = []
+        with self._connection() as conn:
+            conn.execute(_SCHEMA)
+            self._migrate(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS copies_status ON copies (status, next_try)")
+            # copies interrupted by a crash or restart are resumed from their .partial file, those of other running
+            # processes keep their lease
+            conn.execute("UPDATE copies SET status = 'pending', owner = NULL WHERE status = 'in_progress' AND (lease_until IS NULL OR lease_until < ?)",
+                         (time.time(),))
+        if autostart:
+            self.start()
+
+    def _migrate(self, conn):
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(copies)").fetchall()]
+        for name, column_type in _ADDED_COLUMNS:
+            if name not in columns:
+                conn.execute("ALTER TABLE copies ADD COLUMN {name} {type}".format(name=name, type=column_type))
+
+    def _connection(self):
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+        return self._local.conn
+
+    def start(self):
+        self._stop.clear()
+        for idx in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name='replication-worker-{idx}'.format(idx=idx),
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        lease_renewer = threading.Thread(target=self._renew_leases, name='replication-lease-renewer', daemon=True)
+        lease_renewer.start()
+        self.workers.append(lease_renewer)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def enqueue(self, source, destination):
+        """Queues a copy of source to destination and returns immediately."""
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT INTO copies (source, destination, enqueued, status, next_try) VALUES (?, ?, ?, 'pending', ?)",
+                         (os.path.abspath(source), destination, now, now))
+        self._wakeup.set()
+
+    def status(self):
+        """Returns a dict with queue_depth (pending and in progress copies), failed copies, done copies and
+        lag_in_sec, the age of the oldest unfinished copy."""
+        conn = self._connection()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM copies GROUP BY status").fetchall())
+        oldest = conn.execute("SELECT MIN(enqueued) FROM copies WHERE status IN ('pending', 'in_progress')").fetchone()[0]
+        return {'queue_depth': counts.get('pending', 0) + counts.get('in_progress', 0),
+                'failed': counts.get('failed', 0),
+                'done': counts.get('done', 0),
+                'lag_in_sec': 0 if oldest is None else time.time() - oldest}
+
+    def _claim(self):
+        """Claims the oldest copy due, or one whose lease expired, for this process. BEGIN IMMEDIATE takes the write
+        lock of the database before the SELECT, so no other thread or process can claim the same copy."""
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, source, destination, attempts FROM copies WHERE (status = 'pending' AND next_try <= ?) OR (status = 'in_progress' AND lease_until < ?) ORDER BY id LIMIT 1",
+                               (now, now)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE copies SET status = 'in_progress', owner = ?, lease_until = ? WHERE id = ?",
+                             (self.owner, now + self.lease_time, row[0]))
+        return row
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                with self._connection() as conn:
+                    conn.execute("UPDATE copies SET lease_until = ? WHERE status = 'in_progress' AND owner = ?",
+                                 (time.time() + self.lease_time, self.owner))
+            except sqlite3.Error as e:
+                self.logger.warning('renewing the leases of {owner} failed: {error}'.format(owner=self.owner,
+                                                                                          error=str(e)))
+
+    def _time_to_next_try(self):
+        """Returns the seconds until a pending copy is due or the lease of another process's copy expires, or None
+        if there are neither."""
+        next_try, lease_until = self._connection().execute(
+            "SELECT (SELECT MIN(next_try) FROM copies WHERE status = 'pending'), (SELECT MIN(lease_until) FROM copies WHERE status = 'in_progress' AND owner != ?)",
+            (self.owner,)).fetchone()
+        due_times = [due_time for due_time in (next_try, lease_until) if due_time is not None]
+        if len(due_times) == 0:
+            return None
+        return max(min(due_times) - time.time(), 0)
+
+    def _work(self):
+        loop_errors = 0  # consecutive failures outside of the copies, e.g. of the queue database
+        while not self._stop.is_set():
+            try:
+                if getattr(self._local, 'claimed', None) is not None:
+                    self._release_claimed()
+                self._work_once()
+                loop_errors = 0
+            except Exception as e:
+                loop_errors += 1
+                wait_time = min(self.backoff_time * 2 ** (loop_errors - 1), self.max_backoff_time)
+                message = 'replication worker failed ({error}), retrying in {sec:.0f} s'.format(error=repr(e),
+                                                                                             sec=wait_time)
+                if self._report_failure():
+                    self.logger.error(message)
+                else:
+                    self.logger.debug(message)
+                self._stop.wait(wait_time)
+
+    def _report_failure(self):
+        """Marks the worker loop failing. Returns True at the start of an outage, i.e. if it was not failing yet."""
+        with self._failing_lock:
+            outage_start, self.failing = not self.failing, True
+        return outage_start
+
+    def _release_claimed(self):
+        """Puts the copy claimed by this worker back to pending, after it could not be marked done or failed."""
+        with self._connection() as conn:
+            conn.execute("UPDATE copies SET status = 'pending', owner = NULL WHERE id = ? AND owner = ? AND status = 'in_progress'",
+                         (self._local.claimed, self.owner))
+        self._local.claimed = None
+
+    def _work_once(self):
+        """Claims and runs one copy, or waits until a copy is due."""
+        row = self._claim()
+        if row is None:
+            self._wakeup.clear()
+            self._wakeup.wait(self._time_to_next_try())
+            return
+        copy_id, source, destination, attempts = row
+        self._local.claimed = copy_id
+        conn = self._connection()
+        start_time = time.perf_counter()
+        try:
+            if self.verify_checksums:
+                checksum = copy_with_checksum(source, destination)
+                stats = transfer_stats(os.path.getsize(destination), start_time, 'sha1 verified')
+            else:
+                checksum = None
+                stats = copy_with_size_check(source, destination)
+            with conn:
+                conn.execute("UPDATE copies SET status = 'done', checksum = ?, finished = ?, error = NULL, owner = NULL WHERE id = ? AND owner = ?",
+                             (checksum, time.time(), copy_id, self.owner))
+            self._local.claimed = None
+            self.logger.debug('copied {source} to {destination}: {stats}'.format(
+                source=source, destination=destination, stats=format_stats(stats)))
+            with self._failing_lock:
+                outage_end, self.failing = self.failing, False
+            if outage_end:
+                self.logger.warning('replication worker recovered')
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.max_retries or not os.path.exists(source):
+                status, next_try = 'failed', time.time()
+                self.logger.error('giving up copying {source} to {destination}: {error}'.format(
+                    source=source, destination=destination, error=str(e)))
+            else:
+                status = 'pending'
+                next_try = time.time() + min(self.backoff_time * 2 ** (attempts - 1), self.max_backoff_time)
+                self.logger.warning('copying {source} failed ({error}), retry {n} in {sec:.0f} s'.format(
+                    source=source, error=str(e), n=str(attempts), sec=next_try - time.time()))
+            with conn:
+                conn.execute("UPDATE copies SET status = ?, attempts = ?, next_try = ?, error = ?, owner = NULL WHERE id = ? AND owner = ?",
+                             (status, attempts, next_try, str(e), copy_id, self.owner))
+            self._local.claimed = None
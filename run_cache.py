@@ -0,0 +1,109 @@
+"""A background-refreshed window of the newest breadboard runs.
+
+RunCache keeps the last `size` fermi1 runs, newest first, with their runtimes already parsed to datetime objects.
+A background thread refreshes the window with one get request every refresh_time seconds, so matching an image to
+a run is a search over local memory instead of a breadboard request (and a sleep) per candidate run_id.
+"""
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+import utility_functions
+
+
+class RunCache():
+
+    def __init__(self, bc, size=50, refresh_time=2, autostart=True):
+        """
+        Args:
+            - bc: BreadboardClient, see utility_functions.load_breadboard_client
+            - size: number of newest runs kept in the cache, fetched with a single request.
+            - refresh_time: seconds between background refreshes.
+        """
+        self.bc = bc
+        self.size = size
+        self.refresh_time = refresh_time
+        self.logger = logging.getLogger(__name__)
+        self._runs = OrderedDict()  # run_id: (runtime datetime, run_dict), newest first
+        self._updated = threading.Condition()
+        self._stop = threading.Event()
+        self.last_refresh_time = None
+        self.thread = None
+        if autostart:
+            self.start()
+
+    def start(self):
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._refresh_loop, name='run-cache', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except:
+                self.logger.error(sys.exc_info()[1])
+            self._stop.wait(self.refresh_time)
+
+    def refresh(self):
+        """Fetches the newest runs from breadboard and merges them into the cache. Returns the number of new run_ids."""
+        new_run_dicts = utility_functions.get_newest_runs(self.bc, limit=self.size)
+        with self._updated:
+            n_new = self.add_runs(new_run_dicts)
+            self.last_refresh_time = time.time()
+            self._updated.notify_all()
+        return n_new
+
+    def add_runs(self, run_dicts):
+        """Adds (or updates) run_dicts in the cache, dropping the oldest runs beyond size. Returns the number of new run_ids."""
+        with self._updated:
+            n_new = 0
+            runs = dict(self._runs)
+            for run_dict in run_dicts:
+                if run_dict['run_id'] not in runs:
+                    n_new += 1
+                runs[run_dict['run_id']] = (utility_functions.parse_runtime(run_dict['runtime']), run_dict)
+            self._runs = OrderedDict((run_id, runs[run_id])
+                                     for run_id in sorted(runs, reverse=True)[:self.size])
+        return n_new
+
+    def wait_for_update(self, timeout=None):
+        """Blocks until the next refresh finishes or timeout (in seconds) elapses."""
+        with self._updated:
+            return self._updated.wait(timeout)
+
+    def runs(self):
+        """Returns a list of (runtime, run_dict) tuples, newest first."""
+        return list(self._runs.values())
+
+    def get_run_dict(self, run_id):
+        run = self._runs.get(run_id)
+        return None if run is None else run[1]
+
+    def newest_run_dict(self, run_id_offset=0):
+        """Drop-in for utility_functions.get_newest_run_dict, answered from the cache if it holds enough runs."""
+        runs = self.runs()
+        if len(runs) <= abs(run_id_offset):
+            self.refresh()
+            runs = self.runs()
+        return runs[abs(run_id_offset)][1]
+
+    def find_run(self, file_time, min_time_diff_in_sec=0, max_time_diff_in_sec=10):
+        """Returns the newest cached run_dict with min_time_diff_in_sec < file_time - runtime < max_time_diff_in_sec,
+        or None if no cached run qualifies.
+
+        Args:
+            file_time: datetime object, e.g. the ctime of an image.
+        """
+        for runtime, run_dict in self.runs():
+            time_diff = (file_time - runtime).total_seconds()
+            if time_diff <= min_time_diff_in_sec:
+                continue  # run started after the image, look further back
+            if time_diff < max_time_diff_in_sec:
+                return run_dict
+            return None  # runs are newest first, so every remaining run is even older
+        return None
@@ -0,0 +1,310 @@
+"""A local run feed: one process polls breadboard and pushes new and updated runs to every subscriber.
+
+RunFeedServer polls the `size` newest fermi1 runs every refresh_time seconds with a single request and sends the runs
+that are new or whose parameters changed, as one line of JSON, to all subscribers connected to its local TCP socket.
+A new subscriber first receives all runs the server holds, and every subscriber receives a heartbeat line every
+heartbeat_interval seconds, so it can tell a quiet feed from a dead one. Every subscriber has its own send queue and
+thread, so a slow subscriber never delays the others, and one whose queue fills up is disconnected.
+
+utility_functions.get_newest_runs (and so get_newest_run_dict, get_newest_value and RunCache) and
+utility_functions.get_runs_since read from the feed whenever a server is running on this machine and the requested
+runs are within its window, and fall back to asking breadboard themselves otherwise. The load on breadboard then stays the same however many watchdogs, analysis loggers and
+instrument monitors are running, and they all see a new run at the same time.
+
+Usage:
+    python run_feed.py
+"""
+import sys
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+from datetime import datetime
+
+RUN_FEED_HOST = '127.0.0.1'
+RUN_FEED_PORT = 48051
+# seconds between attempts of get_newest_runs to connect to a run feed that was not running
+RECONNECT_TIME = 10
+# lines queued for a subscriber before it is considered stuck and disconnected
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class _Subscriber():
+    """A connected subscriber of a RunFeedServer, with its own send queue drained by its own thread."""
+
+    def __init__(self, sock, logger):
+        self.sock = sock
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.connected = True
+        self.thread = threading.Thread(target=self._send_loop, name='run-feed-subscriber', daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        """Queues message for sending without blocking. Returns False if the subscriber is gone or stuck."""
+        if not self.connected:
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.close()
+            return False
+        return True
+
+    def _send_loop(self):
+        while self.connected:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.sock.sendall(message)
+            except OSError:
+                break
+        self.connected = False
+        self.sock.close()
+
+    def close(self):
+        self.connected = False
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.sock.close()  # unblocks sendall, the send loop then exits
+
+
+class RunFeedServer():
+
+    def __init__(self, bc, host=RUN_FEED_HOST, port=RUN_FEED_PORT, size=50, refresh_time=0.5, heartbeat_interval=2,
+                 send_timeout=1):
+        """
+        Args:
+            - bc: BreadboardClient, see utility_functions.load_breadboard_client
+            - host, port: local address subscribers connect to.
+            - size: number of newest runs polled and held by the feed.
+            - refresh_time: seconds between breadboard polls.
+            - heartbeat_interval: seconds between lines sent to subscribers when no run changed.
+            - send_timeout: subscribers not taking a line within send_timeout seconds, or falling
+                SUBSCRIBER_QUEUE_SIZE lines behind, are disconnected. They reconnect and receive all runs again.
+        """
+        self.bc = bc
+        self.host = host
+        self.port = port
+        self.size = size
+        self.refresh_time = refresh_time
+        self.heartbeat_interval = heartbeat_interval
+        self.send_timeout = send_timeout
+        self.logger = logging.getLogger(__name__)
+        self.runs = {}  # run_id: run_dict
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.server_socket = None
+        self.threads = []
+        self.last_send_time = 0
+
+    def start(self):
+        self._stop.clear()
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # a restarted server can bind while connections of the previous one are in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen()
+        for target, name in [(self._accept_loop, 'run-feed-accept'), (self._poll_loop, 'run-feed-poll')]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)  # wakes up the accept loop, close alone does not
+        except OSError:
+            pass
+        self.server_socket.close()
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+            self.subscribers = []
+
+    def _message(self, run_dicts):
+        return (json.dumps({'time': time.time(), 'size': self.size, 'run_dicts': run_dicts}) + '\n').encode()
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                subscriber, _ = self.server_socket.accept()
+            except OSError:  # the socket was closed by stop
+                break
+            subscriber.settimeout(self.send_timeout)
+            subscriber = _Subscriber(subscriber, self.logger)
+            with self.lock:
+                # queued under the lock, so the subscriber gets all runs before any later update
+                run_dicts = [self.runs[run_id] for run_id in sorted(self.runs)]
+                if not subscriber.put(self._message(run_dicts)):
+                    continue
+                self.subscribers.append(subscriber)
+            self.logger.debug('run feed subscriber connected, {n} in total'.format(n=str(len(self.subscribers))))
+
+    def _poll_loop(self):
+        import utility_functions
+        while not self._stop.is_set():
+            try:
+                new_run_dicts = utility_functions.get_newest_runs(self.bc, limit=self.size, use_run_feed=False)
+                self.update(new_run_dicts)
+            except:
+                self.logger.error(sys.exc_info()[1])
+            if time.time() - self.last_send_time > self.heartbeat_interval:
+                self.broadcast([])
+            self._stop.wait(self.refresh_time)
+
+    def update(self, new_run_dicts):
+        """Merges polled run dicts into the feed and sends the new and changed ones to all subscribers, oldest first.
+        Returns the number of runs sent."""
+        with self.lock:
+            changed_run_dicts = [run_dict for run_dict in new_run_dicts
+                                 if self.runs.get(run_dict['run_id']) != run_dict]
+            for run_dict in changed_run_dicts:
+                self.runs[run_dict['run_id']] = run_dict
+            for run_id in sorted(self.runs)[:-self.size]:
+                del self.runs[run_id]
+        if len(changed_run_dicts) > 0:
+            self.broadcast(sorted(changed_run_dicts, key=lambda run_dict: run_dict['run_id']))
+        return len(changed_run_dicts)
+
+    def broadcast(self, run_dicts):
+        """Queues run_dicts for all subscribers, without waiting for any of them."""
+        message = self._message(run_dicts)
+        with self.lock:
+            for subscriber in list(self.subscribers):
+                if not subscriber.put(message):
+                    self.subscribers.remove(subscriber)
+                    self.logger.debug('run feed subscriber disconnected')
+            self.last_send_time = time.time()
+
+
+class RunFeedClient():
+    """RunFeedClient subscribes to a RunFeedServer and keeps its window of runs up to date in a background thread."""
+
+    def __init__(self, host=RUN_FEED_HOST, port=RUN_FEED_PORT, connect_timeout=1, stale_time=10):
+        """
+        Args:
+            - host, port: address of the RunFeedServer.
+            - connect_timeout: seconds to wait for the connection and the first window of runs.
+            - stale_time: the feed is not live if nothing, not even a heartbeat, arrived for stale_time seconds.
+
+        Raises:
+            OSError if no run feed is running at host, port.
+        """
+        self.stale_time = stale_time
+        self.runs = {}  # run_id: run_dict
+        self.size = None
+        self.last_message_time = None
+        self.connected = True
+        self.lock = threading.Lock()
+        self._first_message = threading.Event()
+        self.sock = socket.create_connection((host, port), timeout=connect_timeout)
+        self.sock.settimeout(None)
+        self.thread = threading.Thread(target=self._receive_loop, name='run-feed-client', daemon=True)
+        self.thread.start()
+        self._first_message.wait(connect_timeout)
+
+    def _receive_loop(self):
+        try:
+            with self.sock.makefile('r') as lines:
+                for line in lines:
+                    message = json.loads(line)
+                    with self.lock:
+                        self.size = message['size']
+                        for run_dict in message['run_dicts']:
+                            self.runs[run_dict['run_id']] = run_dict
+                        for run_id in sorted(self.runs)[:-self.size]:
+                            del self.runs[run_id]
+                        self.last_message_time = time.time()
+                    self._first_message.set()
+        except (OSError, ValueError):
+            pass
+        self.connected = False
+
+    def is_live(self):
+        return (self.connected and self.last_message_time is not None
+                and time.time() - self.last_message_time < self.stale_time)
+
+    def newest_runs(self, limit=1, offset=0):
+        """Returns copies of the limit newest run dicts after skipping offset, newest first, or None if they are not
+        all within the window of the feed."""
+        with self.lock:
+            run_ids = sorted(self.runs, reverse=True)
+            if offset + limit > len(run_ids):
+                return None
+            return [dict(self.runs[run_id]) for run_id in run_ids[offset:offset + limit]]
+
+    def runs_since(self, start_time):
+        """Returns copies of the run dicts with runtime at or after start_time (a naive datetime, compared like
+        utility_functions.parse_runtime), newest first, or None if the window of the feed may not reach back to
+        start_time."""
+        with self.lock:
+            run_dicts = [self.runs[run_id] for run_id in sorted(self.runs, reverse=True)]
+            if self.size is None or (len(run_dicts) >= self.size and _runtime(run_dicts[-1]) >= start_time):
+                return None
+            return [dict(run_dict) for run_dict in run_dicts if _runtime(run_dict) >= start_time]
+
+    def close(self):
+        self.sock.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+_last_connect_time = None
+
+
+def get_client():
+    """Returns the RunFeedClient of this process, connecting to the local run feed if needed, or None if no run feed
+    is running. Connecting is retried at most every RECONNECT_TIME seconds."""
+    global _client, _last_connect_time
+    with _client_lock:
+        if _client is not None and _client.connected:
+            return _client
+        if _last_connect_time is not None and time.time() - _last_connect_time < RECONNECT_TIME:
+            return None
+        _last_connect_time = time.time()
+        try:
+            _client = RunFeedClient(RUN_FEED_HOST, RUN_FEED_PORT)
+        except OSError:
+            _client = None
+        return _client
+
+
+def _runtime(run_dict):
+    return datetime.strptime(run_dict['runtime'], "%Y-%m-%dT%H:%M:%SZ")
+
+
+def get_runs_since(start_time):
+    """Returns the run dicts with runtime at or after start_time from the local run feed, newest first, or None if no
+    live run feed holds them all."""
+    client = get_client()
+    if client is None or not client.is_live():
+        return None
+    return client.runs_since(start_time)
+
+
+def get_newest_runs(limit=1, offset=0):
+    """Returns the limit newest run dicts after skipping offset from the local run feed, newest first, or None if no
+    live run feed holds them."""
+    client = get_client()
+    if client is None or not client.is_live():
+        return None
+    return client.newest_runs(limit=limit, offset=offset)
+
+
+if __name__ == '__main__':
+    from utility_functions import load_breadboard_client
+    logging.basicConfig(level=logging.DEBUG)
+    server = RunFeedServer(load_breadboard_client())
+    server.start()
+    print('Run feed listening on {host}:{port}'.format(host=server.host, port=str(server.port)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,224 @@
+"""Matching of image arrival times to breadboard runtimes.
+
+assign_shots_to_runs matches a whole backlog of shots to a list of runs in one pass. Shots and runs are both in
+time order, so the assignment must preserve that order: a later shot can never belong to an earlier run.
+Among order-preserving assignments it picks the one where every shot is as close as possible after its run,
+leaving a shot unmatched (misplaced) only if no run fits in the allowed time window.
+
+The windows are calibrated for the arrival time (ctime) of the image files. ArrivalClock moves the camera timestamps
+of the images, which are more precise than the arrival times, onto that clock, and image_times times a batch of
+images by one clock only.
+"""
+import datetime
+from collections import deque
+
+
+def _to_seconds(time_value):
+    if isinstance(time_value, datetime.datetime):
+        return time_value.timestamp()
+    return float(time_value)
+
+
+def assign_shots_to_runs(shot_times, runtimes, min_time_diff_in_sec=0, max_time_diff_in_sec=10,
+                         expected_time_diff_in_sec=None):
+    """Order-preserving minimum-cost assignment of shots to runs.
+
+    A shot can only be matched to a run with min_time_diff_in_sec < shot_time - runtime < max_time_diff_in_sec.
+    Matching costs the distance of the time difference from expected_time_diff_in_sec (by default
+    min_time_diff_in_sec, i.e. the newest run before the shot is preferred), leaving a shot unmatched costs more
+    than any allowed match, and a run without a shot (e.g. the camera was not triggered) costs nothing.
+
+    Args:
+        shot_times: list of datetime objects (or epoch seconds), e.g. the arrival time of the first image of each shot,
+            see image_times.
+        runtimes: list of run datetime objects (or epoch seconds), see utility_functions.parse_runtime.
+        min_time_diff_in_sec, max_time_diff_in_sec: allowed window for shot_time - runtime.
+        expected_time_diff_in_sec: typical shot_time - runtime, e.g. from OffsetEstimator.time_diff_in_sec.
+
+    Returns:
+        list with, for each shot, the index into runtimes of its run, or None if the shot is unmatched.
+    """
+    shot_order = sorted(range(len(shot_times)), key=lambda idx: _to_seconds(shot_times[idx]))
+    run_order = sorted(range(len(runtimes)), key=lambda idx: _to_seconds(runtimes[idx]))
+    shot_seconds = [_to_seconds(shot_times[idx]) for idx in shot_order]
+    run_seconds = [_to_seconds(runtimes[idx]) for idx in run_order]
+    n_shots, n_runs = len(shot_seconds), len(run_seconds)
+    if expected_time_diff_in_sec is None:
+        expected_time_diff_in_sec = min_time_diff_in_sec
+    unmatched_cost = max_time_diff_in_sec - min_time_diff_in_sec + 1
+    # cost[i][j]: cheapest assignment of the first i shots to the first j runs; step[i][j] records the choice
+    cost = [[0.0] * (n_runs + 1) for _ in range(n_shots + 1)]
+    step = [[None] * (n_runs + 1) for _ in range(n_shots + 1)]
+    for i in range(1, n_shots + 1):
+        cost[i][0] = cost[i - 1][0] + unmatched_cost
+        step[i][0] = 'skip_shot'
+    for j in range(1, n_runs + 1):
+        step[0][j] = 'skip_run'
+    for i in range(1, n_shots + 1):
+        for j in range(1, n_runs + 1):
+            best_cost, best_step = cost[i - 1][j] + unmatched_cost, 'skip_shot'
+            if cost[i][j - 1] <= best_cost:
+                best_cost, best_step = cost[i][j - 1], 'skip_run'
+            time_diff = shot_seconds[i - 1] - run_seconds[j - 1]
+            if min_time_diff_in_sec < time_diff < max_time_diff_in_sec:
+                match_cost = cost[i - 1][j - 1] + abs(time_diff - expected_time_diff_in_sec)
+                if match_cost <= best_cost:
+                    best_cost, best_step = match_cost, 'match'
+            cost[i][j], step[i][j] = best_cost, best_step
+    assignment = [None] * n_shots
+    i, j = n_shots, n_runs
+    while i > 0:
+        if step[i][j] == 'match':
+            assignment[shot_order[i - 1]] = run_order[j - 1]
+            i, j = i - 1, j - 1
+        elif step[i][j] == 'skip_run':
+            j -= 1
+        else:
+            i -= 1
+    return assignment
+
+
+class ArrivalClock():
+    """ArrivalClock learns the latency from the start of an exposure (the camera time of an image) to the arrival of
+    its file (the ctime), i.e. the exposure, readout and write of the image, from images with both times.
+
+    The default [min_time_diff_in_sec, max_time_diff_in_sec] windows of the watchdog are calibrated for the delay from
+    runtime to arrival, so on the camera clock they are [min_time_diff_in_sec - latency, max_time_diff_in_sec - latency].
+    arrival_time() applies this by moving camera times onto the arrival clock instead, which keeps the precision and
+    order of the camera times, the windows and the delays learned by OffsetEstimator valid for shots timed by either
+    clock. The latency is the median of the newest max_samples images, as the arrival of single files jitters.
+    """
+
+    def __init__(self, max_samples=50):
+        self.latencies = deque(maxlen=max_samples)
+
+    def update(self, camera_time, arrival_time):
+        """Adds the times of one image."""
+        self.latencies.append(_to_seconds(arrival_time) - _to_seconds(camera_time))
+
+    def latency_in_sec(self):
+        """Returns the median latency from camera time to arrival, or None before any image was added."""
+        if len(self.latencies) == 0:
+            return None
+        return _median(self.latencies)
+
+    def arrival_time(self, camera_time):
+        """Returns camera_time on the arrival clock. Needs at least one update."""
+        return camera_time + datetime.timedelta(seconds=self.latency_in_sec())
+
+
+def image_times(camera_times, arrival_times, arrival_clock):
+    """Times a batch of images by one clock, so that their times can be compared.
+
+    Args:
+        - camera_times: camera times of the images (see spe_file.spe_camera_time), None for images without one.
+        - arrival_times: arrival times (ctime) of the same images.
+        - arrival_clock: ArrivalClock, updated with the images.
+
+    Returns:
+        list of the times of the images on the arrival clock: the camera times moved by arrival_clock if every image
+        has one, else the arrival times.
+    """
+    if len(camera_times) == 0 or any(camera_time is None for camera_time in camera_times):
+        return list(arrival_times)
+    for camera_time, arrival_time in zip(camera_times, arrival_times):
+        arrival_clock.update(camera_time, arrival_time)
+    return [arrival_clock.arrival_time(camera_time) for camera_time in camera_times]
+
+
+class OffsetEstimator():
+    """OffsetEstimator learns the delay between breadboard runtime and image arrival, and the experimental cycle
+    period, from confirmed matches.
+
+    The delay drifts with sequence length and PC clock skew, so only the newest max_samples matches are used.
+    window() tightens the fixed [min_time_diff_in_sec, max_time_diff_in_sec] acceptance window around the learned
+    delay, and predict_run_id() extrapolates which run an image belongs to, even if that run is newer than the
+    newest run fetched from breadboard so far.
+    """
+
+    def __init__(self, min_time_diff_in_sec=0, max_time_diff_in_sec=10, max_samples=50, min_samples=5,
+                 n_sigma=5, min_half_width_in_sec=1, max_consecutive_misses=3):
+        """
+        Args:
+            - min_time_diff_in_sec, max_time_diff_in_sec: fixed window, used until min_samples matches are confirmed.
+                The learned window never extends beyond it.
+            - max_samples: number of most recent matches used for the estimates.
+            - n_sigma: half width of the learned window in robust standard deviations of the delay...
+            - min_half_width_in_sec: ...but at least this many seconds.
+            - max_consecutive_misses: the learned estimates are discarded after this many unmatched shots in a row,
+                e.g. after the sequence length changed, and relearned in the fixed window.
+        """
+        self.min_time_diff_in_sec = min_time_diff_in_sec
+        self.max_time_diff_in_sec = max_time_diff_in_sec
+        self.min_samples = min_samples
+        self.n_sigma = n_sigma
+        self.min_half_width_in_sec = min_half_width_in_sec
+        self.time_diffs = deque(maxlen=max_samples)
+        self.cycle_periods = deque(maxlen=max_samples)
+        self.last_match = None  # (run_id, runtime in seconds)
+        self.max_consecutive_misses = max_consecutive_misses
+        self.consecutive_misses = 0
+
+    def update(self, shot_time, runtime, run_id):
+        """Adds a confirmed match of a shot arriving at shot_time to run run_id started at runtime."""
+        shot_seconds, run_seconds = _to_seconds(shot_time), _to_seconds(runtime)
+        self.time_diffs.append(shot_seconds - run_seconds)
+        if self.last_match is not None and run_id > self.last_match[0]:
+            self.cycle_periods.append((run_seconds - self.last_match[1]) / (run_id - self.last_match[0]))
+        self.last_match = (run_id, run_seconds)
+        self.consecutive_misses = 0
+
+    def report_miss(self):
+        """Records a shot which could not be matched in window()."""
+        self.consecutive_misses += 1
+        if self.consecutive_misses >= self.max_consecutive_misses:
+            self.reset()
+
+    def reset(self):
+        self.time_diffs.clear()
+        self.cycle_periods.clear()
+        self.last_match = None
+        self.consecutive_misses = 0
+
+    def is_trained(self):
+        return len(self.time_diffs) >= self.min_samples
+
+    def time_diff_in_sec(self):
+        """Returns the median delay between runtime and image arrival, or None before training."""
+        if not self.is_trained():
+            return None
+        return _median(self.time_diffs)
+
+    def cycle_period_in_sec(self):
+        """Returns the median time between consecutive runs, or None before any has been observed."""
+        if len(self.cycle_periods) == 0:
+            return None
+        return _median(self.cycle_periods)
+
+    def window(self):
+        """Returns the (min_time_diff_in_sec, max_time_diff_in_sec) acceptance window for shot_time - runtime."""
+        if not self.is_trained():
+            return self.min_time_diff_in_sec, self.max_time_diff_in_sec
+        median = _median(self.time_diffs)
+        # the median absolute deviation scaled to a standard deviation is robust against mismatched outliers
+        sigma = 1.4826 * _median([abs(time_diff - median) for time_diff in self.time_diffs])
+        half_width = max(self.n_sigma * sigma, self.min_half_width_in_sec)
+        return (max(median - half_width, self.min_time_diff_in_sec),
+                min(median + half_width, self.max_time_diff_in_sec))
+
+    def predict_run_id(self, shot_time, newest_runtime, newest_run_id):
+        """Extrapolates the run_id of a shot from the newest known run, or returns None before training.
+        A prediction larger than newest_run_id means the shot belongs to a run not fetched from breadboard yet."""
+        time_diff, cycle_period = self.time_diff_in_sec(), self.cycle_period_in_sec()
+        if time_diff is None or cycle_period is None or cycle_period <= 0:
+            return None
+        expected_runtime = _to_seconds(shot_time) - time_diff
+        return newest_run_id + int(round((expected_runtime - _to_seconds(newest_runtime)) / cycle_period))
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
@@ -0,0 +1,261 @@
+"""A local sqlite mirror of the fermi1 runs on breadboard.
+
+The mirror keeps the JSON of every run it has seen, keyed by run_id. sync() pages through the newest runs only down to
+the newest mirrored run_id, plus a trailing resync_window of runs that are re-fetched to pick up later edits (analysis
+results, instrument readouts, badshot and notes), since breadboard does not report when a run was last updated. Runs
+older than the mirror are fetched when first asked for, and again when asked for more than max_age seconds after they
+were fetched, so edits to older runs (e.g. notes, late readouts or images re-matched by rematch_misplaced.py) reach the
+mirror too; refresh() re-fetches runs right away, e.g. when a run folder is loaded in log_editor.py. DataFrames of a run
+folder (see utility_functions.get_newest_df) or of a parameter query are then built from the local file, without a
+request per run.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import datetime
+import threading
+from json import JSONDecodeError
+import numpy as np
+import pandas as pd
+from utility_functions import page_back_runs
+
+_SCHEMA = ["""CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    runtime TEXT NOT NULL,
+    run_json TEXT NOT NULL,
+    synced REAL NOT NULL)""",
+           "CREATE INDEX IF NOT EXISTS runs_runtime ON runs (runtime)"]
+# sqlite limit on the number of ? in a statement
+MAX_QUERY_VARIABLES = 900
+
+
+def analyzed_var_names():
+    """Returns the names of all preliminary analysis results uploaded by AnalysisLogger, see matlab_wrapper.py."""
+    from matlab_wrapper import (ycam_analyzed_var_names, dual_imaging_analyzed_var_names,
+                                triple_imaging_analyzed_var_names)
+    return ycam_analyzed_var_names + dual_imaging_analyzed_var_names + triple_imaging_analyzed_var_names
+
+
+def run_row(run_dict, column_names=None, analysis_names=()):
+    """Flattens a run as returned by the breadboard API into a DataFrame row of run_id, runtime, notes, badshot,
+    the manual_ parameters, the list-bound variables, those of analysis_names present and column_names (nan if the
+    run does not have them)."""
+    parameters = run_dict['parameters']
+    row = {'run_id': run_dict['id'],
+           'runtime': run_dict['runtime'],
+           'notes': run_dict.get('notes'),
+           'badshot': bool(parameters.get('badshot', False))}
+    default_names = ([name for name in parameters if 'manual' in name] + list(parameters.get('ListBoundVariables', []))
+                     + [name for name in analysis_names if name in parameters])
+    for name in default_names + list(column_names or []):
+        if name not in row:
+            row[name] = parameters.get(name, np.nan)
+    return row
+
+
+def runtime_key(time):
+    """Returns the YYYY-MM-DDTHH:MM:SS prefix of the breadboard runtime equal to the datetime time, to compare runtimes
+    as strings. A naive time is taken as is, as utility_functions.parse_runtime reads runtimes, and an aware one is
+    converted to UTC, the zone of the runtime suffix Z."""
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class RunMirror():
+
+    def __init__(self, bc, db_path=os.path.join(os.path.dirname(__file__), 'run_mirror.sqlite'), page_size=200,
+                 resync_window=200, min_sync_interval=2, max_retries=10, max_age=10 * 60):
+        """
+        Args:
+            - bc: BreadboardClient, see utility_functions.load_breadboard_client
+            - db_path: sqlite file holding the mirror.
+            - page_size: runs fetched per request.
+            - resync_window: number of newest runs re-fetched on every sync to pick up edits.
+            - min_sync_interval: sync() returns without a request if the last sync is more recent than this.
+            - max_age: seconds after which get_runs_df re-fetches a mirrored run, to pick up edits to runs older than
+                the resync_window. None keeps mirrored runs until they are refreshed.
+        """
+        self.bc = bc
+        self.db_path = db_path
+        self.page_size = page_size
+        self.resync_window = resync_window
+        self.min_sync_interval = min_sync_interval
+        self.max_retries = max_retries
+        self.max_age = max_age
+        self.logger = logging.getLogger(__name__)
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.last_sync_time = None
+        self.not_found_ids = set()
+        with self.conn:
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+
+    def _get(self, path, params=None):
+        """Sends a get request to breadboard, retrying on errors, and returns the decoded JSON."""
+        for _ in range(self.max_retries):
+            try:
+                resp = self.bc._send_message('get', path, params=params)
+                if resp.status_code == 200:
+                    return resp.json()
+            except JSONDecodeError:
+                pass
+            time.sleep(0.3)
+        raise IOError('breadboard get {path} failed {n} times'.format(path=path, n=str(self.max_retries)))
+
+    def _get_page(self, limit, offset):
+        return self._get('/runs/', params={'lab': 'fermi1', 'limit': limit, 'offset': offset})['results']
+
+    def store(self, run_dicts):
+        """Writes run dicts as returned by the breadboard API, e.g. after editing them, into the mirror."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO runs (run_id, runtime, run_json, synced) VALUES (?, ?, ?, ?)",
+                                  [(run_dict['id'], run_dict['runtime'], json.dumps(run_dict), now)
+                                   for run_dict in run_dicts])
+
+    def newest_run_id(self):
+        with self.lock:
+            return self.conn.execute("SELECT MAX(run_id) FROM runs").fetchone()[0]
+
+    def sync(self, force=False):
+        """Fetches the runs newer than the newest mirrored run, and the resync_window newest runs. Returns the number
+        of runs fetched."""
+        if not force and self.last_sync_time is not None and time.time() - self.last_sync_time < self.min_sync_interval:
+            return 0
+        newest_run_id = self.newest_run_id()
+        run_dicts = []
+        for run_dict in page_back_runs(self._get_page, self.page_size, id_key='id'):
+            # an empty mirror starts from the resync_window newest runs, older runs are fetched when asked for
+            if (newest_run_id is None or run_dict['id'] <= newest_run_id) and len(run_dicts) >= self.resync_window:
+                break
+            run_dicts.append(run_dict)
+        self.store(run_dicts)
+        self.last_sync_time = time.time()
+        self.logger.debug('synced {n} runs from breadboard'.format(n=str(len(run_dicts))))
+        return len(run_dicts)
+
+    def fetch_missing(self, run_ids, max_age=None):
+        """Fetches the run_ids not in the mirror, or fetched more than max_age seconds ago (None for never). They are
+        fetched by paging from the newest run down to the oldest of them if that may take fewer requests than one per
+        run, and otherwise (or for the runs still missing after that many pages) with one request per run. Returns the
+        run_ids not found on breadboard."""
+        run_ids = set(int(run_id) for run_id in run_ids).difference(self.not_found_ids)
+        missing_ids = run_ids.difference(self._stored_ids(run_ids, max_age))
+        if len(missing_ids) == 0:
+            return []
+        oldest_id = min(missing_ids)
+        # breadboard holds at least the mirrored runs newer than oldest_id, so paging down to it from the newest run
+        # (the only offset known exactly) takes at least this many pages
+        with self.lock:
+            n_newer_runs = self.conn.execute("SELECT COUNT(*) FROM runs WHERE run_id > ?", (oldest_id,)).fetchone()[0]
+        if n_newer_runs // self.page_size + 1 < len(missing_ids):
+            max_runs = len(missing_ids) * self.page_size  # at most one page per missing run
+            run_dicts = []
+            try:
+                for run_dict in page_back_runs(self._get_page, self.page_size, id_key='id'):
+                    run_dicts.append(run_dict)
+                    missing_ids.discard(run_dict['id'])
+                    if len(missing_ids) == 0 or run_dict['id'] <= oldest_id or len(run_dicts) >= max_runs:
+                        break
+            finally:
+                self.store(run_dicts)
+        for run_id in sorted(missing_ids):
+            try:
+                self.store([self._get('/runs/' + str(run_id) + '/')])
+            except IOError:
+                self.logger.warning('run_id {id} not found on breadboard'.format(id=str(run_id)))
+                self.not_found_ids.add(run_id)
+        return sorted(missing_ids.intersection(self.not_found_ids))
+
+    def refresh(self, run_ids):
+        """Re-fetches run_ids from breadboard, e.g. to show edits made elsewhere. Returns the run_ids not found."""
+        return self.fetch_missing(run_ids, max_age=0)
+
+    def _stored_ids(self, run_ids, max_age=None):
+        """Returns the run_ids in the mirror, only those fetched within the last max_age seconds unless it is None."""
+        run_ids = [int(run_id) for run_id in run_ids]
+        min_synced = -1 if max_age is None else time.time() - max_age
+        stored_ids = set()
+        with self.lock:
+            for idx in range(0, len(run_ids), MAX_QUERY_VARIABLES):
+                chunk = run_ids[idx:idx + MAX_QUERY_VARIABLES]
+                stored_ids.update(row[0] for row in self.conn.execute(
+                    "SELECT run_id FROM runs WHERE synced > ? AND run_id IN ({marks})".format(
+                        marks=','.join('?' * len(chunk))), [min_synced] + chunk))
+        return stored_ids
+
+    def get_run_dicts(self, run_ids):
+        """Returns the mirrored run dicts of run_ids, in the order of run_ids, skipping those not in the mirror."""
+        run_ids = [int(run_id) for run_id in run_ids]
+        run_dicts = {}
+        with self.lock:
+            for idx in range(0, len(run_ids), MAX_QUERY_VARIABLES):
+                chunk = run_ids[idx:idx + MAX_QUERY_VARIABLES]
+                for run_id, run_json in self.conn.execute(
+                        "SELECT run_id, run_json FROM runs WHERE run_id IN ({marks})".format(
+                            marks=','.join('?' * len(chunk))), chunk):
+                    run_dicts[run_id] = json.loads(run_json)
+        return [run_dicts[run_id] for run_id in run_ids if run_id in run_dicts]
+
+    def get_runs_df(self, run_ids, optional_column_names=[], sync=True, max_age=None):
+        """Returns a DataFrame of run_ids (see run_row), syncing the mirror and fetching runs not in it or fetched more
+        than max_age seconds ago (by default self.max_age, 0 to re-fetch all) first."""
+        if sync:
+            try:
+                self.sync()
+            except:
+                self.logger.error(sys.exc_info()[1])
+            self.fetch_missing(run_ids, self.max_age if max_age is None else max_age)
+        return self._runs_df(self.get_run_dicts(run_ids), optional_column_names)
+
+    def query_df(self, parameters={}, start_time=None, end_time=None, column_names=[], sync=True):
+        """Returns a DataFrame (see run_row) of the mirrored runs with runtime within [start_time, end_time]
+        (datetime objects, None for no limit, see runtime_key) and the given parameter values, e.g. {'seqMode': 2}."""
+        if sync:
+            self.sync()
+        conditions, values = [], []
+        if start_time is not None:
+            conditions.append('substr(runtime, 1, 19) >= ?')
+            values.append(runtime_key(start_time))
+        if end_time is not None:
+            conditions.append('substr(runtime, 1, 19) <= ?')
+            values.append(runtime_key(end_time))
+        statement = "SELECT run_json FROM runs"
+        if len(conditions) > 0:
+            statement += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            run_dicts = [json.loads(row[0]) for row in self.conn.execute(statement + " ORDER BY run_id", values)]
+        run_dicts = [run_dict for run_dict in run_dicts
+                     if all(run_dict['parameters'].get(name) == value for name, value in parameters.items())]
+        return self._runs_df(run_dicts, list(column_names) + list(parameters))
+
+    def _runs_df(self, run_dicts, column_names):
+        analysis_names = analyzed_var_names()
+        rows = [run_row(run_dict, column_names, analysis_names) for run_dict in run_dicts]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=['run_id', 'runtime', 'notes', 'badshot'] + list(column_names))
+        return pd.DataFrame(rows)
+
+    def close(self):
+        self.conn.close()
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror(bc=None):
+    """Returns the RunMirror of this process, creating it with bc (by default a new BreadboardClient) if needed."""
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            if bc is None:
+                from utility_functions import load_breadboard_client
+                bc = load_breadboard_client()
+            _mirror = RunMirror(bc)
+        return _mirror
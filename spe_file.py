@@ -0,0 +1,294 @@
+"""Fast readers for Princeton Instruments / LightField .spe files.
+
+read_spe_header reads only the 4100 byte binary header, the SPE 3.x XML footer and the few bytes of per-frame
+metadata, never the pixel data. Besides the frame geometry and exposure it returns the acquisition start time and,
+if LightField was set to record them, the hardware exposure timestamps and frame tracking numbers of every frame.
+These are far more precise than the filesystem ctime of an image, which moves with copy latency and antivirus scans.
+read_spe_frames reads the pixel data of all frames into a numpy array in a single read. SpeFile instead memory-maps
+the data block, so frames and regions of interest are numpy views and only the pixels actually used are read from
+disk, and SpeRunStack stacks the images of a whole run folder lazily, e.g. for slicing thousands of shots in a notebook.
+"""
+import os
+import re
+import struct
+import datetime
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from collections import OrderedDict
+
+HEADER_SIZE = 4100
+# (offset, struct format) of the header fields used here, see the SPE 3.0 File Format Specification
+HEADER_FIELDS = {'exposure_sec': (10, '<f'),
+                 'date': (20, '10s'),
+                 'xdim': (42, '<H'),
+                 'datatype': (108, '<h'),
+                 'time_local': (172, '7s'),
+                 'time_utc': (179, '7s'),
+                 'ydim': (656, '<H'),
+                 'xml_offset': (678, '<Q'),
+                 'num_frames': (1446, '<i'),
+                 'file_header_ver': (1992, '<f')}
+# header datatype: (numpy dtype string, bytes per pixel)
+DATATYPES = {0: ('<f4', 4), 1: ('<i4', 4), 2: ('<i2', 2), 3: ('<u2', 2), 5: ('<f8', 8), 6: ('<u1', 1), 8: ('<u4', 4)}
+# SPE 3.x pixelFormat: header datatype
+PIXEL_FORMATS = {'MonochromeUnsigned16': 3, 'MonochromeUnsigned32': 8, 'MonochromeFloating32': 0}
+
+
+def _strip_namespace(tag):
+    return tag.split('}', 1)[-1]
+
+
+def _find(element, tag):
+    """Returns the first descendant of element with tag, ignoring XML namespaces, or None."""
+    descendants = _findall(element, tag)
+    return descendants[0] if len(descendants) > 0 else None
+
+
+def _findall(element, tag):
+    return [child for child in element.iter() if child is not element and _strip_namespace(child.tag) == tag]
+
+
+def parse_spe_datetime(datetime_str):
+    """Parses a LightField timestamp, e.g. 2021-10-04T16:04:53.3454578-04:00, to a naive local datetime object
+    comparable with datetime.datetime.fromtimestamp(os.stat(...).st_ctime)."""
+    match = re.match(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:\d{2})?$', datetime_str.strip())
+    if match is None:
+        raise ValueError('Unrecognized SPE timestamp ' + datetime_str)
+    seconds, fraction, zone = match.groups()
+    timestamp = datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if fraction is not None:
+        timestamp += datetime.timedelta(microseconds=round(float(fraction) * 1e6))
+    if zone is None:
+        return timestamp
+    if zone == 'Z':
+        offset = datetime.timedelta(0)
+    else:
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6])) * (1 if zone[0] == '+' else -1)
+    timestamp = timestamp.replace(tzinfo=datetime.timezone(offset))
+    return timestamp.astimezone().replace(tzinfo=None)
+
+
+def read_spe_header(filepath, read_frame_metadata=True):
+    """Reads the header, XML footer and per-frame metadata of an .spe file without reading any pixel data.
+
+    Returns:
+        dict with keys
+            xdim, ydim, num_frames, datatype, dtype, exposure_sec, file_header_ver: from the binary header,
+            data_offset, frame_size, frame_stride: byte offset of the first frame, bytes of pixel data per frame and
+                bytes from one frame to the next (pixel data plus metadata),
+            xml_offset: byte offset of the SPE 3.x XML footer, 0 for SPE 2.x files,
+            acquisition_time: naive local datetime of the start of the acquisition, or None,
+            frame_timestamps: list with the exposure start of every frame as naive local datetimes, or None,
+            frame_tracking_numbers: list with the camera frame counter of every frame, or None.
+    """
+    with open(filepath, 'rb') as file:
+        header_bytes = file.read(HEADER_SIZE)
+        if len(header_bytes) < HEADER_SIZE:
+            raise ValueError('{file} is shorter than an SPE header.'.format(file=filepath))
+        header = {}
+        for key, (offset, fmt) in HEADER_FIELDS.items():
+            header[key] = struct.unpack_from(fmt, header_bytes, offset)[0]
+        for key in ['date', 'time_local', 'time_utc']:
+            header[key] = header[key].split(b'\0', 1)[0].decode('ascii', errors='ignore')
+        header['data_offset'] = HEADER_SIZE
+        header['acquisition_time'] = None
+        header['frame_timestamps'] = None
+        header['frame_tracking_numbers'] = None
+        metadata_entries = []
+        if header['file_header_ver'] >= 3 and header['xml_offset'] > 0:
+            file.seek(header['xml_offset'])
+            footer = ElementTree.fromstring(file.read())
+            data_block = _find(footer, 'DataBlock')
+            region = _find(data_block, 'DataBlock') if data_block is not None else None
+            if data_block is not None:
+                header['num_frames'] = int(data_block.get('count', header['num_frames']))
+                header['datatype'] = PIXEL_FORMATS.get(data_block.get('pixelFormat'), header['datatype'])
+            if region is not None:
+                header['xdim'] = int(region.get('width', header['xdim']))
+                header['ydim'] = int(region.get('height', header['ydim']))
+            if data_block is not None and data_block.get('stride') is not None:
+                header['frame_stride'] = int(data_block.get('stride'))
+                header['frame_size'] = int(data_block.get('size'))
+            origin = _find(footer, 'Origin')
+            if origin is not None and origin.get('created') is not None:
+                header['acquisition_time'] = parse_spe_datetime(origin.get('created'))
+            exposure_time = _find(footer, 'ExposureTime')
+            if exposure_time is not None and exposure_time.text is not None:
+                header['exposure_sec'] = float(exposure_time.text) / 1000  # LightField exposure is in ms
+            # LightField writes the per-frame metadata as the child elements of a MetaBlock, e.g.
+            # <MetaBlock id="1"><TimeStamp event="ExposureStarted" .../><FrameTrackingNumber .../></MetaBlock>
+            metadata_entries = [entry for block in _findall(footer, 'MetaBlock') for entry in block]
+        elif len(header['date']) > 0 and len(header['time_local']) == 6:
+            try:
+                header['acquisition_time'] = datetime.datetime.strptime(header['date'] + header['time_local'],
+                                                                        '%d%b%Y%H%M%S')
+            except ValueError:
+                pass
+        header['dtype'], bytes_per_pixel = DATATYPES[header['datatype']]
+        if 'frame_size' not in header:
+            header['frame_size'] = header['xdim'] * header['ydim'] * bytes_per_pixel
+            header['frame_stride'] = header['frame_size']
+        if read_frame_metadata and len(metadata_entries) > 0:
+            _read_frame_metadata(file, header, metadata_entries)
+    return header
+
+
+def _read_frame_metadata(file, header, metadata_entries):
+    """Reads the metadata LightField appends to the pixel data of every frame, one value per entry of the MetaBlock:
+    exposure timestamps (in ticks of 1/resolution seconds since the absoluteTime of the TimeStamp entry, by default
+    the acquisition start) and frame tracking numbers."""
+    metadata_size = header['frame_stride'] - header['frame_size']
+    fmt = '<' + ''.join('q' if int(entry.get('bitDepth', 64)) == 64 else 'i' for entry in metadata_entries)
+    if struct.calcsize(fmt) > metadata_size:
+        return
+    timestamp_origin = header['acquisition_time']
+    for entry in metadata_entries:
+        if (_strip_namespace(entry.tag) == 'TimeStamp' and entry.get('event') == 'ExposureStarted'
+                and entry.get('absoluteTime') is not None):
+            timestamp_origin = parse_spe_datetime(entry.get('absoluteTime'))
+    timestamps, tracking_numbers = [], []
+    for frame_idx in range(header['num_frames']):
+        file.seek(header['data_offset'] + frame_idx * header['frame_stride'] + header['frame_size'])
+        values = struct.unpack(fmt, file.read(struct.calcsize(fmt)))
+        for entry, value in zip(metadata_entries, values):
+            tag = _strip_namespace(entry.tag)
+            if tag == 'TimeStamp' and entry.get('event') == 'ExposureStarted':
+                timestamps.append(value / float(entry.get('resolution', 1e6)))
+            elif tag == 'FrameTrackingNumber':
+                tracking_numbers.append(value)
+    if len(timestamps) == header['num_frames'] and timestamp_origin is not None:
+        header['frame_timestamps'] = [timestamp_origin + datetime.timedelta(seconds=seconds)
+                                      for seconds in timestamps]
+    if len(tracking_numbers) == header['num_frames']:
+        header['frame_tracking_numbers'] = tracking_numbers
+
+
+def spe_camera_time(filepath):
+    """Returns the camera time of the first exposure in an .spe file as a naive local datetime, or None if the
+    file holds no usable timestamp (e.g. it is still being written, or is not an .spe file)."""
+    try:
+        header = read_spe_header(filepath)
+    except Exception:
+        return None
+    if header['frame_timestamps'] is not None:
+        return header['frame_timestamps'][0]
+    return header['acquisition_time']
+
+
+def read_spe_frames(filepath, header=None):
+    """Reads all frames of an .spe file.
+
+    Args:
+        header: dict from read_spe_header, read from filepath if None.
+
+    Returns:
+        numpy array of shape (num_frames, ydim, xdim) with the dtype of the file.
+    """
+    if header is None:
+        header = read_spe_header(filepath, read_frame_metadata=False)
+    n_frames, stride, frame_size = header['num_frames'], header['frame_stride'], header['frame_size']
+    with open(filepath, 'rb') as file:
+        file.seek(header['data_offset'])
+        raw = np.fromfile(file, dtype=np.uint8, count=n_frames * stride)
+    if raw.size < n_frames * stride - (stride - frame_size):
+        raise ValueError('{file} holds less pixel data than its header announces.'.format(file=filepath))
+    raw = np.pad(raw, (0, n_frames * stride - raw.size))  # the metadata of the last frame may be cut off
+    pixels = raw.reshape(n_frames, stride)[:, :frame_size]
+    return pixels.copy().view(header['dtype']).reshape(n_frames, header['ydim'], header['xdim'])
+
+
+class SpeFile():
+    """Memory-mapped .spe file. frames is a zero-copy (num_frames, ydim, xdim) numpy view of the data block.
+
+    On Windows, a memory-mapped file cannot be moved or deleted until the SpeFile and all views into it are gone.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.header = read_spe_header(filepath)
+        header = self.header
+        itemsize = np.dtype(header['dtype']).itemsize
+        self._map = np.memmap(filepath, dtype=np.uint8, mode='r')
+        if self._map.size < header['data_offset'] + header['num_frames'] * header['frame_stride'] - (
+                header['frame_stride'] - header['frame_size']):
+            raise ValueError('{file} holds less pixel data than its header announces.'.format(file=filepath))
+        # consecutive frames are frame_stride bytes apart, as per-frame metadata can follow the pixels of a frame
+        self.frames = np.ndarray(shape=(header['num_frames'], header['ydim'], header['xdim']), dtype=header['dtype'],
+                                 buffer=self._map, offset=header['data_offset'],
+                                 strides=(header['frame_stride'], header['xdim'] * itemsize, itemsize))
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, key):
+        return self.frames[key]
+
+    def frame(self, frame_idx):
+        return self.frames[frame_idx]
+
+    def roi(self, rows, cols):
+        """Returns a (num_frames, len(rows), len(cols)) view of the region of interest given by two slices."""
+        return self.frames[:, rows, cols]
+
+    def close(self):
+        self.frames = None
+        self._map = None
+
+
+class SpeRunStack():
+    """Lazy (shots, frames, ydim, xdim) stack of the image_idx images of every run in a run folder, in run_id order.
+
+    Indexing with a single shot returns a view into one memory-mapped file; indexing several shots reads only the
+    selected shots and pixels, e.g. stack[:, 0, 100:150, 200:250] or stack[-20:].mean(axis=0). The newest
+    max_open_files files are kept mapped.
+    """
+
+    def __init__(self, runfolder, image_idx=0, max_open_files=64):
+        self.runfolder = runfolder
+        self.image_idx = image_idx
+        self.max_open_files = max_open_files
+        self._open_files = OrderedDict()
+        self.refresh()
+
+    def refresh(self):
+        """Re-lists the run folder, e.g. to include runs added since the stack was created."""
+        run_filepaths = {}
+        for filename in os.listdir(self.runfolder):
+            match = re.match(r'(\d+)_(\d+)\.spe$', filename)
+            if match is not None and int(match.group(2)) == self.image_idx:
+                run_filepaths[int(match.group(1))] = os.path.join(self.runfolder, filename)
+        self.run_ids = sorted(run_filepaths)
+        self.filepaths = [run_filepaths[run_id] for run_id in self.run_ids]
+
+    def spe_file(self, shot_idx):
+        filepath = self.filepaths[shot_idx]
+        if filepath in self._open_files:
+            self._open_files.move_to_end(filepath)
+        else:
+            self._open_files[filepath] = SpeFile(filepath)
+            if len(self._open_files) > self.max_open_files:
+                self._open_files.popitem(last=False)[1].close()
+        return self._open_files[filepath]
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    @property
+    def shape(self):
+        if len(self) == 0:
+            return (0,)
+        return (len(self),) + self.spe_file(-1).frames.shape
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        shot_key, frame_key = key[0], key[1:]
+        if isinstance(shot_key, (int, np.integer)):
+            return self.spe_file(shot_key).frames[frame_key]
+        shot_indices = range(len(self))[shot_key] if isinstance(shot_key, slice) else shot_key
+        return np.stack([np.asarray(self.spe_file(shot_idx).frames[frame_key]) for shot_idx in shot_indices])
+
+    def close(self):
+        for spe_file in self._open_files.values():
+            spe_file.close()
+        self._open_files.clear()
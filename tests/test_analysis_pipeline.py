@@ -0,0 +1,114 @@
+import time
+import random
+import threading
+from analysis_pipeline import Stage, Pipeline
+
+
+class Collector():
+    """Last stage of a test pipeline, recording the items in the order they arrive."""
+
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.items.append(item)
+        return item
+
+
+def slow_identity(item):
+    time.sleep(random.uniform(0, 0.01))
+    return item
+
+
+def test_ordered_stage_passes_items_on_in_the_order_they_were_fed():
+    collector = Collector()
+    pipeline = Pipeline([Stage('first', lambda item: item),
+                         Stage('analyze', slow_identity, n_workers=4, ordered=True),
+                         Stage('last', collector)])
+    pipeline.start()
+    run_ids = list(range(50, 0, -1))  # newest first, as the scheduler feeds them
+    for run_id in run_ids:
+        pipeline.put(run_id)
+    pipeline.stop()
+    assert collector.items == run_ids
+
+
+def test_dropped_items_do_not_block_an_ordered_stage():
+    collector = Collector()
+    pipeline = Pipeline([Stage('analyze', lambda item: None if item % 3 == 0 else slow_identity(item), n_workers=3,
+                               ordered=True),
+                         Stage('last', collector)])
+    pipeline.start()
+    for item in range(30):
+        pipeline.put(item)
+    pipeline.stop()
+    assert collector.items == [item for item in range(30) if item % 3 != 0]
+    assert pipeline.metrics()['analyze']['dropped'] == 10
+    assert pipeline.metrics()['analyze']['reorder_depth'] == 0
+
+
+def test_failing_item_is_counted_and_dropped():
+    def fail_on_two(item):
+        if item == 2:
+            raise ValueError('bad item')
+        return item
+    collector = Collector()
+    pipeline = Pipeline([Stage('analyze', fail_on_two, n_workers=2, ordered=True), Stage('last', collector)])
+    pipeline.start()
+    for item in range(5):
+        pipeline.put(item)
+    pipeline.stop()
+    assert collector.items == [0, 1, 3, 4]
+    assert pipeline.metrics()['analyze']['errors'] == 1
+
+
+class SettingsChain():
+    """Models AnalysisLogger.analyze_stage and release_analysis: every shot is analyzed with the settings released
+    last, and releasing a shot makes its settings the previous settings."""
+
+    def __init__(self):
+        self.previous_settings = 0
+        self.released = []
+
+    def analyze(self, run_id):
+        previous_settings = self.previous_settings
+        time.sleep(random.uniform(0, 0.005))
+        return {'run_id': run_id, 'analyzed_with': previous_settings, 'settings': run_id}
+
+    def release(self, shot):
+        self.previous_settings = shot['settings']
+        self.released.append(shot['run_id'])
+        return shot
+
+
+def slow_upload(shot):
+    time.sleep(0.01)
+    return shot
+
+
+def test_every_shot_is_analyzed_with_the_settings_of_the_shot_before():
+    chain = SettingsChain()
+    collector = Collector()
+    pipeline = Pipeline([Stage('analyze', chain.analyze, ordered=True, release=chain.release),
+                         Stage('upload', slow_upload, maxsize=1),
+                         Stage('last', collector)])
+    pipeline.start()
+    for run_id in range(1, 11):
+        pipeline.put(run_id)
+    pipeline.stop()
+    assert [(shot['run_id'], shot['analyzed_with']) for shot in collector.items] == \
+        [(run_id, run_id - 1) for run_id in range(1, 11)]
+
+
+def test_settings_are_released_in_the_feed_order_with_several_workers():
+    chain = SettingsChain()
+    pipeline = Pipeline([Stage('analyze', chain.analyze, n_workers=3, ordered=True, release=chain.release)])
+    pipeline.start()
+    run_ids = list(range(30, 0, -1))
+    for run_id in run_ids:
+        pipeline.put(run_id)
+    pipeline.stop()
+    assert chain.released == run_ids
+    assert chain.previous_settings == run_ids[-1]
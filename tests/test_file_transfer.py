@@ -0,0 +1,79 @@
+import os
+import shutil
+import pytest
+import file_transfer
+from file_transfer import copy_file, CHUNK_SIZE
+
+SIZE = 3 * CHUNK_SIZE + 5
+
+
+@pytest.fixture
+def source(tmp_path):
+    filepath = tmp_path / 'image.spe'
+    filepath.write_bytes(os.urandom(SIZE))
+    return filepath
+
+
+def use_copy_method(monkeypatch, method):
+    """Makes copy_file use method, 'copy_file_range', 'sendfile' or 'userspace'."""
+    monkeypatch.setattr(file_transfer, '_reflink', lambda source_file, destination_file: False)
+    if method == 'userspace':
+        monkeypatch.setattr(file_transfer, '_try_kernel_copy', lambda *args: None)
+        return
+    if not hasattr(os, method):
+        pytest.skip('os.{method} is not available'.format(method=method))
+    if method == 'sendfile':
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+
+
+def shrink_during_copy(monkeypatch, method, source):
+    """Truncates source after the copy with method started."""
+    if method == 'userspace':
+        copyfileobj = shutil.copyfileobj
+
+        def shrinking_copyfileobj(source_file, destination_file, length):
+            os.truncate(source, CHUNK_SIZE + 10)
+            copyfileobj(source_file, destination_file, length)
+        monkeypatch.setattr(shutil, 'copyfileobj', shrinking_copyfileobj)
+        return
+    kernel_copy = getattr(os, method)
+    calls = []
+
+    def shrinking_kernel_copy(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            os.truncate(source, CHUNK_SIZE + 10)
+        return kernel_copy(*args)
+    monkeypatch.setattr(os, method, shrinking_kernel_copy)
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', 'sendfile', 'userspace'])
+def test_copy(monkeypatch, tmp_path, source, method):
+    use_copy_method(monkeypatch, method)
+    destination = tmp_path / 'copy.spe'
+    stats = copy_file(str(source), str(destination))
+    assert stats['method'] == method
+    assert destination.read_bytes() == source.read_bytes()
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', 'sendfile', 'userspace'])
+def test_source_shrinking_during_the_copy_fails_it(monkeypatch, tmp_path, source, method):
+    use_copy_method(monkeypatch, method)
+    shrink_during_copy(monkeypatch, method, source)
+    with pytest.raises(IOError, match='changed size while copying'):
+        copy_file(str(source), str(tmp_path / 'copy.spe'))
+
+
+def test_resumed_copy(tmp_path, source):
+    destination = tmp_path / 'copy.spe'
+    destination.write_bytes(source.read_bytes()[:CHUNK_SIZE])
+    stats = copy_file(str(source), str(destination), offset=CHUNK_SIZE)
+    assert stats['bytes'] == SIZE - CHUNK_SIZE
+    assert destination.read_bytes() == source.read_bytes()
+
+
+def test_longer_previous_copy_is_truncated(tmp_path, source):
+    destination = tmp_path / 'copy.spe'
+    destination.write_bytes(os.urandom(SIZE + 1000))
+    copy_file(str(source), str(destination), offset=CHUNK_SIZE)
+    assert destination.stat().st_size == SIZE
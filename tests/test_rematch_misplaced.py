@@ -0,0 +1,65 @@
+import os
+import datetime
+import rematch_misplaced
+from rematch_misplaced import rematch_misplaced as rematch, taken_run_ids
+from measurement_directory import measurement_name_from_runfolder
+
+
+class Response():
+    status_code = 200
+    text = ''
+
+
+class FakeBreadboardClient():
+
+    def __init__(self):
+        self.images, self.measurement_names = {}, {}
+
+    def append_images_to_run(self, run_id, image_names):
+        self.images[run_id] = image_names
+        return Response()
+
+    def add_measurement_name_to_run(self, run_id, measurement_name):
+        self.measurement_names[run_id] = measurement_name
+        return Response()
+
+
+def runtime(seconds_ago):
+    time = datetime.datetime.now() - datetime.timedelta(seconds=seconds_ago)
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def make_day(tmp_path):
+    runfolder = tmp_path / '202610' / '261017' / 'run0_test'
+    misplaced_folder = tmp_path / '202610' / '261017' / 'run0_testmisplaced'
+    runfolder.mkdir(parents=True)
+    misplaced_folder.mkdir()
+    return runfolder, misplaced_folder
+
+
+def test_taken_runs_are_read_from_the_image_names(tmp_path):
+    runfolder, _ = make_day(tmp_path)
+    for name in ['11_0.spe', '11_1.spe', '12_0.spe', 'notes.txt', 'misplacedimage.spe']:
+        (runfolder / name).write_bytes(b'')
+    assert taken_run_ids([str(runfolder), str(runfolder)]) == {11, 12}
+
+
+def test_measurement_name_does_not_depend_on_the_cwd(tmp_path, monkeypatch):
+    runfolder, _ = make_day(tmp_path)
+    monkeypatch.chdir(str(runfolder))
+    assert measurement_name_from_runfolder(str(runfolder)) == os.path.join('202610', '261017', 'run0_test')
+    assert measurement_name_from_runfolder(os.path.join('..', 'run0_test')) == os.path.join('202610', '261017',
+                                                                                             'run0_test')
+
+
+def test_shot_is_not_matched_to_a_run_with_images(tmp_path, monkeypatch):
+    runfolder, misplaced_folder = make_day(tmp_path)
+    (runfolder / '11_0.spe').write_bytes(b'')
+    (misplaced_folder / 'image.spe').write_bytes(b'')  # no camera time, timed by its ctime
+    runs = [{'run_id': 11, 'runtime': runtime(2)}, {'run_id': 10, 'runtime': runtime(4)}]
+    monkeypatch.setattr(rematch_misplaced, 'get_runs_since', lambda bc, start_time: runs)
+    monkeypatch.chdir(str(tmp_path / '202610'))
+    bc = FakeBreadboardClient()
+    assert rematch(str(tmp_path / '202610' / '261017'), bc=bc) == {10: ['10_0.spe']}
+    assert sorted(os.listdir(str(runfolder))) == ['10_0.spe', '11_0.spe']
+    assert bc.measurement_names == {10: os.path.join('202610', '261017', 'run0_test')}
@@ -0,0 +1,74 @@
+import os
+import time
+import multiprocessing
+from replication_queue import ReplicationQueue
+
+
+def _claim_all(db_path, results):
+    queue = ReplicationQueue(db_path=db_path, autostart=False)
+    claimed_ids = []
+    while True:
+        row = queue._claim()
+        if row is None:
+            break
+        claimed_ids.append(row[0])
+        time.sleep(0.001)  # lets the other processes claim in between
+    results.put(claimed_ids)
+
+
+def _enqueue(queue, tmp_path, n_copies):
+    for idx in range(n_copies):
+        filename = '{idx}.spe'.format(idx=idx)
+        queue.enqueue(str(tmp_path / filename), str(tmp_path / 'copies' / filename))
+
+
+def test_every_copy_is_claimed_by_one_process(tmp_path):
+    db_path = str(tmp_path / 'queue.sqlite')
+    _enqueue(ReplicationQueue(db_path=db_path, autostart=False), tmp_path, 200)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_claim_all, args=(db_path, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    claimed_ids = [claimed_id for _ in processes for claimed_id in results.get(timeout=60)]
+    for process in processes:
+        process.join()
+    assert sorted(claimed_ids) == list(range(1, 201))
+
+
+def test_copies_of_a_live_process_survive_a_restart(tmp_path):
+    db_path = str(tmp_path / 'queue.sqlite')
+    queue = ReplicationQueue(db_path=db_path, autostart=False)
+    _enqueue(queue, tmp_path, 1)
+    assert queue._claim() is not None
+    restarted_queue = ReplicationQueue(db_path=db_path, autostart=False)
+    assert restarted_queue._claim() is None
+    assert restarted_queue.status()['queue_depth'] == 1
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    db_path = str(tmp_path / 'queue.sqlite')
+    crashed_queue = ReplicationQueue(db_path=db_path, autostart=False, lease_time=0.1)
+    _enqueue(crashed_queue, tmp_path, 1)
+    copy_id = crashed_queue._claim()[0]
+    queue = ReplicationQueue(db_path=db_path, autostart=False)
+    assert queue._claim() is None
+    time.sleep(0.2)
+    assert queue._claim()[0] == copy_id
+
+
+def test_copy_is_verified_by_checksum(tmp_path):
+    source = tmp_path / 'image.spe'
+    source.write_bytes(os.urandom(100000))
+    (tmp_path / 'copies').mkdir()
+    destination = tmp_path / 'copies' / 'image.spe'
+    queue = ReplicationQueue(db_path=str(tmp_path / 'queue.sqlite'), num_workers=1)
+    try:
+        queue.enqueue(str(source), str(destination))
+        start_time = time.monotonic()
+        while queue.status()['done'] == 0 and time.monotonic() - start_time < 10:
+            time.sleep(0.05)
+    finally:
+        queue.stop()
+    assert destination.read_bytes() == source.read_bytes()
+    checksum = queue._connection().execute("SELECT checksum FROM copies").fetchone()[0]
+    assert checksum is not None
@@ -0,0 +1,72 @@
+import datetime
+from run_matching import assign_shots_to_runs, OffsetEstimator, ArrivalClock, image_times
+
+T0 = datetime.datetime(2026, 10, 17, 12, 0, 0)
+
+
+def seconds(*values):
+    return [T0 + datetime.timedelta(seconds=value) for value in values]
+
+
+def test_every_shot_is_matched_to_the_newest_run_before_it():
+    runtimes = seconds(0, 20, 40)
+    assert assign_shots_to_runs(seconds(3, 23, 43), runtimes) == [0, 1, 2]
+
+
+def test_runs_and_shots_can_be_given_newest_first():
+    runtimes = seconds(40, 20, 0)
+    assert assign_shots_to_runs(seconds(43, 3), runtimes) == [0, 2]
+
+
+def test_shot_outside_the_window_is_unmatched():
+    runtimes = seconds(0, 20)
+    assert assign_shots_to_runs(seconds(3, 35), runtimes, max_time_diff_in_sec=10) == [0, None]
+
+
+def test_assignment_preserves_the_order_of_shots_and_runs():
+    # both shots are within 10 s of both runs, but a later shot can never belong to an earlier run
+    runtimes = seconds(0, 2)
+    assert assign_shots_to_runs(seconds(4, 5), runtimes) == [0, 1]
+
+
+def test_run_without_a_shot_is_skipped():
+    # the camera missed the trigger of the run at 20 s
+    runtimes = seconds(0, 20, 40)
+    assert assign_shots_to_runs(seconds(3, 43), runtimes) == [0, 2]
+
+
+def test_expected_time_diff_picks_the_run_the_delay_was_learned_for():
+    runtimes = seconds(0, 4)
+    assert assign_shots_to_runs(seconds(6), runtimes) == [1]
+    assert assign_shots_to_runs(seconds(6), runtimes, expected_time_diff_in_sec=6) == [0]
+
+
+def test_no_shots_or_no_runs():
+    assert assign_shots_to_runs([], seconds(0)) == []
+    assert assign_shots_to_runs(seconds(3), []) == [None]
+
+
+def test_offset_estimator_tightens_the_window_around_the_learned_delay():
+    estimator = OffsetEstimator(min_time_diff_in_sec=0, max_time_diff_in_sec=10, min_samples=5)
+    assert estimator.window() == (0, 10)
+    for run_id in range(5):
+        estimator.update(T0 + datetime.timedelta(seconds=20 * run_id + 3), T0 + datetime.timedelta(seconds=20 * run_id),
+                         run_id)
+    assert estimator.time_diff_in_sec() == 3
+    assert estimator.cycle_period_in_sec() == 20
+    assert estimator.window() == (2, 4)
+
+
+def test_camera_times_are_moved_onto_the_arrival_clock():
+    arrival_clock = ArrivalClock()
+    camera_times = seconds(0, 20, 40)
+    times = image_times(camera_times, seconds(1.5, 21.4, 41.6), arrival_clock)
+    assert arrival_clock.latency_in_sec() == 1.5
+    assert times == seconds(1.5, 21.5, 41.5)
+
+
+def test_a_batch_with_an_image_without_camera_time_is_timed_by_arrival():
+    arrival_clock = ArrivalClock()
+    arrival_times = seconds(1.5, 21.4)
+    assert image_times([T0, None], arrival_times, arrival_clock) == arrival_times
+    assert arrival_clock.latency_in_sec() is None
@@ -0,0 +1,120 @@
+import struct
+import datetime
+import numpy as np
+from spe_file import HEADER_SIZE, read_spe_header, read_spe_frames, spe_camera_time, parse_spe_datetime
+
+CREATED = '2026-10-17T12:00:00.5-04:00'
+
+
+def write_spe(filepath, frames, created=CREATED, frame_metadata=True, footer=True):
+    """Writes uint16 frames of shape (num_frames, ydim, xdim) as a LightField SPE 3.0 file, with an exposure start
+    timestamp (in microseconds since created) and a frame tracking number after every frame if frame_metadata.
+    Without footer, the file ends after the frames, as while LightField is still writing it."""
+    num_frames, ydim, xdim = frames.shape
+    frame_size = xdim * ydim * 2
+    stride = frame_size + (16 if frame_metadata else 0)
+    data = b''
+    for frame_idx, frame in enumerate(frames):
+        data += frame.astype('<u2').tobytes()
+        if frame_metadata:
+            data += struct.pack('<qq', 1500000 * frame_idx, 100 + frame_idx)
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into('<H', header, 42, xdim)
+    struct.pack_into('<h', header, 108, 3)
+    struct.pack_into('<H', header, 656, ydim)
+    struct.pack_into('<Q', header, 678, HEADER_SIZE + len(data) if footer else 0)
+    struct.pack_into('<i', header, 1446, num_frames)
+    struct.pack_into('<f', header, 1992, 3.0)
+    meta_block = ''
+    if frame_metadata:
+        meta_block = ('<MetaFormat><MetaBlock id="1">'
+                      '<TimeStamp event="ExposureStarted" type="Int64" bitDepth="64" resolution="1000000"/>'
+                      '<FrameTrackingNumber type="Int64" bitDepth="64"/>'
+                      '</MetaBlock></MetaFormat>')
+    xml = ('<?xml version="1.0" encoding="utf-8"?>'
+           '<SpeFormat version="3.0" xmlns="http://www.princetoninstruments.com/spe/2009">'
+           '<DataFormat><DataBlock type="Frame" count="{n}" pixelFormat="MonochromeUnsigned16" size="{size}" '
+           'stride="{stride}"><DataBlock type="Region" count="1" width="{x}" height="{y}" size="{size}" '
+           'stride="{size}"/></DataBlock></DataFormat>{meta}'
+           '<DataHistories><DataHistory><Origin software="LightField" created="{created}"/></DataHistory>'
+           '</DataHistories><Experiment><Devices><Cameras><Camera><ShutterTiming><ExposureTime>20</ExposureTime>'
+           '</ShutterTiming></Camera></Cameras></Devices></Experiment></SpeFormat>').format(
+        n=num_frames, size=frame_size, stride=stride, x=xdim, y=ydim, meta=meta_block, created=created)
+    with open(filepath, 'wb') as file:
+        file.write(bytes(header))
+        file.write(data)
+        if footer:
+            file.write(xml.encode())
+
+
+def make_frames(num_frames=3, ydim=4, xdim=5):
+    return np.arange(num_frames * ydim * xdim, dtype=np.uint16).reshape(num_frames, ydim, xdim)
+
+
+def test_header_geometry_and_exposure(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    write_spe(filepath, make_frames())
+    header = read_spe_header(filepath)
+    assert (header['num_frames'], header['ydim'], header['xdim']) == (3, 4, 5)
+    assert header['dtype'] == '<u2'
+    assert (header['frame_size'], header['frame_stride']) == (40, 56)
+    assert header['exposure_sec'] == 0.02
+
+
+def test_frame_timestamps_and_tracking_numbers(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    write_spe(filepath, make_frames())
+    header = read_spe_header(filepath)
+    created = parse_spe_datetime(CREATED)
+    assert header['acquisition_time'] == created
+    assert header['frame_timestamps'] == [created + datetime.timedelta(seconds=1.5 * idx) for idx in range(3)]
+    assert header['frame_tracking_numbers'] == [100, 101, 102]
+    assert spe_camera_time(filepath) == created
+
+
+def test_frame_metadata_is_optional(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    write_spe(filepath, make_frames(), frame_metadata=False)
+    header = read_spe_header(filepath)
+    assert header['frame_timestamps'] is None
+    assert header['frame_tracking_numbers'] is None
+    assert spe_camera_time(filepath) == parse_spe_datetime(CREATED)
+
+
+def test_read_frames_skips_the_frame_metadata(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    frames = make_frames()
+    write_spe(filepath, frames)
+    np.testing.assert_array_equal(read_spe_frames(filepath), frames)
+
+
+def test_no_camera_time_before_the_footer_is_written(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    write_spe(filepath, make_frames(), footer=False)
+    assert spe_camera_time(filepath) is None
+    with open(filepath, 'wb') as file:
+        file.write(b'\0' * 100)  # the header is not complete yet
+    assert spe_camera_time(filepath) is None
+
+
+def test_spe2_acquisition_time_from_the_header(tmp_path):
+    filepath = str(tmp_path / 'image.spe')
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into('10s', header, 20, b'17Oct2026')
+    struct.pack_into('<H', header, 42, 2)
+    struct.pack_into('<h', header, 108, 3)
+    struct.pack_into('7s', header, 172, b'120000')
+    struct.pack_into('<H', header, 656, 2)
+    struct.pack_into('<i', header, 1446, 1)
+    struct.pack_into('<f', header, 1992, 2.5)
+    with open(filepath, 'wb') as file:
+        file.write(bytes(header) + b'\0' * 8)
+    assert spe_camera_time(filepath) == datetime.datetime(2026, 10, 17, 12, 0, 0)
+
+
+def test_parse_spe_datetime_converts_to_local_time():
+    utc_time = parse_spe_datetime('2026-10-17T16:00:00.25Z')
+    assert utc_time == parse_spe_datetime('2026-10-17T12:00:00.25-04:00')
+    expected = datetime.datetime(2026, 10, 17, 16, 0, 0, 250000, tzinfo=datetime.timezone.utc)
+    assert utc_time == expected.astimezone().replace(tzinfo=None)
+    assert parse_spe_datetime('2026-10-17T12:00:00') == datetime.datetime(2026, 10, 17, 12, 0, 0)
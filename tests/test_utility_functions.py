@@ -0,0 +1,52 @@
+from utility_functions import page_back_runs
+
+
+class FakeBreadboard():
+    """Serves run dicts newest first by offset, like the /runs/ endpoint, while runs are created and deleted."""
+
+    def __init__(self, n_runs):
+        self.run_ids = list(range(1, n_runs + 1))
+        self.requests = 0
+        self.new_runs_per_request = 0
+        self.deleted_per_request = []
+
+    def get_page(self, limit, offset):
+        self.requests += 1
+        for _ in range(self.new_runs_per_request):
+            self.run_ids.append(self.run_ids[-1] + 1)
+        if len(self.deleted_per_request) > 0:
+            for run_id in self.deleted_per_request.pop(0):
+                self.run_ids.remove(run_id)
+        newest_first = self.run_ids[::-1]
+        return [{'run_id': run_id} for run_id in newest_first[offset:offset + limit]]
+
+
+def test_pages_back_through_all_runs():
+    breadboard = FakeBreadboard(95)
+    run_ids = [run_dict['run_id'] for run_dict in page_back_runs(breadboard.get_page, 10)]
+    assert run_ids == list(range(95, 0, -1))
+
+
+def test_runs_created_while_paging_are_not_yielded_twice():
+    breadboard = FakeBreadboard(95)
+    breadboard.new_runs_per_request = 3
+    run_ids = [run_dict['run_id'] for run_dict in page_back_runs(breadboard.get_page, 10)]
+    assert run_ids[-95:] == list(range(95, 0, -1))
+    assert len(run_ids) == len(set(run_ids))
+
+
+def test_runs_deleted_while_paging_do_not_hide_older_runs():
+    breadboard = FakeBreadboard(95)
+    # deleting runs already yielded pulls the runs not reached yet to lower offsets
+    breadboard.deleted_per_request = [[], [95, 94, 93], [], [80, 79, 78, 77]]
+    run_ids = [run_dict['run_id'] for run_dict in page_back_runs(breadboard.get_page, 10)]
+    assert set(breadboard.run_ids).issubset(run_ids)
+    assert run_ids == sorted(set(run_ids), reverse=True)
+
+
+def test_stops_paging_when_the_caller_stops():
+    breadboard = FakeBreadboard(1000)
+    for run_dict in page_back_runs(breadboard.get_page, 10):
+        if run_dict['run_id'] <= 980:
+            break
+    assert breadboard.requests == 3
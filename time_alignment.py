@@ -0,0 +1,259 @@
+"""Aligns timestamped instrument readings to breadboard runs.
+
+ReadingBuffer keeps the newest `capacity` readings in a ring buffer: a preallocated float64 array of timestamps plus
+the readings themselves. align() matches one run or a whole batch of runs at once with np.searchsorted over the
+timestamps, instead of parsing every runtime string against every reading and taking an argmin per run.
+ColumnarReadingBuffer stores dicts of readings (e.g. the values of a StatusMonitor) as one preallocated typed array per
+value name instead, so the readings in the buffer, or in a time range of it, are numpy arrays ready for statistics
+and plotting.
+
+The arrays are twice the capacity and every reading is written at its position in both halves, so the readings,
+oldest first, are always the contiguous slice [start, start + count) and times(), column() and window() return views
+without copying.
+
+Times are seconds since 1970-01-01 of naive datetimes, compared as they are: breadboard runtimes and
+datetime.datetime.today() readings are aligned just like utility_functions.time_diff_in_sec does. For a run at
+runtime and a lag, the reading is matched to the target time runtime - lag:
+    - 'backward': the newest reading at or before the target (an as-of join),
+    - 'forward': the oldest reading at or after the target,
+    - 'nearest': the reading closest to the target,
+and the match only counts if the reading is less than tolerance seconds from the target.
+"""
+import logging
+import datetime
+import numpy as np
+
+DIRECTIONS = ['backward', 'forward', 'nearest']
+logger = logging.getLogger(__name__)
+
+
+def to_timestamps(times):
+    """Converts a time or a list of times, each a datetime, a breadboard runtime string (see
+    utility_functions.parse_runtime) or a timestamp, to a float64 array of timestamps."""
+    if isinstance(times, (str, datetime.datetime)) or np.isscalar(times):
+        times = [times]
+    times = list(times)
+    if len(times) > 0 and isinstance(times[0], str):
+        return np.array([time_str.rstrip('Z') for time_str in times], dtype='datetime64[us]').astype(np.int64) / 1e6
+    if len(times) > 0 and isinstance(times[0], datetime.datetime):
+        return np.array(times, dtype='datetime64[us]').astype(np.int64) / 1e6
+    return np.asarray(times, dtype=np.float64)
+
+
+def timestamp_to_datetime(timestamp):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=float(timestamp))
+
+
+def align_timestamps(reading_times, run_times, lag=0, tolerance=np.inf, direction='backward'):
+    """Matches run_times to the sorted array reading_times, see the module docstring.
+
+    Returns:
+        indices: int array of the matched reading of every run, -1 if there is none within tolerance.
+        deviations: float array of the matched reading time minus the target time of every run, also for matches
+            beyond tolerance (to report them), and inf where there is no reading in the given direction.
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(str(direction) + ' is not an allowed direction, i.e. ' + str(DIRECTIONS))
+    reading_times = np.asarray(reading_times, dtype=np.float64)
+    targets = to_timestamps(run_times) - lag
+    n_readings = len(reading_times)
+    indices = np.full(len(targets), -1, dtype=np.int64)
+    deviations = np.full(len(targets), np.inf)
+    if n_readings == 0:
+        return indices, deviations
+    if direction in ['backward', 'nearest']:
+        before = np.searchsorted(reading_times, targets, side='right') - 1
+        valid = before >= 0
+        indices[valid] = before[valid]
+        deviations[valid] = reading_times[before[valid]] - targets[valid]
+    if direction in ['forward', 'nearest']:
+        after = np.searchsorted(reading_times, targets, side='left')
+        valid = after < n_readings
+        after_deviations = np.full(len(targets), np.inf)
+        after_deviations[valid] = reading_times[after[valid]] - targets[valid]
+        closer = np.abs(after_deviations) < np.abs(deviations)
+        indices[closer] = after[closer]
+        deviations[closer] = after_deviations[closer]
+    indices[~(np.abs(deviations) < tolerance)] = -1
+    return indices, deviations
+
+
+class ReadingBuffer():
+
+    def __init__(self, capacity=30):
+        """
+        Args:
+            - capacity: number of newest readings kept, older ones are overwritten.
+        """
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        self._values = [None] * capacity
+        self.start = 0  # position of the oldest reading
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _next_position(self, time):
+        """Writes time at the position of the next reading, i.e. the oldest one once the buffer is full, and returns
+        the position."""
+        if time is None:
+            time = datetime.datetime.today()
+        position = (self.start + self.count) % self.capacity
+        self._times[position] = self._times[position + self.capacity] = to_timestamps(time)[0]
+        return position
+
+    def _advance(self):
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def append(self, value, time=None):
+        """Adds a reading taken at time (a datetime or timestamp, by default now). Readings are expected in the order
+        they were taken."""
+        position = self._next_position(time)
+        self._values[position] = value
+        self._advance()
+
+    def _position(self, idx):
+        return (self.start + idx) % self.capacity
+
+    def times(self):
+        """Returns the timestamps of the readings, oldest first, as a read-only view."""
+        return _view(self._times, self.start, self.count)
+
+    def time(self, idx):
+        """Returns the time of the idx-th oldest reading as a datetime."""
+        return timestamp_to_datetime(self._times[self._position(idx)])
+
+    def value(self, idx):
+        """Returns the idx-th oldest reading, or None for idx -1 (no match, see align)."""
+        if idx < 0:
+            return None
+        return self._values[self._position(idx)]
+
+    def index_range(self, start_time=None, end_time=None):
+        """Returns the indices (first, last + 1) of the readings taken within [start_time, end_time] (see
+        to_timestamps, None for no limit)."""
+        times = self.times()
+        first = 0 if start_time is None else int(np.searchsorted(times, to_timestamps(start_time)[0], side='left'))
+        last = self.count if end_time is None else int(np.searchsorted(times, to_timestamps(end_time)[0], side='right'))
+        return first, max(first, last)
+
+    def align(self, run_times, lag=0, tolerance=np.inf, direction='backward'):
+        """Matches one run time or a list of run times (see to_timestamps) to the readings, see align_timestamps.
+        The indices are those of value and time."""
+        return align_timestamps(self.times(), run_times, lag=lag, tolerance=tolerance, direction=direction)
+
+
+def _view(array, start, count):
+    view = array[start:start + count]
+    view.flags.writeable = False
+    return view
+
+
+def _column_dtype(value):
+    """Returns the dtype of a column holding value: bool, int64, float64, or object for anything else."""
+    if isinstance(value, (bool, np.bool_)):
+        return np.dtype(bool)
+    if isinstance(value, np.integer) or (isinstance(value, int) and -2**63 <= value < 2**63):
+        return np.dtype(np.int64)
+    if isinstance(value, (float, np.floating)):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+_MISSING = {np.dtype(bool): False, np.dtype(np.int64): 0, np.dtype(np.float64): np.nan, np.dtype(object): None}
+
+
+class ColumnarReadingBuffer(ReadingBuffer):
+    """ColumnarReadingBuffer keeps dicts of readings as one typed column per value name: bool, int64 or float64 if
+    all readings of the name are of that type, object otherwise. Whether a reading has the value is kept in a bool
+    mask per name, see present. Where a reading lacks the value, float columns hold nan, object columns None and int
+    and bool columns 0 and False. A column whose readings stop fitting its dtype is converted once, with a warning:
+    an int column to float64 on a float reading, otherwise to object."""
+
+    def __init__(self, capacity=30):
+        """
+        Args:
+            - capacity: number of newest readings kept, older ones are overwritten.
+        """
+        ReadingBuffer.__init__(self, capacity=capacity)
+        self._values = None
+        self.columns = {}  # value name: array of 2 * capacity
+        self._present = {}  # value name: bool array of 2 * capacity, True where a reading has the value
+
+    def _fit_column(self, name, value):
+        """Creates the column of name for value, or converts it if value does not fit its dtype."""
+        dtype = _column_dtype(value)
+        if name not in self.columns:
+            self.columns[name] = np.full(2 * self.capacity, _MISSING[dtype], dtype=dtype)
+            self._present[name] = np.zeros(2 * self.capacity, dtype=bool)
+            return
+        column = self.columns[name]
+        if dtype == column.dtype or column.dtype == object or \
+                (column.dtype == np.float64 and dtype == np.int64):
+            return
+        new_dtype = np.dtype(np.float64) if column.dtype == np.int64 and dtype == np.float64 else np.dtype(object)
+        logger.warning('Converting the {old} column {name} to {new} for the reading {value}.'.format(
+            old=str(column.dtype), name=name, new=str(new_dtype), value=repr(value)))
+        if new_dtype == object:
+            new_column = np.array([item.item() for item in column], dtype=object)
+            new_column[~self._present[name]] = None
+        else:
+            new_column = column.astype(new_dtype)
+            new_column[~self._present[name]] = np.nan
+        self.columns[name] = new_column
+
+    def append(self, values_dict, time=None):
+        """Adds a dict of readings taken at time (a datetime or timestamp, by default now). Readings are expected in
+        the order they were taken."""
+        for name, value in values_dict.items():
+            if value is not None:
+                self._fit_column(name, value)
+        position = self._next_position(time)
+        for name, column in self.columns.items():
+            value = values_dict.get(name)
+            present = value is not None
+            if not present:
+                value = _MISSING[column.dtype]
+            column[position] = column[position + self.capacity] = value
+            self._present[name][position] = self._present[name][position + self.capacity] = present
+        self._advance()
+
+    def names(self):
+        return list(self.columns)
+
+    def column(self, name, start_time=None, end_time=None):
+        """Returns the readings of name taken within [start_time, end_time] (None for no limit), oldest first, as a
+        read-only view."""
+        first, last = self.index_range(start_time, end_time)
+        return _view(self.columns[name], self.start + first, last - first)
+
+    def present(self, name, start_time=None, end_time=None):
+        """Returns the bool mask of the readings taken within [start_time, end_time] (None for no limit) that have a
+        value of name, oldest first, as a read-only view."""
+        first, last = self.index_range(start_time, end_time)
+        return _view(self._present[name], self.start + first, last - first)
+
+    def window(self, start_time=None, end_time=None):
+        """Returns the timestamps and a dict of the columns of the readings taken within [start_time, end_time] (None
+        for no limit), oldest first, as read-only views."""
+        first, last = self.index_range(start_time, end_time)
+        return (_view(self._times, self.start + first, last - first),
+                {name: _view(column, self.start + first, last - first) for name, column in self.columns.items()})
+
+    def value(self, idx):
+        """Returns the dict of the idx-th oldest reading, without the values it lacks, or None for idx -1 (no match,
+        see align)."""
+        if idx < 0:
+            return None
+        position = self._position(idx)
+        values_dict = {}
+        for name, column in self.columns.items():
+            if not self._present[name][position]:
+                continue
+            value = column[position]
+            values_dict[name] = value.item() if isinstance(value, np.generic) else value
+        return values_dict
@@ -1,8 +1,10 @@
 import json
 import time
+import datetime
 from json import JSONDecodeError
 import numpy as np
 import matplotlib.pyplot as plt
+import run_feed
 
 
 def fancy_plot(x, y, fmt='', ax = None, **kwargs):
@@ -197,31 +199,113 @@ def load_breadboard_client():
     return bc
 
 
-def get_newest_run_dict(bc, max_retries=10, run_id_offset=0):
-    """Gets newest run dictionary containing runtime, run_id, and parameters via breadboard client bc
+def get_newest_runs(bc, limit=1, max_retries=10, offset=0, use_run_feed=True):
+    """Gets the limit newest run dictionaries containing runtime, run_id, and parameters via breadboard client bc
+    in a single request. The newest run comes first.
     Optional args:
-        run_id_offset ~ (int <= 0) negative values will return not the most recent run_dict, 
-            but run_id_offset ids from the past 
+        offset ~ skip this many of the newest runs, e.g. to page back through older runs
+        use_run_feed ~ if True, the runs are taken from the local run feed when one is running and holds them,
+            without a request to breadboard. See run_feed.py
     """
+    if use_run_feed:
+        run_dicts = run_feed.get_newest_runs(limit=limit, offset=offset)
+        if run_dicts is not None:
+            return run_dicts
     retries = 0
     while retries < max_retries:
         try:
             resp = bc._send_message(
-                'get', '/runs/', params={'lab': 'fermi1', 'limit': abs(run_id_offset) + 1})
+                'get', '/runs/', params={'lab': 'fermi1', 'limit': limit, 'offset': offset})
             if resp.status_code != 200:
                 retries += 1
                 time.sleep(0.3)
                 continue
-            new_run_dict = resp.json()['results'][abs(run_id_offset)]
+            new_run_dicts = resp.json()['results']
             break
         except JSONDecodeError:
             time.sleep(0.3)
             retries += 1
 
-    new_run_dict_clean = {'runtime': new_run_dict['runtime'],
-                          'run_id': new_run_dict['id'],
-                          **new_run_dict['parameters']}
-    return new_run_dict_clean
+    return [clean_run_dict(new_run_dict) for new_run_dict in new_run_dicts]
+
+
+def clean_run_dict(run_dict):
+    """Flattens a run as returned by the breadboard API into {'runtime', 'run_id', **parameters}"""
+    return {'runtime': run_dict['runtime'],
+            'run_id': run_dict['id'],
+            **run_dict['parameters']}
+
+
+def parse_runtime(runtime_str):
+    """Returns run_dict['runtime'] as a datetime object."""
+    return datetime.datetime.strptime(runtime_str, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def get_newest_run_dict(bc, max_retries=10, run_id_offset=0):
+    """Gets newest run dictionary containing runtime, run_id, and parameters via breadboard client bc
+    Optional args:
+        run_id_offset ~ (int <= 0) negative values will return not the most recent run_dict, 
+            but run_id_offset ids from the past 
+    """
+    return get_newest_runs(bc, limit=abs(run_id_offset) + 1, max_retries=max_retries)[abs(run_id_offset)]
+
+
+def get_runs_since(bc, start_time, page_size=200, use_run_feed=True):
+    """Gets all runs with runtime at or after start_time (a datetime object), newest first, from the local run feed
+    if it reaches back to start_time (see run_feed.py), and otherwise paging back through breadboard page_size runs per
+    request.
+    """
+    if use_run_feed:
+        run_dicts = run_feed.get_runs_since(start_time)
+        if run_dicts is not None:
+            return run_dicts
+    run_dicts = []
+    for run_dict in page_back_runs(lambda limit, offset: get_newest_runs(bc, limit=limit, offset=offset), page_size):
+        if parse_runtime(run_dict['runtime']) < start_time:
+            break
+        run_dicts.append(run_dict)
+    return run_dicts
+
+
+def page_back_runs(get_page, page_size, id_key='run_id'):
+    """Yields the runs of breadboard newest first, each run once, from pages fetched with get_page(limit, offset).
+
+    Offsets count from the newest run, so runs created while paging push runs already seen onto the next page, and
+    deleted runs pull runs not seen yet onto the previous one. Consecutive pages therefore overlap by one run, runs not
+    older than the oldest run yielded are dropped, and a page which does not reach back to the oldest run yielded
+    is fetched again from a lower offset.
+    Args:
+        - get_page: function taking limit and offset and returning a list of run dicts, newest first.
+        - page_size: limit of every page.
+        - id_key: key of the run_id in the run dicts, 'id' for run dicts as returned by the breadboard API.
+    """
+    offset, oldest_id = 0, None
+    step = max(page_size - 1, 1)
+    while True:
+        page = get_page(page_size, offset)
+        if page_size > 1 and offset > 0 and len(page) > 0 and page[0][id_key] < oldest_id:
+            offset = max(offset - step, 0)
+            continue
+        for run_dict in page:
+            if oldest_id is None or run_dict[id_key] < oldest_id:
+                oldest_id = run_dict[id_key]
+                yield run_dict
+        if len(page) < page_size:
+            return
+        offset += step
+
+
+def get_runs_by_ids(bc, run_ids, mirror=None):
+    """Gets the run dictionaries of run_ids from the local mirror of breadboard runs, which only fetches the runs it does
+    not hold (or holds for longer than its max_age), in paged or per-run requests, whichever takes fewer. See
+    run_mirror.RunMirror.fetch_missing. Returns a dict of run_id: run_dict, without the run_ids not found on breadboard.
+    """
+    import run_mirror
+    if mirror is None:
+        mirror = run_mirror.get_mirror(bc)
+    mirror.fetch_missing(run_ids, mirror.max_age)
+    return {run_dict['id']: clean_run_dict(run_dict) for run_dict in mirror.get_run_dicts(run_ids)}
+
 
 def get_newest_value(bc, key, max_tries_this_level = 6, delay_seconds = 5):
     tries = 0
@@ -242,8 +326,7 @@ def time_diff_in_sec(runtime_str, trigger_time):
         runtime_str: The string value from run_dict['runtime'], e.g. from get_newest_run_dict.
         trigger_time: a datetime object.
     """
-    import datetime
-    runtime = datetime.datetime.strptime(runtime_str, "%Y-%m-%dT%H:%M:%SZ")
+    runtime = parse_runtime(runtime_str)
     time_diff = (runtime - trigger_time)
     return time_diff.total_seconds()
 
@@ -268,17 +351,22 @@ def load_analysis_path():
         analysis_paths = json.load(my_file)
     return analysis_paths
 
-def get_newest_df(watchfolder, optional_column_names=[], existing_df=None):
-    """Returns a dataframe constructed by getting data from breadboard for run_ids parsed from watchfolder directory.
+def get_newest_df(watchfolder, optional_column_names=[], existing_df=None, mirror=None, max_age=None):
+    """Returns a dataframe constructed from the local mirror of breadboard runs for run_ids parsed from watchfolder directory.
 
     Args:
         watchfolder: path string.
         optional_column_names: a list of non-default columns to get from breadboard (e.g. non list-bound variables.)
-        existing_df: previously created dataframe generated by calling get_newest_df. This prevents overloading breadboard with unnecessary get requests.
+        existing_df: previously created dataframe generated by calling get_newest_df. Its rows are kept as they are, e.g. with unsaved edits.
+        mirror: RunMirror to build the dataframe from, by default the one of this process. See run_mirror.py
+        max_age: runs fetched from breadboard more than max_age seconds ago are fetched again, by default after the max_age of the mirror. 0 re-fetches all runs.
     """
     from measurement_directory import run_ids_from_txt, run_ids_from_filenames
     import os
-    bc = load_breadboard_client()
+    import pandas as pd
+    import run_mirror
+    if mirror is None:
+        mirror = run_mirror.get_mirror()
     run_ids = []
     files = [filename for filename in os.listdir(watchfolder)]
     files_spe = []
@@ -290,16 +378,17 @@ def get_newest_df(watchfolder, optional_column_names=[], existing_df=None):
                 os.path.abspath(os.path.join(watchfolder, file)))
     if existing_df is None:
         run_ids += run_ids_from_filenames(files_spe)
-        df = bc.get_runs_df_from_ids(
-            run_ids, optional_column_names=optional_column_names)
+        df = mirror.get_runs_df(
+            run_ids, optional_column_names=optional_column_names, max_age=max_age)
     else:
         run_ids = list(set(run_ids_from_filenames(files_spe)).union(set(run_ids)).difference(
             set(list(existing_df['run_id']))))
         if len(run_ids) > 0:
-            df = existing_df.append(bc.get_runs_df_from_ids(run_ids,
-                                                            optional_column_names=optional_column_names),
-                                    sort=False,
-                                    ignore_index=True)
+            df = pd.concat([existing_df, mirror.get_runs_df(run_ids,
+                                                            optional_column_names=optional_column_names,
+                                                            max_age=max_age)],
+                           sort=False,
+                           ignore_index=True)
         else:
             df = existing_df
 
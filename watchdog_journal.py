@@ -0,0 +1,95 @@
+"""An append-only journal of the state of every image handled by ImageWatchdog.
+
+Every state change of an image (arrived, matched or misplaced, moved, copy queued, done) is appended as one JSON
+line and flushed to the OS immediately, so it survives a crash of the process. fsync, which is needed to survive
+a crash of the PC, is batched to at most one call per fsync_interval seconds: a record not synced right away is
+synced by a timer at most fsync_interval seconds later, also when no further record follows. On restart, replay() returns the
+last state of every image whose handling did not finish, so ImageWatchdog can complete or redo it.
+"""
+import os
+import json
+import time
+import threading
+
+# states of an image in the order they are reached. Misplaced images go from 'misplaced' straight to 'done'.
+ARRIVED, MATCHED, MISPLACED, MOVED, COPY_QUEUED, DONE = 'arrived', 'matched', 'misplaced', 'moved', 'copy_queued', 'done'
+
+
+class WatchdogJournal():
+
+    def __init__(self, path, fsync_interval=1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.last_fsync_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.sync_timer = None
+        self.file = open(self.path, 'a')
+        if self.file.tell() > 0:
+            with open(self.path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    self.file.write('\n')  # terminate a line torn by a crash mid-write
+
+    def record(self, filename, status, **fields):
+        """Appends the new status of watchfolder image filename, with any extra JSON serializable fields
+        (e.g. run_id, new_filepath), to the journal."""
+        entry = {'file': filename, 'status': status, 'time': time.time(), **fields}
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            time_since_fsync = time.monotonic() - self.last_fsync_time
+            if time_since_fsync > self.fsync_interval:
+                self._sync()
+            elif self.sync_timer is None:
+                self.sync_timer = threading.Timer(self.fsync_interval - time_since_fsync, self.sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+
+    def _sync(self):
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if not self.file.closed:
+            os.fsync(self.file.fileno())
+        self.last_fsync_time = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+    def replay(self):
+        """Returns a list of the states of images which are not done, in order of arrival. Each state is a dict
+        with the fields of all records since the image arrived, and the status of the newest record."""
+        states = {}
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line torn by a crash mid-write
+                filename = entry['file']
+                if entry['status'] == ARRIVED or filename not in states:
+                    states[filename] = entry
+                else:
+                    states[filename].update({key: value for key, value in entry.items() if key != 'time'})
+        return sorted([state for state in states.values() if state['status'] != DONE], key=lambda state: state['time'])
+
+    def compact(self):
+        """Rewrites the journal with only the images which are not done, so it does not grow without bound."""
+        with self.lock:
+            self._sync()
+            incomplete_states = self.replay()
+            self.file.close()
+            compacted_path = self.path + '.compact'
+            with open(compacted_path, 'w') as file:
+                for state in incomplete_states:
+                    file.write(json.dumps(state) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(compacted_path, self.path)
+            self.file = open(self.path, 'a')
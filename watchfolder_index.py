@@ -0,0 +1,81 @@
+"""An incremental index of the run_ids of the images in a run folder.
+
+new_run_ids() only looks at files added since its last call: with inotify it takes their names from the close-write
+and moved-to events of the folder (see folder_watcher.py), otherwise it re-lists the folder only when its mtime
+changed. Names are matched with a precompiled pattern instead of the parse library, and the known run_ids are kept
+in a sorted array, so every call costs O(new files), however many shots the folder already holds.
+"""
+import os
+import re
+import time
+from array import array
+from bisect import bisect_left, insort
+from folder_watcher import make_folder_watcher, InotifyFolderWatcher
+
+RUN_FILENAME_PATTERN = re.compile(r'(\d+)_\d+\.spe$')
+# a directory mtime this recent may still change within its timestamp resolution, so it is not trusted yet
+MTIME_SETTLE_TIME = 2
+
+
+class WatchfolderIndex():
+
+    def __init__(self, folder, backend='auto'):
+        """
+        Args:
+            - folder: run folder of images named runId_imageIdx.spe.
+            - backend: notification backend, see folder_watcher.make_folder_watcher. Without inotify the folder is
+                re-listed when its mtime changes.
+        """
+        self.folder = folder
+        self.run_ids = array('q')  # sorted run_ids of all images seen so far
+        self.seen_filenames = set()
+        self.folder_mtime_ns = None
+        self.folder_watcher = None
+        if backend != 'polling':
+            folder_watcher = make_folder_watcher(folder, backend=backend)
+            if isinstance(folder_watcher, InotifyFolderWatcher):
+                self.folder_watcher = folder_watcher
+        # images written before the index was created are returned by the first new_run_ids call
+        self.unreported_run_ids = self._new_run_ids(os.listdir(folder))
+
+    def __contains__(self, run_id):
+        idx = bisect_left(self.run_ids, run_id)
+        return idx < len(self.run_ids) and self.run_ids[idx] == run_id
+
+    def __len__(self):
+        return len(self.run_ids)
+
+    def _new_run_ids(self, filenames):
+        new_run_ids = set()
+        for filename in filenames:
+            if filename in self.seen_filenames:
+                continue
+            self.seen_filenames.add(filename)
+            match = RUN_FILENAME_PATTERN.match(filename)
+            if match is None:
+                continue
+            run_id = int(match.group(1))
+            if run_id not in self and run_id not in new_run_ids:
+                new_run_ids.add(run_id)
+        for run_id in new_run_ids:
+            insort(self.run_ids, run_id)
+        return sorted(new_run_ids)
+
+    def new_run_ids(self):
+        """Returns a sorted list of the run_ids of images added to the folder since the last call. Each run_id is
+        returned once, when its first image appears."""
+        new_run_ids, self.unreported_run_ids = self.unreported_run_ids, []
+        if self.folder_watcher is not None:
+            new_run_ids += self._new_run_ids(self.folder_watcher.wait_for_files(timeout=0))
+            return sorted(new_run_ids)
+        folder_mtime_ns = os.stat(self.folder).st_mtime_ns
+        if folder_mtime_ns != self.folder_mtime_ns:
+            filenames = os.listdir(self.folder)
+            if time.time() - folder_mtime_ns / 1e9 > MTIME_SETTLE_TIME:
+                self.folder_mtime_ns = folder_mtime_ns
+            new_run_ids += self._new_run_ids(filenames)
+        return sorted(new_run_ids)
+
+    def close(self):
+        if self.folder_watcher is not None:
+            self.folder_watcher.close()
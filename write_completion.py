@@ -0,0 +1,103 @@
+"""Detection of when the camera (or ImageWatchdog) has finished writing an image file, without polling its size.
+
+An .spe file announces its own length: spe_write_state compares the file size with the byte length expected from
+its header (the 4100 byte header plus frame_stride bytes per frame) and, for SPE 3.x files, checks that the XML
+footer at xml_offset is closed by </SpeFormat>. WriteCompletionWaiter checks this whenever the folder reports a
+close-write (or a rename into the folder) and otherwise blocks, so a file is reported complete the moment its last
+byte lands. Files whose length cannot be predicted fall back to the close-write notification alone, or on
+platforms without inotify to an unchanged size over one poll_interval.
+"""
+import os
+import time
+import struct
+from spe_file import HEADER_SIZE, HEADER_FIELDS, DATATYPES
+from folder_watcher import make_folder_watcher, InotifyFolderWatcher
+
+COMPLETE, INCOMPLETE, UNKNOWN = 'complete', 'incomplete', 'unknown'
+SPE_FOOTER_END = b'</SpeFormat>'
+
+
+def spe_write_state(filepath):
+    """Returns COMPLETE if the .spe file at filepath holds all the bytes its header announces, INCOMPLETE if it does
+    not (yet) or does not exist, and UNKNOWN if filepath is not an .spe file or its header cannot be interpreted."""
+    if not filepath.lower().endswith('.spe'):
+        return UNKNOWN
+    try:
+        with open(filepath, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < HEADER_SIZE:
+                return INCOMPLETE
+            header_bytes = file.read(HEADER_SIZE)
+            header = {key: struct.unpack_from(fmt, header_bytes, offset)[0]
+                      for key, (offset, fmt) in HEADER_FIELDS.items()}
+            if header['file_header_ver'] >= 3:
+                # LightField writes the footer last, after all frames and their metadata
+                if header['xml_offset'] == 0 or size <= header['xml_offset']:
+                    return INCOMPLETE
+                file.seek(max(size - 64, header['xml_offset']))
+                return COMPLETE if file.read().rstrip(b'\0\r\n\t ').endswith(SPE_FOOTER_END) else INCOMPLETE
+            if header['xdim'] == 0 or header['ydim'] == 0 or header['num_frames'] <= 0:
+                return INCOMPLETE  # header not written yet
+            if header['datatype'] not in DATATYPES:
+                return UNKNOWN
+            frame_size = header['xdim'] * header['ydim'] * DATATYPES[header['datatype']][1]
+            return COMPLETE if size >= HEADER_SIZE + frame_size * header['num_frames'] else INCOMPLETE
+    except OSError:
+        return INCOMPLETE
+
+
+class WriteCompletionWaiter():
+    """Blocks until files in one folder are completely written. Create it before the files are written, so that
+    no close-write notification is missed."""
+
+    def __init__(self, folder, backend='auto', poll_interval=0.05):
+        """
+        Args:
+            - folder: folder the files are written to.
+            - backend: notification backend, see folder_watcher.make_folder_watcher.
+            - poll_interval: seconds between checks of incomplete files on platforms without inotify.
+        """
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.folder_watcher = make_folder_watcher(folder, backend=backend, refresh_time=poll_interval)
+        self.notifies_close_write = isinstance(self.folder_watcher, InotifyFolderWatcher)
+        self.closed_filenames = set()
+
+    def _collect_notifications(self, timeout):
+        if not self.notifies_close_write:
+            time.sleep(timeout)
+            return
+        self.closed_filenames.update(self.folder_watcher.wait_for_files(timeout=timeout))
+        if len(self.closed_filenames) > 1000:
+            # forget files that were moved away without anyone waiting for them
+            self.closed_filenames.intersection_update(os.listdir(self.folder))
+
+    def wait_until_complete(self, filepath, timeout=None):
+        """Returns True as soon as the file at filepath is completely written, or False if timeout (in seconds)
+        elapses first. Also waits for files which do not exist yet."""
+        filename = os.path.basename(filepath)
+        start_time = time.monotonic()
+        old_filesize = None
+        if self.notifies_close_write:
+            self._collect_notifications(0)
+        while True:
+            state = spe_write_state(filepath)
+            if state == UNKNOWN:
+                if self.notifies_close_write and filename in self.closed_filenames:
+                    state = COMPLETE
+                elif not self.notifies_close_write and os.path.exists(filepath):
+                    filesize = os.path.getsize(filepath)
+                    state = COMPLETE if filesize == old_filesize else INCOMPLETE
+                    old_filesize = filesize
+            if state == COMPLETE:
+                self.closed_filenames.discard(filename)
+                return True
+            wait_time = None if timeout is None else timeout - (time.monotonic() - start_time)
+            if wait_time is not None and wait_time <= 0:
+                return False
+            if not self.notifies_close_write:
+                wait_time = self.poll_interval if wait_time is None else min(wait_time, self.poll_interval)
+            self._collect_notifications(wait_time)
+
+    def close(self):
+        self.folder_watcher.close()